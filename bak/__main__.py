@@ -1,11 +1,60 @@
 from os import geteuid
-from sys import exit as exitapp
+from sys import argv, exit as exitapp
+
+
+def _fast_path(args) -> bool:
+    """ Answers `bak --version`, `bak where FILE [#]` and `bak config --get SETTING`
+        in plain text, without loading click, rich or the rest of bak; they're
+        called from shell prompts and hooks, where startup time matters.
+
+        Returns False for anything out of the ordinary (options, ambiguous
+        bakfiles, errors), which the full CLI then handles as usual.
+    """
+    if args == ['--version']:
+        from bak import BAK_VERSION
+        print(f"bak version {BAK_VERSION}")
+        return True
+
+    if len(args) in (2, 3) and args[0] == 'where' and not args[1].startswith('-'):
+        number = args[2] if len(args) == 3 else '0'
+        if not number.isdigit():
+            return False
+        from pathlib import Path
+        filename = Path(args[1]).expanduser().resolve()
+        if filename.is_dir():
+            return False
+        from bak.configuration import bak_cfg as cfg
+        if not cfg.bak_db_loc.exists():
+            return False
+        from bak.data.bak_db import BakDBHandler
+        entries = BakDBHandler(cfg.bak_db_loc).get_bakfile_entries(filename)
+        number = int(number)
+        if not entries or number > len(entries) or (not number and len(entries) > 1):
+            return False
+        print(entries[number - 1 if number else 0].bakfile_loc)
+        return True
+
+    if args[:1] == ['config'] and args[1:2] != ['--set']:
+        setting = [arg for arg in args[1:] if arg != '--get']
+        from bak.configuration import bak_cfg as cfg
+        if len(setting) != 1 or setting[0] not in cfg.SETTABLE_VALUES:
+            return False
+        print(cfg.get(setting[0], literal=True))
+        return True
+    return False
+
+
+def _confirm(prompt: str) -> bool:
+    try:
+        return input(f"{prompt} [y/N]: ").strip().lower() in ('y', 'yes')
+    except EOFError:
+        return False
 
-from click import confirm
 
 def run_bak():
     if geteuid() == 0:
-        if not confirm("WARNING: You are running bak as root! "
+        # A plain prompt, rather than click.confirm(), so the fast path stays fast
+        if not _confirm("WARNING: You are running bak as root! "
                     "This will create separate config and bakfiles for root, "
                     "and is probably not what you're trying to do.\n\n"
                     "If bak needs superuser privileges to copy or overwrite a file, "
@@ -13,8 +62,18 @@ def run_bak():
                     "Are you sure you want to continue as root?"):
             exitapp()
 
-    from bak.cli import bak as _bak
-    _bak()
+    # Before anything else is imported, so that startup shows up in the trace
+    from bak import trace
+    trace.start_early(argv[1:])
+
+    with trace.phase('fast path'):
+        if _fast_path(argv[1:]):
+            return
+
+    with trace.phase('startup'):
+        from bak.cli import bak as _bak
+    with trace.phase('command'):
+        _bak()
 
 if __name__ == "__main__":
     run_bak()
@@ -1,11 +1,13 @@
 import functools
+import glob
+import os
 from pathlib import Path
 
 
 import click
 from click_default_group import DefaultGroup
 
-from bak import commands
+from bak import commands, trace
 from bak import BAK_VERSION as bak_version
 from bak.configuration import bak_cfg as cfg
 
@@ -14,16 +16,19 @@ def __print_help():
         click.echo(bak.get_help(ctx))
 
 
-def normalize_path(args_key: str = 'filename'):
+def normalize_path(args_key: str = 'filename', dirs_flag: str = None):
+    """ `dirs_flag` names a flag (e.g. --recursive) that makes directories
+        acceptable
+    """
     def on_decorator(func):
         @functools.wraps(func)
         def on_call(*args, **kwargs):
             try:
                 # expand path
                 arg = Path(kwargs[args_key]).expanduser().resolve()
-                if arg.is_dir():
+                if arg.is_dir() and not kwargs.get(dirs_flag):
                     click.echo(
-                        f"Error: bak cannot operate on directories ({arg})")
+                        f"Error: bak cannot operate on directories ({arg}); try 'bak -r'")
                     return
                 else:
                     kwargs[args_key] = arg
@@ -35,6 +40,12 @@ def normalize_path(args_key: str = 'filename'):
     return on_decorator
 
 
+TRACE_HELP = "Report where the time goes (phases, database, I/O, memory) on stderr. " \
+    "Also: BAK_TRACE=1"
+TRACE_FILE_HELP = "Write the --trace report to FILE, as JSON. Also: BAK_TRACE=FILE"
+PROFILE_HELP = "Trace, and run under cProfile too. Also: BAK_TRACE_PROFILE=1"
+
+
 BASIC_HELP_TEXT = "bak FILENAME (creates a bakfile)\n\nalias: bak create\n\n" +\
     "See also: bak COMMAND --help"
 
@@ -44,48 +55,118 @@ BASIC_HELP_TEXT = "bak FILENAME (creates a bakfile)\n\nalias: bak create\n\n" +\
 # default command behavior is duplicated here because it's cleaner from a Click perspective,
 # which is to say that it gets the desired behavior across the board. ugly but it works!
 @click.option("--version", required=False, is_flag=True, help="Print current version and exit.")
-def bak(version:bool=False):
+@click.option("--trace", "trace_on", required=False, is_flag=True, help=TRACE_HELP)
+@click.option("--trace-file", required=False, type=click.Path(dir_okay=False), help=TRACE_FILE_HELP)
+@click.option("--profile", required=False, is_flag=True, help=PROFILE_HELP)
+def bak(version:bool=False, trace_on:bool=False, trace_file:str=None, profile:bool=False):
+    # Normally already started by bak's entry point, ahead of the imports
+    trace.start_from_options(trace_on, trace_file, profile)
     if version:
-        create_bak_cmd(None, version)
+        create_bak_cmd((), version)
+
+
+VERBOSE_HELP = "Report how files were copied (reflink, copy_file_range, ...)"
+
+
+FROM0_HELP = "Also back up the NUL-separated paths in FILE ('-' for stdin), as from find -print0"
+JOBS_HELP = "Worker threads for copying, when backing up several files"
+RECURSIVE_HELP = "Snapshot directories: back up every file in them, as one group"
+PARANOID_HELP = "Compare file contents even when size, timestamps and inode say they're unchanged"
 
 
 @bak.command("\0", hidden=True)
-@normalize_path()
 @click.option("--version", required=False, is_flag=True, help="Print current version and exit.")
-@click.argument("filename", required=False, type=click.Path(exists=True))
-def _create(filename, version):
-    create_bak_cmd(filename, version)
+@click.option("--verbose", "-v", required=False, is_flag=True, help=VERBOSE_HELP)
+@click.option("--from0", required=False, type=click.File('rb'), help=FROM0_HELP)
+@click.option("--jobs", "-j", required=False, type=click.IntRange(min=1),
+              default=commands.BATCH_WORKERS, help=JOBS_HELP)
+@click.option("--recursive", "-r", required=False, is_flag=True, help=RECURSIVE_HELP)
+@click.option("--paranoid", required=False, is_flag=True, help=PARANOID_HELP)
+@click.argument("filenames", nargs=-1, type=click.Path())
+def _create(filenames, version, verbose, from0, jobs, recursive, paranoid):
+    create_bak_cmd(filenames, version, verbose, from0, jobs, recursive, paranoid)
 
 
 @bak.command("create", hidden=True)
-@normalize_path()
 @click.option("--version", required=False, is_flag=True)
-@click.argument("filename", required=False, type=click.Path(exists=True))
-def create(filename, version):
-    create_bak_cmd(filename, version)
-
-
-def create_bak_cmd(filename, version):
+@click.option("--verbose", "-v", required=False, is_flag=True, help=VERBOSE_HELP)
+@click.option("--from0", required=False, type=click.File('rb'), help=FROM0_HELP)
+@click.option("--jobs", "-j", required=False, type=click.IntRange(min=1),
+              default=commands.BATCH_WORKERS, help=JOBS_HELP)
+@click.option("--recursive", "-r", required=False, is_flag=True, help=RECURSIVE_HELP)
+@click.option("--paranoid", required=False, is_flag=True, help=PARANOID_HELP)
+@click.argument("filenames", nargs=-1, type=click.Path())
+def create(filenames, version, verbose, from0, jobs, recursive, paranoid):
+    create_bak_cmd(filenames, version, verbose, from0, jobs, recursive, paranoid)
+
+
+def __expand_filenames(filenames, from0=None):
+    """ Shell-style globs are expanded here too, for shells that pass them
+        through (or quoted patterns). Patterns that match nothing are kept,
+        so they're reported as missing.
+    """
+    for name in filenames:
+        name = os.path.expanduser(name)
+        yield from (glob.glob(name, recursive=True) or [name]) if glob.has_magic(name) else [name]
+    if from0:
+        yield from (os.fsdecode(name) for name in from0.read().split(b'\0') if name.strip())
+
+
+def __snapshot_dirs(dirs, verbose, jobs, paranoid):
+    for root in dirs:
+        copied, shared, failed = commands.create_snapshot(root, verbose, jobs, paranoid)
+        for filename, reason in failed:
+            click.echo(f"Failed: {filename} ({reason})", err=True)
+        click.echo(f"Snapshot of {root}: copied {copied} file{'s' if copied != 1 else ''}, "
+                   f"shared {shared} unchanged, {len(failed)} failed")
+
+
+def create_bak_cmd(filenames, version, verbose=False, from0=None, jobs=commands.BATCH_WORKERS,
+                   recursive=False, paranoid=False):
     if version:
         click.echo(f"bak version {bak_version}")
-    elif not filename:
+        return
+    names = list(__expand_filenames(filenames, from0))
+    if recursive:
+        paths = [Path(name).expanduser().resolve() for name in names]
+        names = [str(path) for path in paths if not path.is_dir()]
+        __snapshot_dirs(list(dict.fromkeys(path for path in paths if path.is_dir())),
+                        verbose, jobs, paranoid)
+        if not names:
+            return
+    if not names:
     # Ensures that 'bak --help' is printed if it doesn't get a filename
         __print_help()
+    elif len(names) == 1 and not from0 and not recursive and not glob.has_magic(filenames[0]):
+        filename = Path(names[0]).expanduser().resolve()
+        if filename.is_dir():
+            click.echo(f"Error: bak cannot operate on directories ({filename}); try 'bak -r'")
+        elif not filename.exists():
+            raise click.BadParameter(f"Path '{names[0]}' does not exist.",
+                                     param_hint="'FILENAMES...'")
+        else:
+            commands.create_bakfile(filename, verbose, paranoid)
     else:
-        filename = Path(filename).expanduser().resolve()
-        commands.create_bakfile(filename)
+        backed_up, skipped, failed = commands.create_bakfiles(
+            [Path(name).expanduser().resolve() for name in names], verbose, jobs, paranoid)
+        for filename, reason in failed:
+            click.echo(f"Failed: {filename} ({reason})", err=True)
+        click.echo(f"Backed up {backed_up} file{'s' if backed_up != 1 else ''}, "
+                   f"skipped {skipped} unchanged, {len(failed)} failed")
 
 
 @bak.command("up", help="Replace a .bakfile with a fresh copy of the parent file")
 @normalize_path()
+@click.option("--verbose", "-v", required=False, is_flag=True, help=VERBOSE_HELP)
+@click.option("--paranoid", required=False, is_flag=True, help=PARANOID_HELP)
 @click.argument("filename", required=True, type=click.Path(exists=True))
 @click.argument("bakfile_number", metavar="[#]", required=False, type=int)
-def bak_up(filename, bakfile_number):
+def bak_up(filename, bakfile_number, verbose, paranoid):
     if not filename:
         click.echo("A filename or operation is required.\n"
                    "\tbak --help")
     filename = Path(filename).expanduser().resolve()
-    if not commands.bak_up_cmd(filename, bakfile_number):
+    if not commands.bak_up_cmd(filename, bakfile_number, verbose, paranoid):
         # TODO descriptive failures
         click.echo("An error occurred.")
 
@@ -103,15 +184,23 @@ def bak_up(filename, bakfile_number):
               default=False,
               help="No confirmation prompt")
 @click.option('-d', '-o', '--destination', default=None, type=str)
+@click.option("--verbose", "-v", required=False, is_flag=True, help=VERBOSE_HELP)
+@click.option("--recursive", "-r", required=False, is_flag=True,
+              help="Restore a directory from its snapshot # (default: the newest)")
 @click.argument("filename", required=True)
 @click.argument("bakfile_number", metavar="[#]", required=False, type=int)
-def bak_down(filename: str, keep: bool, quietly: bool, destination: str, bakfile_number: int=0):
+def bak_down(filename: str, keep: bool, quietly: bool, destination: str, bakfile_number: int=0,
+             verbose: bool=False, recursive: bool=False):
     if not filename:
         click.echo("A filename or operation is required.\n"
                    "\tbak --help")
     filename = Path(filename).expanduser().resolve()
     if destination:
         destination = Path(destination).expanduser().resolve()
+    if recursive:
+        commands.bak_down_snapshot_cmd(filename, destination, bool(keep), quietly,
+                                       bakfile_number, verbose)
+        return
     if not isinstance(keep, tuple):
         if keep in [-1, 'all']:
             keep = True
@@ -119,45 +208,152 @@ def bak_down(filename: str, keep: bool, quietly: bool, destination: str, bakfile
             keep = False
     else:
         keep = list(keep)
-    commands.bak_down_cmd(filename, destination, keep, quietly, bakfile_number)
+    commands.bak_down_cmd(filename, destination, keep, quietly, bakfile_number, verbose)
+
 
+OFF_HELP = "Use when finished to delete .bakfiles. Takes any number of files; directories " \
+    "(everything bak has under them, even if they're gone); and quoted globs, matched " \
+    "against the paths bak knows, where * matches / too (like retention_paths)"
 
-@bak.command("off", help="Use when finished to delete .bakfiles")
+
+@bak.command("off", help=OFF_HELP, short_help="Use when finished to delete .bakfiles")
 @click.option("--quietly", "-q",
               is_flag=True,
               default=False,
               help="Delete all related .bakfiles without confirming")
-@click.argument("filename", required=True)
-def bak_off(filename, quietly):
-    filename = Path(filename).expanduser().resolve()
-    if not commands.bak_off_cmd(filename, quietly):
+@click.argument("filenames", nargs=-1, required=True)
+def bak_off(filenames, quietly):
+    paths = [Path(name).expanduser().resolve() for name in filenames if not glob.has_magic(name)]
+    patterns = [str(Path(name).expanduser().resolve()) for name in filenames
+                if glob.has_magic(name)]
+    if not commands.bak_off_cmd(paths, patterns, quietly):
         # TODO better output here
         click.echo("Operation cancelled or failed.")
 
-@bak.command("del", help="Delete a single .bakfile by number (see `bak list FILENAME`)"
+
+def __parse_numbers(specs):
+    """ ('3', '5-9', '12,14') -> [3, 5, 6, 7, 8, 9, 12, 14] """
+    numbers = []
+    for spec in specs:
+        for part in spec.split(','):
+            first, _, last = part.strip().partition('-')
+            try:
+                first = int(first)
+                last = int(last) if last else first
+            except ValueError:
+                raise click.BadParameter(f"'{part}' is neither a number nor a range (like 3-40)",
+                                         param_hint="'#'")
+            if first < 1 or last < first:
+                raise click.BadParameter(f"'{part}' isn't a valid .bakfile number or range",
+                                         param_hint="'#'")
+            numbers.extend(range(first, last + 1))
+    return numbers
+
+
+@bak.command("del", help="Delete .bakfiles by number (see `bak list FILENAME`): "
+                         "`bak del FILE 3`, `bak del FILE 3-40 45`"
                          "\n\n\talias: `bak rm`")
 @click.option("--quietly", "-q",
               is_flag=True,
               default=False,
               help="Delete .bakfile without confirming")
 @click.argument("filename", required=True, type=click.Path(exists=False))
-@click.argument("number", metavar="#", required=False, type=int)
-def bak_del(filename, number, quietly):
+@click.argument("numbers", metavar="[#|#-#]...", nargs=-1)
+def bak_del(filename, numbers, quietly):
     filename = Path(filename).expanduser().resolve()
-    if not commands.bak_del_cmd(filename, number, quietly):
+    if not commands.bak_del_cmd(filename, __parse_numbers(numbers), quietly):
         # TODO this is just a copy of `bak off`, so...
         click.echo("Operation cancelled or failed.")
 
-@bak.command("rm", hidden=True, help="Delete a single .bakfile by number (see `bak list FILENAME`)"
+@bak.command("rm", hidden=True, help="Delete .bakfiles by number (see `bak list FILENAME`)"
                          "\n\n\talias of `bak del`")
 @click.option("--quietly", "-q",
               is_flag=True,
               default=False,
               help="Delete .bakfile without confirming")
 @click.argument("filename", required=True, type=click.Path(exists=False))
-@click.argument("number", metavar="#", required=False, type=int)
-def _bak_rm(filename, number, quietly):
-    bak_del(filename, number, quietly)
+@click.argument("numbers", metavar="[#|#-#]...", nargs=-1)
+def _bak_rm(filename, numbers, quietly):
+    filename = Path(filename).expanduser().resolve()
+    if not commands.bak_del_cmd(filename, __parse_numbers(numbers), quietly):
+        click.echo("Operation cancelled or failed.")
+
+@bak.command("prune",
+             help="Remove old .bakfiles by retention policy (the retention_* settings, "
+                  "or the options below). A file's newest .bakfile is always kept.",
+             short_help="Remove old .bakfiles by retention policy")
+@click.option("--dry-run", "-n", is_flag=True, default=False,
+              help="List what would be removed, and the space it would reclaim")
+@click.option("--quietly", "-q", is_flag=True, default=False,
+              help="Don't ask for confirmation")
+@click.option("--keep-last", type=click.IntRange(min=1), help="Keep each file's N newest")
+@click.option("--keep-hourly", type=click.IntRange(min=1),
+              help="Keep the newest of each of the last N hours with .bakfiles")
+@click.option("--keep-daily", type=click.IntRange(min=1), help="Likewise, for days")
+@click.option("--keep-weekly", type=click.IntRange(min=1), help="Likewise, for weeks")
+@click.option("--max-age", help="Remove .bakfiles older than this (e.g. 12h, 30d, 2w)")
+@click.option("--max-bytes-per-file",
+              help="Cap each file's .bakfiles at this many bytes (e.g. 500M), oldest go first")
+@click.option("--max-bytes", help="Cap the whole store (when no FILENAMES are given)")
+@click.argument("filenames", nargs=-1, type=click.Path())
+def bak_prune(filenames, dry_run, quietly, **policy):
+    filenames = [Path(filename).expanduser().resolve() for filename in filenames]
+    if not commands.bak_prune_cmd(filenames, dry_run, quietly, **policy):
+        click.echo("Operation cancelled or failed.")
+
+
+@bak.command("fsck",
+             help="Check that bak's database and its .bakfiles agree, and that every "
+                  ".bakfile still reads back to what was backed up. Exits with status 1 "
+                  "if problems remain.",
+             short_help="Verify (and repair) the .bakfile store")
+@click.option("--repair", is_flag=True, default=False,
+              help="Store lost or damaged .bakfiles again from unchanged originals, "
+                   "remove entries that can't be read back, and register or delete "
+                   ".bakfiles with no entry")
+@click.option("--quietly", "-q", is_flag=True, default=False,
+              help="Don't ask for confirmation")
+@click.option("--jobs", "-j", required=False, type=click.IntRange(min=1),
+              default=commands.FSCK_WORKERS, show_default=True,
+              help="Processes to re-hash .bakfiles with")
+def bak_fsck(repair, quietly, jobs):
+    if not commands.bak_fsck_cmd(repair, quietly, jobs):
+        click.get_current_context().exit(1)
+
+
+@bak.command("migrate",
+             help="Move existing .bakfiles into the configured layout (see "
+                  "'bak config layout'), in batches, while bak stays usable. "
+                  "Either layout can be read at any point.",
+             short_help="Move .bakfiles into a new on-disk layout")
+@click.option("--layout", type=click.Choice(["flat", "sharded"]),
+              help="Layout to move to, if not the configured one")
+@click.option("--batch-size", type=click.IntRange(min=1), default=commands.MIGRATE_BATCH_SIZE,
+              help="Bakfiles moved per database transaction")
+def bak_migrate(layout, batch_size):
+    if not commands.bak_migrate_cmd(layout, batch_size):
+        click.get_current_context().exit(1)
+
+
+@bak.command("watch",
+             help="Back files up whenever they change, until interrupted. Directories' "
+                  "files are watched too. Bursts of writes make one .bakfile, and files "
+                  "that haven't really changed are skipped.",
+             short_help="Back files up automatically as they change")
+@click.option("--recursive", "-r", is_flag=True, default=False,
+              help="Watch subdirectories of directories too")
+@click.option("--delay", type=click.FloatRange(min=0), default=commands.WATCH_DELAY,
+              show_default=True, help="Seconds a file must be left alone before it's backed up")
+@click.option("--poll", "poll_interval", type=click.FloatRange(min=0.1),
+              help="Check for changes every this many seconds, instead of using inotify")
+@click.option("--verbose", "-v", required=False, is_flag=True, help=VERBOSE_HELP)
+@click.option("--jobs", "-j", required=False, type=click.IntRange(min=1),
+              default=commands.BATCH_WORKERS, help=JOBS_HELP)
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+def bak_watch(paths, recursive, delay, poll_interval, verbose, jobs):
+    paths = list(dict.fromkeys(Path(path).expanduser().resolve() for path in paths))
+    commands.bak_watch_cmd(paths, recursive, delay, poll_interval, verbose, jobs)
+
 
 @bak.command("open", help="View or edit a .bakfile in an external program")
 @click.option("--using", "--in", "--with",
@@ -187,16 +383,18 @@ def bak_get(filename, bakfile_number=0):
 
 
 @bak.command("diff",
-             help="diff a file against its .bakfile")
+             help="diff a file against its .bakfile, or two of its .bakfiles against each other")
 @click.option("--using", "--with",
-              help="Program to use instead of system diff",
+              help="Program to use instead of system diff ('builtin' for bak's own)",
               required=False)
 @normalize_path()
 @click.argument("filename", required=True, type=click.Path(exists=True))
 @click.argument("bakfile_number", metavar="[#]", required=False, type=int)
-def bak_diff(filename, using, bakfile_number=0):
+@click.argument("other_number", metavar="[#]", required=False, type=int)
+def bak_diff(filename, using, bakfile_number=0, other_number=0):
     filename = Path(filename).expanduser().resolve()
-    commands.bak_diff_cmd(filename, command=using, bakfile_number=bakfile_number or 0)
+    commands.bak_diff_cmd(filename, command=using, bakfile_number=bakfile_number or 0,
+                          other_number=other_number or 0)
 
 
 @bak.command("list",
@@ -215,15 +413,48 @@ def bak_diff(filename, using, bakfile_number=0):
               required=False,
               is_flag=True,
               default=False)
+@click.option("--limit", "-n",
+              help="Show at most this many .bakfiles",
+              required=False,
+              type=click.IntRange(min=0),
+              default=None)
+@click.option("--offset",
+              help="Skip this many .bakfiles before listing",
+              required=False,
+              type=click.IntRange(min=0),
+              default=0)
+@click.option("--snapshots", "-s",
+              help="List directory snapshots (see 'bak -r') instead",
+              required=False,
+              is_flag=True,
+              default=False)
+@click.option("--format", "list_format",
+              help="Output format: a table, or json, ndjson, tsv or paths for scripts, "
+                   "streamed as they're read",
+              required=False,
+              type=click.Choice(commands.LIST_FORMATS),
+              default='table')
 @click.argument("filename",
                 required=False,
                 type=click.Path(exists=True))
-@normalize_path()
-def bak_list(colors, relpaths, compare, filename):
+@normalize_path(dirs_flag='snapshots')
+def bak_list(colors, relpaths, compare, limit, offset, snapshots, list_format, filename):
     if filename:
         filename = Path(filename).expanduser().resolve()
+    if snapshots:
+        if list_format != 'table':
+            click.echo("Error: --format only applies to lists of .bakfiles, not snapshots")
+            return
+        commands.show_snapshot_list(filename or None, colors=colors)
+        return
+    if list_format != 'table':
+        commands.print_bak_list(filename=filename or None, list_format=list_format,
+                                relative_paths=relpaths, compare=compare,
+                                limit=limit, offset=offset)
+        return
     commands.show_bak_list(filename=filename or None,
-                           relative_paths=relpaths, colors=colors, compare=compare)
+                           relative_paths=relpaths, colors=colors, compare=compare,
+                           limit=limit, offset=offset)
 
 
 TAB = '\t'
@@ -231,7 +462,7 @@ CFG_HELP_TEXT = '\b\nGet/set config values. Valid settings include:\n\n\t' + \
                f'\b\n{(TAB + cfg.newline).join(cfg.SETTABLE_VALUES)}' + \
                 '\b\n\nNOTE: diff-exec\'s value should be enclosed in quotes, and' \
                 '\nformatted like:\b\n\n\t\'diff %old %new\' \b\n\n(%old and %new will be substituted ' \
-                'with the bakfile and the original file, respectively)'
+                'with the bakfile and the original file, respectively.\nUse \'builtin\' for bak\'s own diff)'
 
 
 @bak.command("config",
@@ -1,40 +1,110 @@
 # region lots of imports
+import io
+import json
 import os
+import re
 import sqlite3
-from datetime import datetime
-from filecmp import cmp as compare_files
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-from shutil import copy2
+from shutil import copystat
 from subprocess import call
 from sys import stderr, stdout
+from time import perf_counter
 from typing import List, Optional, Union
 from warnings import warn
 
 import click
-from config import Config, KeyNotFoundError
-from rich import box
-from rich.color import Color
-from rich.console import Console
-from rich.style import Style
-from rich.table import Table
-from rich.text import Text
-
-from bak.configuration import bak_cfg as cfg
-from bak.data import bak_db, bakfile
+
+from bak import trace
+from bak.configuration import bak_cfg as cfg, translate_config_value
+from bak.data import bak_db, bak_delta, bak_diff, bak_fsck, bak_hash, bak_store, bak_watch, \
+    bakfile
+from bak.lazy import LazyImport
+
+# rich takes longer to import than the rest of bak put together, and most
+# commands (`bak FILE`, `bak where`) never draw a table
+box = LazyImport('rich.box')
+Console = LazyImport('rich.console', 'Console')
+Table = LazyImport('rich.table', 'Table')
+Text = LazyImport('rich.text', 'Text')
 # endregion
 
 
 # region constants etc.
-bak_dir = cfg['bakfile_location'] or cfg.data_dir / 'bak' / 'bakfiles'
-bak_db_loc = cfg['bak_database_location'] or cfg.data_dir / 'bak' / 'bak.db'
+bak_dir = cfg.bak_dir
+bak_db_loc = cfg.bak_db_loc
 
 BAK_LIST_RELPATHS = cfg['bak_list_relative_paths']
 BAK_LIST_COLORS = cfg['bak_list_colors']
 FASTMODE = cfg['fast_mode']
-if not bak_dir.exists():
-    bak_dir.mkdir(parents=True)
-
-db_handler = bak_db.BakDBHandler(bak_db_loc)
+BAK_LIST_PAGE_SIZE = 500
+# `bak list --format`: 'table' is for people; the rest are for scripts, and
+# have LIST_COLUMNS, in this order, whatever changes about the table
+LIST_FORMATS = ('table', 'json', 'ndjson', 'tsv', 'paths')
+LIST_COLUMNS = ('id', 'number', 'original', 'bakfile', 'created', 'modified', 'restored',
+                'oldest', 'newest', 'current', 'size', 'codec', 'content_hash',
+                'delta_base', 'snapshot')
+# Worker threads for copying in batch mode (`bak create a b c ...`)
+BATCH_WORKERS = min(8, os.cpu_count() or 1)
+# Threads unlinking bakfiles, when many go at once (`bak off DIR`, prune)
+UNLINK_WORKERS = 8
+UNLINK_PARALLEL_MIN = 64
+# Worker processes for re-hashing bakfiles in `bak fsck`
+FSCK_WORKERS = os.cpu_count() or 1
+DEDUP = cfg['dedup']
+try:
+    COMPRESSION = bak_store.normalize_codec(cfg['compression'])
+except KeyError as unknown_codec:
+    warn(f"Unknown compression codec {unknown_codec}; storing bakfiles uncompressed. "
+         f"Valid codecs: {', '.join(bak_store.CODECS)}")
+    COMPRESSION = None
+# Only means anything with a codec, and each takes its own range of levels
+COMPRESSION_LEVEL = cfg['compression_level'] if COMPRESSION else None
+if COMPRESSION_LEVEL in (None, ''):
+    COMPRESSION_LEVEL = None
+elif str(COMPRESSION_LEVEL).strip() in map(str, bak_store.CODEC_LEVELS[COMPRESSION]):
+    COMPRESSION_LEVEL = int(COMPRESSION_LEVEL)
+else:
+    levels = bak_store.CODEC_LEVELS[COMPRESSION]
+    warn(f"Invalid compression level {COMPRESSION_LEVEL} for {COMPRESSION}; using its default. "
+         f"Valid levels: {levels[0]}-{levels[-1]}")
+    COMPRESSION_LEVEL = None
+LAYOUT = cfg['bakfile_layout'] or 'sharded'
+if LAYOUT not in bak_store.LAYOUTS:
+    warn(f"Unknown bakfile layout {LAYOUT}; using 'sharded'. "
+         f"Valid layouts: {', '.join(bak_store.LAYOUTS)}")
+    LAYOUT = 'sharded'
+# `bak watch` backs a file up once it's been left alone this many seconds,
+# or, if it keeps changing, this many delays after its first change
+WATCH_DELAY = 2.0
+WATCH_MAX_DELAYS = 15
+# Bakfiles moved per transaction by `bak migrate`
+MIGRATE_BATCH_SIZE = 1000
+DELTA_CHAINS = cfg['delta_chains']
+DELTA_KEYFRAME_INTERVAL = int(cfg['delta_keyframe_interval'] or 10)
+# Larger files are always stored in full; line diffs of them get expensive
+DELTA_MAX_SIZE = 8 * 1024 * 1024
+# Keep a bakfile in full unless its delta is at most this fraction of its size
+DELTA_MAX_RATIO = 0.8
+# bak_diff_exec value that selects bak's own diff (see bak_diff.py)
+BUILTIN_DIFF = 'builtin'
+# Built-in diffs between two bakfiles are cached by content hashes, as long
+# as they're small; the least recently written go first
+DIFF_CACHE_DIRNAME = 'diff-cache'
+DIFF_CACHE_MAX_SIZE = 1024 * 1024
+DIFF_CACHE_MAX_ENTRIES = 256
+# Blank or null means the default, not the least safe mode
+DURABILITY = cfg['durability'] or 'group'
+if DURABILITY not in bak_store.DURABILITY_MODES:
+    warn(f"Unknown durability {DURABILITY}; using 'group'. "
+         f"Valid settings: {', '.join(bak_store.DURABILITY_MODES)}")
+    DURABILITY = 'group'
+# For bakfiles written one at a time; a group of one is no cheaper than that
+SINGLE_WRITES = bak_store.Durability('per-file' if DURABILITY == 'group' else DURABILITY)
+# Connects on first use
+db_handler = bak_db.BakDBHandler(bak_db_loc, durable=DURABILITY != 'none')
 # endregion
 
 
@@ -42,12 +112,18 @@ db_handler = bak_db.BakDBHandler(bak_db_loc)
 ############
 ############
 ############
+def __mangled_name(filename: Path):
+    """ The start of `filename`'s bakfiles' names: /a/b c/d -> a-b-c-d """
+    return ("-".join(i for i in filename.parent.parts[1:])
+            + '-' + filename.name).replace(" ", "-")
+
+
 def __assemble_bakfile(filename: Path):
     time_now = datetime.now()
     bakfile_name = "".join(
-        ["-".join(i for i in filename.parent.parts[1:])
-         + '-' + filename.name, ".", '-'.join(str(time_now.timestamp()).split('.')), ".bak"]).replace(" ", "-")
-    bakfile_path = bak_dir / bakfile_name
+        [__mangled_name(filename), ".", '-'.join(str(time_now.timestamp()).split('.')), ".bak"])
+    # Its directory is made when something's written there (not in dedup mode)
+    bakfile_path = bak_store.bakfile_path(bak_dir, bakfile_name, LAYOUT)
 
     new_bak_entry = bakfile.BakFile(filename.name,
                                     filename,
@@ -58,6 +134,409 @@ def __assemble_bakfile(filename: Path):
     return new_bak_entry
 
 
+def __hash_for_dedup(bak_entry: bakfile.BakFile, filename: Path):
+    """ The hashing half of __write_bakfile() in dedup mode """
+    stat = os.stat(filename)
+    # Taken before reading, so a change mid-copy can't be vouched for
+    bak_entry.source_stat = bak_store.settled_signature(stat)
+    bak_entry.content_hash = bak_store.hash_current_file(filename, stat)
+
+
+def __write_bakfile(bak_entry: bakfile.BakFile, filename: Path,
+                    durability: bak_store.Durability = SINGLE_WRITES, hashed: bool = False):
+    """ The file I/O half of __store_bakfile(). Doesn't touch the database,
+        so it's safe to run in worker threads. In dedup mode, an object that's
+        already on disk is left for __adopt_object() to finish; `hashed`
+        means __hash_for_dedup() has been run already. The copy is put in
+        place by `durability`, which for a group means later.
+    """
+    bak_entry.delta_base = None
+    with trace.phase('copy in'):
+        if DEDUP:
+            if not hashed:
+                __hash_for_dedup(bak_entry, filename)
+            obj = bak_store.object_path(bak_dir, bak_entry.content_hash)
+            if obj.exists():
+                bak_entry.bakfile_loc, bak_entry.size, bak_entry.codec = obj, None, None
+                return "deduplicated"
+            bak_entry.bakfile_loc, bak_entry.content_hash, bak_entry.size, bak_entry.codec, \
+                strategy = bak_store.store_object(bak_dir, filename, bak_entry.content_hash,
+                                                  COMPRESSION, COMPRESSION_LEVEL, durability)
+        else:
+            # Taken before reading, so a change mid-copy can't be vouched for
+            bak_entry.source_stat = bak_store.settled_signature(os.stat(filename))
+            bak_entry.content_hash, bak_entry.size, bak_entry.codec, strategy = \
+                bak_store.write_bakfile(filename, bak_entry.bakfile_loc,
+                                        COMPRESSION, COMPRESSION_LEVEL, durability)
+    trace.count('bytes backed up', bak_entry.size)
+    return strategy
+
+
+def __adopt_object(bak_entry: bakfile.BakFile, filename: Path):
+    """ An existing object's size and codec come from an entry that uses it.
+        Objects no entry refers to (say, left by a crash) are written again.
+    """
+    existing = db_handler.find_bakfile_entry(bak_entry.bakfile_loc)
+    if existing:
+        bak_entry.size, bak_entry.codec = existing.size, existing.codec
+        return "deduplicated"
+    bak_entry.bakfile_loc, bak_entry.content_hash, bak_entry.size, bak_entry.codec, \
+        strategy = bak_store.store_object(bak_dir, filename, bak_entry.content_hash,
+                                          COMPRESSION, COMPRESSION_LEVEL, SINGLE_WRITES)
+    return strategy
+
+
+def __store_bakfile(bak_entry: bakfile.BakFile, filename: Path):
+    """ Copies `filename` into the store and records where it landed in
+        `bak_entry`, along with its hash, size and codec. In dedup mode,
+        that's an existing object if the contents match one.
+
+    Returns:
+        str: how the data got there (see bak_copy.STRATEGIES), for verbose output
+    """
+    strategy = __write_bakfile(bak_entry, filename)
+    if strategy == "deduplicated":
+        strategy = __adopt_object(bak_entry, filename)
+    return strategy
+
+
+def __copy_if_changed(filename: Path, previous: Optional[bakfile.BakFile],
+                      paranoid: bool = False, durability: bak_store.Durability = SINGLE_WRITES,
+                      copy: bool = True):
+    """ Copies `filename` into the store, unless it's unchanged since
+        `previous`. Safe to run in worker threads: no database access here.
+        Without `copy` (dedup mode only), the new entry is only hashed, and
+        its strategy is None; see __copy_objects().
+
+    Returns:
+        (BakFile|None, str|None, tuple|None, str|None): the new, not yet
+            inserted entry (None if unchanged) and its copy strategy, plus
+            the (hash, size) of `previous` if it had to be hashed and the
+            file's stat signature if its contents had to be compared, for
+            the caller to record
+    """
+    learned_hash = None
+    if previous is not None:
+        stat = os.stat(filename)
+        if not paranoid and __unchanged_since(previous, stat):
+            trace.count('bytes skipped by stat signature', stat.st_size)
+            return None, None, None, None
+        if previous.size is None or previous.size == stat.st_size:
+            previous_hash = previous.content_hash
+            if previous_hash is None and previous.delta_base is None:
+                learned_hash = __hash_contents(previous)
+                previous_hash = learned_hash[0]
+            if previous_hash == bak_store.hash_current_file(filename, stat):
+                return None, None, learned_hash, bak_store.settled_signature(stat)
+    new_entry = __assemble_bakfile(filename)
+    if not copy:
+        with trace.phase('hash'):
+            __hash_for_dedup(new_entry, filename)
+        return new_entry, None, learned_hash, None
+    return new_entry, __write_bakfile(new_entry, filename, durability), learned_hash, None
+
+
+def __copy_in_parallel(plans, jobs: int, failed: list, paranoid: bool = False):
+    """ Runs __copy_if_changed() over (filename, previous entry) pairs in a
+        pool of `jobs` threads. Files that can't be read go in `failed`. The
+        copies are all on disk, as DURABILITY has it, by the time it returns.
+
+    Returns:
+        list: (filename, previous, new entry, strategy, learned hash,
+               learned signature) per file
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = []
+    writes = bak_store.Durability(DURABILITY, max(1, jobs))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            # In dedup mode, everything's hashed first, so that files with the
+            # same contents can be copied once between them
+            futures = [(filename, previous,
+                        pool.submit(__copy_if_changed, filename, previous, paranoid, writes,
+                                    not DEDUP))
+                       for filename, previous in plans]
+            for filename, previous, future in futures:
+                try:
+                    results.append((filename, previous, *future.result()))
+                except OSError as error:
+                    failed.append((filename, error.strerror or str(error)))
+            if DEDUP:
+                results = __copy_objects(pool, results, writes, failed)
+        with trace.phase('sync'):
+            writes.flush()
+    finally:
+        writes.discard()
+    return results
+
+
+def __copy_objects(pool, results: list, durability: bak_store.Durability, failed: list):
+    """ The copying half of a dedup batch, over __copy_in_parallel()'s hashed
+        results. Each distinct hash is written once, as one object, by the
+        first file that has it; the others are left to adopt that object in
+        __insert_copied_entry(), after the first one's entry is inserted.
+
+    Returns:
+        list: `results`, with strategies, less the files that failed
+    """
+    groups = {}
+    for i, (_, _, new_entry, *_) in enumerate(results):
+        if new_entry is not None:
+            groups.setdefault(new_entry.content_hash, []).append(i)
+    futures = [(group, pool.submit(__write_bakfile, results[group[0]][2], results[group[0]][0],
+                                   durability, True))
+               for group in groups.values()]
+    results, dropped = list(results), set()
+    for group, future in futures:
+        first = group[0]
+        filename, previous, new_entry, _, learned_hash, learned_stat = results[first]
+        try:
+            results[first] = (filename, previous, new_entry, future.result(),
+                              learned_hash, learned_stat)
+        except OSError as error:
+            failed.append((filename, error.strerror or str(error)))
+            dropped.add(first)
+        for i in group[1:]:
+            filename, previous, new_entry, _, learned_hash, learned_stat = results[i]
+            new_entry.bakfile_loc, new_entry.size, new_entry.codec = \
+                bak_store.object_path(bak_dir, new_entry.content_hash), None, None
+            results[i] = (filename, previous, new_entry, "deduplicated",
+                          learned_hash, learned_stat)
+    return [result for i, result in enumerate(results) if i not in dropped]
+
+
+def __insert_copied_entry(new_entry: bakfile.BakFile, filename: Path, strategy: str,
+                          verbose: bool, failed: list):
+    """ The database half of a batch copy, run in the caller's transaction """
+    if strategy == "deduplicated":
+        try:
+            strategy = __adopt_object(new_entry, filename)
+        except OSError as error:
+            failed.append((filename, error.strerror or str(error)))
+            return False
+    __report_copy(verbose, filename, new_entry.bakfile_loc, strategy)
+    db_handler.create_bakfile_entry(new_entry)
+    if DELTA_CHAINS:
+        __delta_compress_predecessor(new_entry)
+    return True
+
+
+def __report_copy(verbose: bool, src, dest, strategy: str):
+    if verbose:
+        click.echo(f"{src} -> {dest} ({strategy})", err=True)
+
+
+def __hash_contents(bak_entry: bakfile.BakFile):
+    """ (hash, size) of a bakfile's original contents. Raw full versions are
+        hashed in place, in parallel if they're large; the rest as streams.
+    """
+    if bak_entry.delta_base is None and bak_entry.codec is None:
+        return bak_hash.hash_file(bak_entry.bakfile_loc)
+    with __open_bakfile(bak_entry) as _file:
+        return bak_store.hash_stream(_file)
+
+
+def __bakfile_hash(bak_entry: bakfile.BakFile):
+    """ Stored hash of a bakfile's contents. Bakfiles from before bak
+        recorded hashes are hashed (once) on demand.
+    """
+    if not bak_entry.content_hash:
+        db_handler.set_content_hash(bak_entry, *__hash_contents(bak_entry))
+    return bak_entry.content_hash
+
+
+def __unchanged_since(bak_entry: bakfile.BakFile, stat: os.stat_result):
+    """ True if the original's stat signature is the one recorded when it
+        last held `bak_entry`'s contents, so they needn't be read to compare
+    """
+    return bak_entry.source_stat is not None and \
+        bak_entry.source_stat == bak_store.stat_signature(stat)
+
+
+def __matches_current_file(bak_entry: bakfile.BakFile, current_filename: Path,
+                           paranoid: bool = False):
+    """ True if `bak_entry` holds the current contents of `current_filename`.
+        Files whose stat signature hasn't changed since aren't read at all
+        (unless `paranoid`); otherwise stored hashes are compared, so no
+        bakfile is read more than once, and the signature is recorded for
+        next time.
+    """
+    try:
+        stat = os.stat(current_filename)
+    except FileNotFoundError:
+        return False
+    if not paranoid and __unchanged_since(bak_entry, stat):
+        trace.count('bytes skipped by stat signature', stat.st_size)
+        return True
+    if bak_entry.size is not None and bak_entry.size != stat.st_size:
+        return False
+    with trace.phase('compare'):
+        matches = __bakfile_hash(bak_entry) == bak_store.hash_current_file(current_filename, stat)
+    signature = bak_store.settled_signature(stat)
+    if matches and signature and bak_entry.rowid is not None and \
+            bak_entry.source_stat != signature:
+        db_handler.set_source_stat(bak_entry, signature)
+    return matches
+
+
+def __unlink_bakfile(bakfile_loc: Path):
+    try:
+        Path(bakfile_loc).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def __unlink_bakfiles(bakfile_locs):
+    """ Unlinks many bakfiles; in a pool of threads if there are enough of
+        them for the filesystem's latency to add up
+    """
+    bakfile_locs = list(bakfile_locs)
+    with trace.phase('unlink'):
+        if len(bakfile_locs) < UNLINK_PARALLEL_MIN:
+            for bakfile_loc in bakfile_locs:
+                __unlink_bakfile(bakfile_loc)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as pool:
+            list(pool.map(__unlink_bakfile, bakfile_locs))
+
+
+def __release_bakfile(bakfile_loc: Path):
+    """ Unlinks `bakfile_loc` once no entries refer to it anymore. Inside a
+        transaction, the unlink waits for the commit.
+    """
+    if db_handler.count_references(bakfile_loc):
+        return
+    db_handler.call_after_commit(lambda: __unlink_bakfile(bakfile_loc))
+
+
+# region reading bakfiles, reverse deltas
+def __read_lines(bak_entry: bakfile.BakFile):
+    """ Full contents of a bakfile as lines, rebuilt from reverse deltas if
+        need be. Chains are at most DELTA_KEYFRAME_INTERVAL long.
+    """
+    chain = []
+    while bak_entry.delta_base is not None:
+        chain.append(bak_entry)
+        bak_entry = db_handler.get_entry(bak_entry.delta_base)
+    with bak_store.open_bakfile(bak_entry.bakfile_loc, bak_entry.codec) as _file:
+        lines = _file.readlines()
+    for delta_entry in reversed(chain):
+        with bak_store.open_bakfile(delta_entry.bakfile_loc, delta_entry.codec) as _delta:
+            lines = bak_delta.apply_delta(lines, _delta)
+    return lines
+
+
+def __open_bakfile(bak_entry: bakfile.BakFile):
+    """ Binary stream of a bakfile's original contents, however it's stored.
+        Full versions are streamed; deltas are rebuilt in memory, which
+        DELTA_MAX_SIZE keeps small.
+    """
+    if bak_entry.delta_base is None:
+        return bak_store.open_bakfile(bak_entry.bakfile_loc, bak_entry.codec)
+    return io.BytesIO(b''.join(__read_lines(bak_entry)))
+
+
+def __restore_bakfile(bak_entry: bakfile.BakFile, destination: Path):
+    """ Returns the copy strategy used, for verbose output """
+    with trace.phase('copy out'):
+        if bak_entry.delta_base is None:
+            strategy = bak_store.restore_bakfile(bak_entry.bakfile_loc, bak_entry.codec,
+                                                 destination)
+        else:
+            with __open_bakfile(bak_entry) as _src:
+                bak_store.restore_stream(_src, bak_entry.bakfile_loc, destination)
+            strategy = "rebuilt from deltas"
+    if trace.active():
+        trace.count('bytes restored', os.stat(destination).st_size)
+    return strategy
+
+
+def __materialize(bak_entry: bakfile.BakFile):
+    """ Context manager yielding a plain file with the bakfile's contents,
+        for external programs
+    """
+    suffix = Path(bak_entry.original_file).suffix
+    if bak_entry.delta_base is None:
+        return bak_store.materialize(bak_entry.bakfile_loc, bak_entry.codec, suffix)
+    return bak_store.materialize_stream(__open_bakfile(bak_entry), suffix)
+
+
+def __delta_run_length(bak_entry: bakfile.BakFile):
+    """ How many older versions are chained, delta by delta, onto `bak_entry` """
+    run_length = 0
+    dependents = db_handler.get_delta_dependents(bak_entry)
+    while dependents:
+        run_length += 1
+        dependents = db_handler.get_delta_dependents(dependents[0])
+    return run_length
+
+
+def __delta_compress_predecessor(new_entry: bakfile.BakFile):
+    """ Once `new_entry` is stored in full, turns the version before it into
+        a reverse delta against it. Every DELTA_KEYFRAME_INTERVAL versions,
+        one is left in full so rebuilding an old version stays cheap.
+    """
+    entries = db_handler.get_bakfile_entries(new_entry.orig_abspath) or []
+    older = [entry for entry in entries if entry.rowid != new_entry.rowid]
+    if not older:
+        return
+    previous = older[-1]
+    if any((previous.delta_base is not None,
+            bak_store.is_object(bak_dir, previous.bakfile_loc),
+            previous.size is None or previous.size > DELTA_MAX_SIZE,
+            new_entry.size is None or new_entry.size > DELTA_MAX_SIZE)):
+        return
+    if db_handler.count_references(previous.bakfile_loc) > 1 or \
+            __delta_run_length(previous) + 1 >= DELTA_KEYFRAME_INTERVAL:
+        return
+    previous_lines = __read_lines(previous)
+    if not bak_delta.is_text(b''.join(previous_lines[:100])):
+        return
+    delta = bak_delta.make_delta(__read_lines(new_entry), previous_lines)
+    if len(delta) > previous.size * DELTA_MAX_RATIO:
+        return
+
+    old_loc = previous.bakfile_loc
+    previous.bakfile_loc = Path(f"{old_loc}{bak_store.DELTA_SUFFIX}")
+    _, _, previous.codec = bak_store.store_stream(io.BytesIO(delta), previous.bakfile_loc,
+                                                  COMPRESSION, COMPRESSION_LEVEL, SINGLE_WRITES)
+    copystat(old_loc, previous.bakfile_loc)
+    previous.delta_base = new_entry.rowid
+    db_handler.set_storage(previous)
+    __release_bakfile(old_loc)
+
+
+def __undelta(bak_entry: bakfile.BakFile):
+    """ Stores a delta-compressed bakfile in full again """
+    old_loc = Path(bak_entry.bakfile_loc)
+    data = b''.join(__read_lines(bak_entry))
+    # Back under the name it had before it became a delta, which carries its
+    # creation time; that name was released then, and nothing else took it
+    if old_loc.name.endswith(bak_store.DELTA_SUFFIX):
+        bak_entry.bakfile_loc = old_loc.with_name(old_loc.name[:-len(bak_store.DELTA_SUFFIX)])
+    _, _, bak_entry.codec = bak_store.store_stream(io.BytesIO(data), bak_entry.bakfile_loc,
+                                                   COMPRESSION, COMPRESSION_LEVEL, SINGLE_WRITES)
+    copystat(old_loc, bak_entry.bakfile_loc)
+    bak_entry.delta_base = None
+    db_handler.set_storage(bak_entry)
+    __release_bakfile(old_loc)
+
+
+def __detach_delta_dependents(entries, leaving_ids=()):
+    """ Before `entries` are deleted or overwritten, stores any versions
+        that are deltas against them in full. Entries in `leaving_ids`
+        are about to go too, and are skipped.
+    """
+    for entry in entries:
+        for dependent in db_handler.get_delta_dependents(entry):
+            if dependent.rowid not in leaving_ids:
+                __undelta(dependent)
+# endregion
+
+
 default_select_prompt = ("Enter a number, or: (V)iew (D)iff (C)ancel", 'C')
 
 
@@ -137,16 +616,24 @@ def __do_select_bakfile(bakfiles: List[bakfile.BakFile],
 
 
 def __remove_bakfiles(entries_to_remove):
-    for entry in entries_to_remove:
-        Path(entry.bakfile_loc).unlink()
-        db_handler.del_bakfile_entry(entry)
+    """ Deletes entries in one statement (per few hundred), then unlinks the
+        bakfiles nothing refers to anymore, in one go, once that's committed
+    """
+    with db_handler.transaction():
+        __detach_delta_dependents(entries_to_remove,
+                                  {entry.rowid for entry in entries_to_remove})
+        db_handler.del_bakfile_entries(entries_to_remove)
+        orphans = db_handler.unreferenced_bakfiles(entry.bakfile_loc for entry in entries_to_remove)
+        db_handler.call_after_commit(lambda: __unlink_bakfiles(orphans))
+        if any(entry.snapshot is not None for entry in entries_to_remove):
+            db_handler.del_empty_snapshots()
 
 
 def __keep_bakfiles(bakfile_entry, bakfile_entries, new_destination, bakfile_numbers_to_keep):
     if not new_destination:
         for entry in bakfile_entries:
             if all((entry.restored,
-                    entry.bakfile_loc != bakfile_entry.bakfile_loc)):
+                    entry.rowid != bakfile_entry.rowid)):
                 db_handler.set_restored_flag(entry, False)
         db_handler.set_restored_flag(bakfile_entry, True)
     keep_all = not bakfile_numbers_to_keep
@@ -159,34 +646,19 @@ def __keep_bakfiles(bakfile_entry, bakfile_entries, new_destination, bakfile_num
 
 
 def __identify_baks(entries):
-    oldest_version: bakfile.BakFile
-    oldest_date = datetime.now()
-    newest_version: bakfile.BakFile
-    newest_date = datetime(1970, 1, 1, 1, 1)
-    for entry in entries:
-        timestamp = datetime.fromisoformat(entry.date_modified)
-        if timestamp < oldest_date:
-            oldest_version = entry
-            oldest_date = timestamp
-        if timestamp > newest_date:
-            newest_version = entry
-            newest_date = timestamp
+    """ (oldest, newest) of `entries`, by modification date. Each entry
+        parses its date once, however often it's asked.
+    """
+    oldest_version = min(entries, key=lambda entry: entry.modified_at)
+    newest_version = max(entries, key=lambda entry: entry.modified_at)
     return (oldest_version, newest_version)
 
 
-def __distinguish_baks(bakfiles):
-    filenames = set(_bakfile.orig_abspath for _bakfile in bakfiles)
-    _identified_baks = {}
-    for _filename in filenames:
-        _identified_baks[_filename] = __identify_baks(
-            [_bakfile for _bakfile in bakfiles if _bakfile.orig_abspath == _filename])
-    return _identified_baks
-
-
-bold_style = Style(bold=True, italic=True)
-purple_style = Style(bold=True, italic=True, color="purple")
-blue_style = Style(color="blue")
-none_style = Style()
+# Style strings, rather than rich Styles, so rich isn't imported up front
+bold_style = "bold italic"
+purple_style = "bold italic purple"
+blue_style = "blue"
+none_style = "none"
 
 
 def __generate_caption(colors, compare):
@@ -219,22 +691,21 @@ def __prep_list_row(_bakfile,
                     filename_exists,
                     relative_paths,
                     current_filename,
-                    _identified_baks,
+                    is_oldest,
+                    is_newest,
                     i):
     # Apply identifying markers to indices
-    if Path(current_filename).exists() and compare:
+    if compare:
         current_version_marker = \
-            Text("$ ") if compare_files(
-                _bakfile.bakfile_loc, current_filename) else None
+            Text("$ ") if __matches_current_file(_bakfile, current_filename) else None
     else:
         current_version_marker = None
 
     restored_marker = \
         Text('** ') if _bakfile.restored else None
 
-    _id_baks = _identified_baks[_bakfile.orig_abspath]
-    marker = ('-- ' if _bakfile is _id_baks[0]
-              else ('++ ' if _bakfile is _id_baks[1]
+    marker = ('-- ' if is_oldest
+              else ('++ ' if is_newest
                     else ""))
     marker = Text(marker) if marker else Text()
 
@@ -280,12 +751,19 @@ def show_bak_list(filename: Optional[Path] = None,
                   relative_paths: bool = BAK_LIST_RELPATHS,
                   err=False,
                   colors: bool = BAK_LIST_COLORS,
-                  compare: bool = False):
+                  compare: bool = False,
+                  limit: Optional[int] = None,
+                  offset: int = 0):
     """ Prints list of .bakfiles with metadata
 
     Arguments:
         filename (str|os.path, optional):
         List only `filename`'s .bakfiles
+        limit (int, optional): print at most this many .bakfiles
+        offset (int): skip this many .bakfiles first
+
+    Rows stream off one cursor and are rendered BAK_LIST_PAGE_SIZE at a
+    time, so a large store never becomes one giant Table (or list).
     """
 
     def _rotate_style(bold: bool):
@@ -293,66 +771,215 @@ def show_bak_list(filename: Optional[Path] = None,
             return bold_style if bold else none_style
         return purple_style if bold else blue_style
 
-    # Get bakfiles
-    bakfiles: List[bakfile.BakFile]
-    bakfiles = db_handler.get_bakfile_entries(filename) if filename else \
-        db_handler.get_all_entries()
+    def _new_table(first_page: bool, last_page: bool):
+        table = Table(title=(f".bakfiles of {filename}" if
+                             filename else ".bakfiles") if first_page else None,
+                      show_header=first_page,
+                      show_lines=True,
+                      box=box.HEAVY_EDGE,
+                      caption=__generate_caption(colors, compare) if last_page else None)
+        table.add_column("", justify='right', style=None)
+        table.add_column("Original File")
+        table.add_column("Date Created")
+        table.add_column("Last Modified")
+        return table
+
+    entries = islice(db_handler.iter_list_entries(filename),
+                     offset, None if limit is None else offset + limit)
+
+    def _get_page():
+        return list(islice(entries, BAK_LIST_PAGE_SIZE))
 
     console = Console(file=stderr if err else stdout)
-    if not bakfiles:
+    page = _get_page()
+    if not page:
         console.print(f"No .bakfiles found for "
                       f"{filename}" if
                       filename else "No .bakfiles found")
         return
 
-    # Set up table
-    table = Table(title=(f".bakfiles of {filename}" if
-                         filename else ".bakfiles"),
+    # Distinguish .bakfiles from different original files
+    i = offset + 1
+    current_filename = page[0][0].orig_abspath
+    current_style = blue_style if colors else none_style
+    bold = False  # First line will be opposite, toggled between population and rendering of table row
+    first_page = True
+
+    while page:
+        next_page = _get_page()
+        table = _new_table(first_page, not next_page)
+        # Begin individual row prep and add
+        for _bakfile, is_oldest, is_newest in page:
+            # Alternate styles on every other filename
+            if current_filename != _bakfile.orig_abspath:
+                current_filename = _bakfile.orig_abspath
+                bold = not bold
+                current_style = _rotate_style(bold)
+
+            table.add_row(*__prep_list_row(_bakfile,  # the current row's bakfile
+                                           compare,  # options
+                                           colors,
+                                           current_style,
+                                           filename is not None,
+                                           relative_paths,  # end options
+                                           current_filename,  # orig_abspath
+                                           is_oldest,  # oldest/newest
+                                           is_newest,
+                                           i  # current row index
+                                           ))
+            i += 1
+        # End table prep
+        with trace.phase('render'):
+            console.print(table)
+        page, first_page = next_page, False
+
+
+def show_snapshot_list(root: Optional[Path] = None,
+                       err=False,
+                       colors: bool = BAK_LIST_COLORS):
+    """ Prints the directory snapshots (`bak -r`) of `root`, or of every
+        directory. Snapshots are numbered per directory, oldest first, as
+        `bak down -r` expects.
+    """
+    console = Console(file=stderr if err else stdout)
+    snapshots = db_handler.get_snapshots(root)
+    if not snapshots:
+        console.print(f"No snapshots found for {root}" if root else "No snapshots found")
+        return
+    table = Table(title=f"Snapshots of {root}" if root else "Snapshots",
                   show_lines=True,
-                  box=box.HEAVY_EDGE,
-                  caption=__generate_caption(colors, compare))
+                  box=box.HEAVY_EDGE)
     table.add_column("", justify='right', style=None)
-    table.add_column("Original File")
+    table.add_column("Directory")
     table.add_column("Date Created")
-    table.add_column("Last Modified")
+    table.add_column("Files", justify='right')
+    current_root, i, bold = None, 0, True
+    for _, snapshot_root, date_created, file_count in snapshots:
+        if snapshot_root != current_root:
+            current_root, i, bold = snapshot_root, 0, not bold
+        i += 1
+        style = (purple_style if bold else blue_style) if colors else \
+            (bold_style if bold else none_style)
+        table.add_row(Text(str(i), style="bold"),
+                      Text(snapshot_root, style=style),
+                      Text(str(date_created).split('.')[0], style=style),
+                      Text(str(file_count), style=style))
+    with trace.phase('render'):
+        console.print(table)
+
+
+# region machine-readable `bak list`
+def __list_time(value: (str, datetime, None)) -> (str, None):
+    """ A stored date as the list formats have it, 'YYYY-MM-DD HH:MM:SS.ffffff';
+        str(datetime), which it was stored as, leaves off a zero .ffffff
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.isoformat(sep=' ', timespec='microseconds')
 
-    # Distinguish .bakfiles from different original files
-    i = 1
-    current_filename = bakfiles[0].orig_abspath
-    current_style = blue_style if colors else none_style
-    bold = False  # First line will be opposite, toggled between population and rendering of table row
 
-    # Begin individual row prep and add
-    for _bakfile in bakfiles:
-        _id_baks = __distinguish_baks(bakfiles)
-        # Alternate styles on every other filename
-        if current_filename != _bakfile.orig_abspath:
-            current_filename = _bakfile.orig_abspath
-            bold = not bold
-            current_style = _rotate_style(bold)
-
-        table.add_row(*__prep_list_row(_bakfile,  # the current row's bakfile
-                                       compare,  # options
-                                       colors,
-                                       current_style,
-                                       filename is not None,
-                                       relative_paths,  # end options
-                                       current_filename,  # orig_abspath
-                                       _id_baks,  # oldest/newest/restored
-                                       i  # current row index
-                                       ))
-        i += 1
-    # End table prep
-    console.print(table)
+def __list_records(filename: Optional[Path], relative_paths: bool):
+    """ `bak list`'s entries as (original abspath, stat signature, {column: value}),
+        streamed from the cursor (see BakDBHandler.iter_list_rows())
+    """
+    original, shown, number = None, None, 0
+    for (_, abspath, loc, created, modified, restored, rowid, content_hash, size, codec,
+         delta_base, snapshot, source_stat), oldest, newest in db_handler.iter_list_rows(filename):
+        if abspath != original:
+            original, number = abspath, 0
+            shown = os.path.relpath(original) if relative_paths else original
+        number += 1
+        yield original, source_stat, {'id': rowid, 'number': number, 'original': shown, 'bakfile': loc,
+                         'created': __list_time(created), 'modified': __list_time(modified),
+                         'restored': bool(restored),
+                         'oldest': oldest, 'newest': newest, 'current': None,
+                         'size': size, 'codec': codec, 'content_hash': content_hash,
+                         'delta_base': delta_base, 'snapshot': snapshot}
+
+
+def __mark_current(original: str, source_stat: (str, None), record: dict):
+    """ Fills in `current` (and, if it had to be worked out, `content_hash`) """
+    entry = bakfile.BakFile(Path(original).name, original, record['bakfile'],
+                            record['created'], record['modified'], record['restored'],
+                            record['id'], record['content_hash'], record['size'],
+                            record['codec'], record['delta_base'], record['snapshot'],
+                            source_stat)
+    record['current'] = __matches_current_file(entry, Path(original))
+    record['content_hash'] = entry.content_hash
+
+
+def __tsv_field(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def print_bak_list(filename: Optional[Path] = None,
+                   list_format: str = 'json',
+                   relative_paths: bool = BAK_LIST_RELPATHS,
+                   compare: bool = False,
+                   limit: Optional[int] = None,
+                   offset: int = 0,
+                   out=None):
+    """ `bak list --format json|ndjson|tsv|paths`: the same entries as
+        show_bak_list(), in the same order, written as they're read.
+
+        json is one array of objects and ndjson one object per line, keyed
+        by LIST_COLUMNS. tsv is a header line of LIST_COLUMNS, then one line
+        per entry: null is empty, booleans are true/false, and backslashes,
+        tabs and newlines are escaped as \\\\, \\t and \\n. paths is just the
+        bakfiles' paths, one per line.
+
+        Columns: `number` is the entry's number among its file's .bakfiles,
+        as `bak down FILE NUMBER` takes it; `created` and `modified` are
+        local times, 'YYYY-MM-DD HH:MM:SS.ffffff'; `current` is only known
+        (true/false) with `compare`; `size` and `content_hash` describe the
+        original contents and may be null for old entries.
+    """
+    out = out or stdout
+    records = islice(__list_records(filename, relative_paths),
+                     offset, None if limit is None else offset + limit)
+    try:
+        if list_format == 'json':
+            out.write('[')
+        elif list_format == 'tsv':
+            out.write('\t'.join(LIST_COLUMNS) + '\n')
+        for i, (original, source_stat, record) in enumerate(records):
+            if compare:
+                __mark_current(original, source_stat, record)
+            if list_format == 'json':
+                out.write((',\n' if i else '\n') + json.dumps(record))
+            elif list_format == 'ndjson':
+                out.write(json.dumps(record) + '\n')
+            elif list_format == 'tsv':
+                out.write('\t'.join(__tsv_field(record[column]) for column in LIST_COLUMNS)
+                          + '\n')
+            else:
+                out.write(record['bakfile'] + '\n')
+        if list_format == 'json':
+            out.write('\n]\n')
+        out.flush()
+    except BrokenPipeError:
+        # The reader went away (`| head`); don't complain about it on the way out
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+# endregion
 
 
-def create_bakfile(filename: Path):
+def create_bakfile(filename: Path, verbose: bool = False, paranoid: bool = False):
     """ Default command. Roughly equivalent to
             cp filename $XDG_DATA_DIR/.bakfiles/filename.bak
         but inserts relevant metadata into the database.
 
     Arguments:
         filename: (str|os.path)
+        verbose: (bool) report how the file was copied
+        paranoid: (bool) compare contents even if the file's stat signature
+                  says it hasn't changed
     """
     if not filename.exists():
         # TODO descriptive failure
@@ -360,20 +987,139 @@ def create_bakfile(filename: Path):
     current_entries = db_handler.get_bakfile_entries(
         filename.expanduser().resolve())
     if current_entries:
-        if compare_files(__identify_baks(current_entries)[1].bakfile_loc, filename.expanduser().resolve()):
+        if __matches_current_file(__identify_baks(current_entries)[1],
+                                  filename.expanduser().resolve(), paranoid):
             if not click.confirm("No changes to file since last bak. Would you like to create a duplicate .bakfile?"):
                 click.echo("Cancelled.")
                 return
     new_bakfile = __assemble_bakfile(filename)
-    copy2(new_bakfile.orig_abspath, new_bakfile.bakfile_loc)
-    db_handler.create_bakfile_entry(new_bakfile)
-
-
-def bak_up_cmd(filename: Path, bakfile_number: int=0):
-    """ Overwrite an existing .bakfile with the file's current contents
+    strategy = __store_bakfile(new_bakfile, new_bakfile.orig_abspath)
+    __report_copy(verbose, new_bakfile.orig_abspath, new_bakfile.bakfile_loc, strategy)
+    with db_handler.transaction():
+        db_handler.create_bakfile_entry(new_bakfile)
+        if DELTA_CHAINS:
+            __delta_compress_predecessor(new_bakfile)
+
+
+def create_bakfiles(filenames: List[Path], verbose: bool = False, jobs: int = BATCH_WORKERS,
+                    paranoid: bool = False):
+    """ create_bakfile() for many files at once. Never prompts: files that
+        haven't changed since their newest .bakfile are skipped. Copies run in
+        a pool of `jobs` threads, and the new entries are inserted in a single
+        transaction once they're done.
+
+    Returns:
+        (int, int, list): how many files were backed up and skipped, and
+                          (filename, reason) for each failure
+    """
+    failed = []
+    plans = []
+    for filename in dict.fromkeys(filenames):
+        if filename.is_dir():
+            failed.append((filename, "a directory; use bak -r"))
+        elif not filename.exists():
+            failed.append((filename, "No such file"))
+        else:
+            entries = db_handler.get_bakfile_entries(filename)
+            plans.append((filename, __identify_baks(entries)[1] if entries else None))
+
+    results = __copy_in_parallel(plans, jobs, failed, paranoid)
+
+    backed_up = skipped = 0
+    with db_handler.transaction():
+        for filename, newest, new_entry, strategy, learned_hash, learned_stat in results:
+            if learned_hash:
+                db_handler.set_content_hash(newest, *learned_hash)
+            if learned_stat:
+                db_handler.set_source_stat(newest, learned_stat)
+            if new_entry is None:
+                skipped += 1
+                continue
+            if __insert_copied_entry(new_entry, filename, strategy, verbose, failed):
+                backed_up += 1
+    return backed_up, skipped, failed
+
+
+def __walk_files(root: Path):
+    """ Regular files under `root`, found with os.scandir. Symlinks aren't
+        followed, and bak's own directory is never descended into.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        if Path(dir_entry.path) != bak_dir:
+                            stack.append(dir_entry.path)
+                    elif dir_entry.is_file(follow_symlinks=False):
+                        yield Path(dir_entry.path)
+        except OSError as error:
+            warn(f"Skipping {directory}: {error.strerror or error}")
+
+
+def create_snapshot(root: Path, verbose: bool = False, jobs: int = BATCH_WORKERS,
+                    paranoid: bool = False):
+    """ `bak -r DIR`: backs up every file under `root` as one snapshot.
+        Files unchanged since the directory's previous snapshot aren't
+        copied again; the new snapshot shares their .bakfiles.
+
+    Returns:
+        (int, int, list): how many files were copied and shared, and
+                          (filename, reason) for each failure
+    """
+    previous_snapshots = db_handler.get_snapshots(root)
+    previous_entries = {}
+    if previous_snapshots:
+        previous_entries = {str(entry.orig_abspath): entry for entry in
+                            db_handler.get_snapshot_entries(previous_snapshots[-1][0])}
+
+    plans = []
+    for filename in __walk_files(root):
+        previous = previous_entries.get(str(filename))
+        if previous is None:
+            entries = db_handler.get_bakfile_entries(filename)
+            previous = __identify_baks(entries)[1] if entries else None
+        # Deltas can't be shared; their contents depend on another entry
+        plans.append((filename, previous if previous and previous.delta_base is None else None))
+
+    failed = []
+    results = __copy_in_parallel(plans, jobs, failed, paranoid)
+
+    copied = shared = 0
+    time_now = datetime.now()
+    with db_handler.transaction():
+        snapshot_id = db_handler.create_snapshot(root, time_now)
+        for filename, previous, new_entry, strategy, learned_hash, learned_stat in results:
+            if learned_hash:
+                db_handler.set_content_hash(previous, *learned_hash)
+            if new_entry is None:
+                db_handler.create_bakfile_entry(
+                    bakfile.BakFile(filename.name, filename, previous.bakfile_loc,
+                                    time_now, time_now, restored=False,
+                                    content_hash=previous.content_hash, size=previous.size,
+                                    codec=previous.codec, snapshot=snapshot_id,
+                                    source_stat=learned_stat or previous.source_stat))
+                shared += 1
+                continue
+            new_entry.snapshot = snapshot_id
+            if __insert_copied_entry(new_entry, filename, strategy, verbose, failed):
+                copied += 1
+        if not copied + shared:
+            db_handler.del_empty_snapshots()
+    return copied, shared, failed
+
+
+def bak_up_cmd(filename: Path, bakfile_number: int=0, verbose: bool = False,
+               paranoid: bool = False):
+    """ Overwrite an existing .bakfile with the file's current contents.
+        Does nothing if it already has them.
 
     Args:
         filename (str|os.path)
+        paranoid (bool): compare contents even if the file's stat signature
+                         says it hasn't changed
     """
     # Return Truthy things for failures that echo their own output,
     # false for nonspecific or generic failures.
@@ -386,7 +1132,7 @@ def bak_up_cmd(filename: Path, bakfile_number: int=0):
     if old_bakfile is None:
         console.print(f"No bakfile found for {filename}")
         console.print(f"Creating {filename}.bak")
-        return create_bakfile(filename)
+        return create_bakfile(filename, verbose, paranoid)
 
     # Disambiguate
     if len(old_bakfile) == 1:
@@ -406,21 +1152,39 @@ def bak_up_cmd(filename: Path, bakfile_number: int=0):
     elif not isinstance(old_bakfile, bakfile.BakFile):
         return False
 
-    copy2(old_bakfile.original_file, old_bakfile.bakfile_loc)
-    old_bakfile.date_modified = datetime.now()
-    db_handler.update_bakfile_entry(old_bakfile)
+    if __matches_current_file(old_bakfile, filename, paranoid):
+        console.print(f"No changes to {filename} since its .bakfile was made.")
+        return True
+
+    old_bakfile_loc = old_bakfile.bakfile_loc
+    with db_handler.transaction():
+        # Older versions may be deltas against the contents we're replacing
+        __detach_delta_dependents([old_bakfile])
+        if DEDUP or bak_store.is_object(bak_dir, old_bakfile_loc) or \
+                old_bakfile.delta_base is not None or \
+                db_handler.count_references(old_bakfile_loc) > 1:
+            # Shared bakfiles (and deltas) can't be overwritten in place
+            old_bakfile.bakfile_loc = __assemble_bakfile(filename).bakfile_loc
+        strategy = __store_bakfile(old_bakfile, old_bakfile.orig_abspath)
+        __report_copy(verbose, old_bakfile.orig_abspath, old_bakfile.bakfile_loc, strategy)
+        old_bakfile.date_modified = datetime.now()
+        db_handler.update_bakfile_entry(old_bakfile)
+        if str(old_bakfile_loc) != str(old_bakfile.bakfile_loc):
+            __release_bakfile(old_bakfile_loc)
     return True
 
-def _sudo_bak_down_helper(src, dest):
+def _sudo_bak_down_helper(bak_entry: bakfile.BakFile, dest):
     # TODO spin this off into a separate exec for sanity
     click.echo(f"The destination {dest} is privileged. Falling back on 'sudo cp'")
-    call(f"sudo cp {src} {dest}".split(" "))
+    with __materialize(bak_entry) as src:
+        call(["sudo", "cp", str(src), str(dest)])
 
 def bak_down_cmd(filename: Path,
                  destination: Optional[Path],
                  keep_bakfile: Union[bool, List[int]] = None,
                  quiet: bool = False,
-                 bakfile_number: int = 0):
+                 bakfile_number: int = 0,
+                 verbose: bool = False):
     """ Restore `filename` from .bakfile. Prompts if ambiguous (such as
         when there are multiple .bakfiles of `filename`)
 
@@ -429,6 +1193,7 @@ def bak_down_cmd(filename: Path,
         keep_bakfile (bool): If False, .bakfile is deleted (default: False)
         quiet (bool): If True, does not ask user to confirm
         destination (None|Path): destination path to restore to
+        verbose (bool): report how the file was copied
     """
     bakfile_entry = None
     bakfile_entries = []
@@ -461,6 +1226,16 @@ def bak_down_cmd(filename: Path,
     else:
         destination = Path(bakfile_entry.orig_abspath)
 
+    baks_to_keep = []
+    if isinstance(keep_bakfile, list):
+        try:
+            baks_to_keep = sorted(set(int(i) for i in keep_bakfile))
+        except ValueError:
+            if set(keep_bakfile) != {'all'}:
+                click.echo("Error: bak down --keep only accepts bakfile #s or the word 'all'")
+                click.echo("Cancelled.")
+                return
+
     confirm = True if quiet else _bak_down_confirm_helper(filename,
                                                           bakfile_number,
                                                           bakfile_entries,
@@ -472,35 +1247,79 @@ def bak_down_cmd(filename: Path,
         console.print("Cancelled.")
         return
 
-    try:
-        copy2(bakfile_entry.bakfile_loc, destination)
-    except PermissionError:
-        _sudo_bak_down_helper(bakfile_entry.bakfile_loc, destination)
+    # Restoring, flagging and removing bakfiles commit together, or not at all
+    with db_handler.transaction():
+        try:
+            strategy = __restore_bakfile(bakfile_entry, destination)
+            __report_copy(verbose, bakfile_entry.bakfile_loc, destination, strategy)
+        except PermissionError:
+            _sudo_bak_down_helper(bakfile_entry, destination)
+
+        if not keep_bakfile and not new_destination:
+            for entry in bakfile_entries:
+                if entry.restored:
+                    if entry.rowid != bakfile_entry.rowid:
+                        db_handler.set_restored_flag(entry, False)
+            db_handler.set_restored_flag(bakfile_entry, True)
+
+        args = [bakfile_entries] if not keep_bakfile else [bakfile_entry,
+                                                           bakfile_entries,
+                                                           new_destination,
+                                                           baks_to_keep]
+        helper = __keep_bakfiles if keep_bakfile else __remove_bakfiles
+        helper(*args)
+
+def bak_down_snapshot_cmd(root: Path,
+                          destination: Optional[Path],
+                          keep_snapshots: bool = False,
+                          quiet: bool = False,
+                          snapshot_number: int = 0,
+                          verbose: bool = False):
+    """ `bak down -r DIR`: restores every file in one of DIR's snapshots
+        (the newest, by default). Without --keep, all of DIR's snapshots
+        are deleted afterwards.
 
-    if not keep_bakfile and not new_destination:
-        for entry in bakfile_entries:
-            if entry.restored:
-                if entry.bakfile_loc != bakfile_entry.bakfile_loc:
-                    db_handler.set_restored_flag(entry, False)
-        db_handler.set_restored_flag(bakfile_entry, True)
+    Args:
+        destination (None|Path): directory to restore into instead of `root`
+    """
+    console = Console()
+    snapshots = db_handler.get_snapshots(root)
+    if not snapshots:
+        console.print(f"No snapshots found for {root}")
+        return
+    if snapshot_number and snapshot_number not in range(1, len(snapshots) + 1):
+        console.print(f"No such snapshot: {root} #{snapshot_number}")
+        return
+    snapshot_number = snapshot_number or len(snapshots)
+    entries = db_handler.get_snapshot_entries(snapshots[snapshot_number - 1][0])
+    new_destination = destination is not None and destination != root
+    destination = destination or root
+
+    if not quiet:
+        confirm_prompt = f"Confirm: Restore {len(entries)} files in {root} " \
+                         f"from snapshot #{snapshot_number}"
+        confirm_prompt += f" to {destination}" if new_destination else ""
+        confirm_prompt += " and keep its snapshots?" if keep_snapshots else \
+            f" and erase all {len(snapshots)} of its snapshots?"
+        if not click.confirm(confirm_prompt, default=False):
+            console.print("Cancelled.")
+            return
 
-    baks_to_keep = []
-    if isinstance(keep_bakfile, list):
-        keep_bakfile = sorted(set(keep_bakfile))
-        try:
-            baks_to_keep = [int(i) for i in keep_bakfile]
-        except ValueError:
-            if keep_bakfile != ['all']:
-                click.echo("Error: bak down --keep only accepts bakfile #s or the word 'all'")
-                click.echo("Cancelled.")
-                return
+    with db_handler.transaction():
+        for entry in entries:
+            dest = destination / os.path.relpath(entry.orig_abspath, root)
+            try:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                strategy = __restore_bakfile(entry, dest)
+                __report_copy(verbose, entry.bakfile_loc, dest, strategy)
+            except PermissionError:
+                _sudo_bak_down_helper(entry, dest)
+            if not new_destination:
+                db_handler.set_restored_flag(entry, True)
+        if not keep_snapshots:
+            __remove_bakfiles([entry for snapshot in snapshots
+                               for entry in db_handler.get_snapshot_entries(snapshot[0])])
 
-    args = [bakfile_entries] if not keep_bakfile else [bakfile_entry,
-                                                       bakfile_entries,
-                                                       new_destination,
-                                                       baks_to_keep]
-    helper = __keep_bakfiles if keep_bakfile else __remove_bakfiles
-    helper(*args)
 
 def _bak_down_confirm_helper(filename,
                              bakfile_number,
@@ -551,8 +1370,20 @@ def _bak_down_confirm_helper(filename,
 
     return click.confirm(confirm_prompt, default=False)
 
-def bak_del_cmd(filename:Path, bakfile_number:int, quietly=False):
-    """ Deletes a bakfile by number
+def __format_numbers(numbers: List[int]):
+    """ [3, 4, 5, 9] -> '#3-5, #9' """
+    runs = []
+    for number in sorted(set(numbers)):
+        if runs and number == runs[-1][1] + 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return ", ".join(f"#{first}" if first == last else f"#{first}-{last}" for first, last in runs)
+
+
+def bak_del_cmd(filename: Path, bakfile_numbers: List[int] = (), quietly=False):
+    """ Deletes bakfiles by number, or the one picked from a list if no
+        numbers are given
     """
     console = Console()
     _bakfile = None
@@ -560,6 +1391,19 @@ def bak_del_cmd(filename:Path, bakfile_number:int, quietly=False):
     if not bakfiles:
         console.print(f"No bakfiles found for {filename}")
         return False
+    if len(bakfile_numbers) > 1:
+        missing = [number for number in bakfile_numbers if number > len(bakfiles)]
+        if missing:
+            console.print(f"No such bakfile: {filename} {__format_numbers(missing)}")
+            return False
+        confirm = input(
+            f"Confirming: Delete {len(set(bakfile_numbers))} bakfiles "
+            f"({__format_numbers(bakfile_numbers)}) for {filename}? "
+            f"(y/N) ").lower() == 'y' if not quietly else True
+        if confirm:
+            __remove_bakfiles([bakfiles[number - 1] for number in sorted(set(bakfile_numbers))])
+        return confirm
+    bakfile_number = bakfile_numbers[0] if bakfile_numbers else 0
     if not bakfile_number:
         try:
             _bakfile, bakfile_number = \
@@ -582,26 +1426,501 @@ def bak_del_cmd(filename:Path, bakfile_number:int, quietly=False):
         __remove_bakfiles([_bakfile])
         return True
 
-def bak_off_cmd(filename: Optional[Path],
+def bak_off_cmd(filenames: List[Path],
+                patterns: List[str] = (),
                 quietly=False):
-    """ Used when finished. Deletes all instances of `filename.bak`
-    Args:
-        filename ([type], optional): [description]. Defaults to None.
+    """ Used when finished. Deletes every .bakfile of each of `filenames`,
+        and of every file bak knows of under those that are (or were)
+        directories, plus those of files matching `patterns` (globs, where *
+        matches / too). Only bak's database is consulted, so files that are
+        long gone can still be let go of.
+
+        Entries go in a few set-based statements, in one transaction, and
+        the bakfiles left unused are unlinked in parallel after the commit.
     """
-    console = Console()
-    bakfiles = db_handler.get_bakfile_entries(filename)
-    if not bakfiles:
-        console.print(f"No bakfiles found for {filename}")
+    entry_count, file_count = db_handler.count_entries_of(filenames, filenames, patterns)
+    if not entry_count:
+        targets = [*map(str, filenames), *patterns]
+        click.echo(f"No bakfiles found for {targets[0] if len(targets) == 1 else 'those files'}")
         return False
-    confirm = input(
-        f"Confirming: Remove {len(bakfiles)} .bakfiles for {filename}? "
-        f"(y/N) ").lower() == 'y' if not quietly else True
-    if confirm:
-        __remove_bakfiles(db_handler.get_bakfile_entries(filename))
-        return True
+    if file_count == 1 and len(filenames) == 1 and not patterns:
+        summary = f"{entry_count} .bakfiles for {filenames[0]}"
     else:
+        summary = f"{entry_count} .bakfile{'s' if entry_count != 1 else ''} of " \
+                  f"{file_count} file{'s' if file_count != 1 else ''}"
+    confirm = input(f"Confirming: Remove {summary}? "
+                    f"(y/N) ").lower() == 'y' if not quietly else True
+    if not confirm:
+        return False
+    with db_handler.transaction():
+        removed, orphans = db_handler.del_entries_of(filenames, filenames, patterns)
+        db_handler.call_after_commit(lambda: __unlink_bakfiles(orphans))
+    if file_count > 1:
+        click.echo(f"Removed {removed} .bakfile{'s' if removed != 1 else ''} "
+                   f"of {file_count} files")
+    return True
+
+
+# region retention
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+AGE_UNITS = {'h': timedelta(hours=1), 'd': timedelta(days=1), 'w': timedelta(weeks=1)}
+
+
+def __parse_size(size: (str, int, None)) -> Optional[int]:
+    """ '500M', '2g', '1024' (bytes) -> bytes """
+    if size in (None, ''):
+        return None
+    size = str(size).strip().lower().rstrip('b')
+    unit = size[-1] if size and size[-1] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def __parse_age(age: (str, int, None)) -> Optional[timedelta]:
+    """ '12h', '30d', '2w', or a number of days -> timedelta """
+    if age in (None, ''):
+        return None
+    age = str(age).strip().lower()
+    if age[-1] in AGE_UNITS:
+        return float(age[:-1]) * AGE_UNITS[age[-1]]
+    return float(age) * AGE_UNITS['d']
+
+
+def __format_size(size: int):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+
+
+def __retention_policy(settings: dict, overrides: dict, now: datetime):
+    """ A plan_prune() policy from `settings` (config keys, minus the
+        retention_ prefix), with command-line `overrides` on top
+    """
+    settings = {key: translate_config_value(value) for key, value in
+                {**settings, **{key: value for key, value in overrides.items()
+                                if value is not None}}.items()}
+    policy = {key: int(settings[key]) if settings.get(key) is not None else None
+              for key in ('keep_last', 'keep_hourly', 'keep_daily', 'keep_weekly')}
+    max_age = __parse_age(settings.get('max_age'))
+    policy['cutoff'] = now - max_age if max_age is not None else None
+    policy['max_bytes_per_file'] = __parse_size(settings.get('max_bytes_per_file'))
+    return policy
+
+
+def bak_prune_cmd(filenames: List[Path] = (),
+                  dry_run: bool = False,
+                  quietly: bool = False,
+                  **overrides):
+    """ Removes .bakfiles by retention policy. Policies come from the
+        retention_* settings, with per-path overrides in retention_paths
+        (glob pattern -> settings); keyword arguments override both.
+        A file's newest .bakfile is never pruned.
+    """
+    now = datetime.now()
+    defaults = {key[len('retention_'):]: cfg[key] for key in cfg.DEFAULT_VALUES
+                if key.startswith('retention_') and key not in ('retention_paths',
+                                                                'retention_max_bytes')}
+    path_policies = cfg['retention_paths'] or {}
+    try:
+        policies = [(str(Path(pattern).expanduser()),
+                     __retention_policy({**defaults, **(settings or {})}, overrides, now))
+                    for pattern, settings in path_policies.items()]
+        policies.append((None, __retention_policy(defaults, overrides, now)))
+        max_bytes = __parse_size(translate_config_value(
+            overrides.get('max_bytes') or cfg['retention_max_bytes']))
+    except (ValueError, TypeError, AttributeError) as error:
+        click.echo(f"Error: invalid retention setting ({error})", err=True)
+        return False
+    try:
+        entries, orphans = db_handler.plan_prune(policies, max_bytes, filenames)
+    except sqlite3.NotSupportedError as error:
+        click.echo(f"Error: {error}", err=True)
+        return False
+
+    if not entries:
+        click.echo("Nothing to prune.")
+        return True
+    reclaimed = sum(loc.stat().st_size for loc in orphans if loc.exists())
+    file_count = len({str(entry.orig_abspath) for entry in entries})
+    summary = f"{len(entries)} .bakfile{'s' if len(entries) != 1 else ''} of " \
+              f"{file_count} file{'s' if file_count != 1 else ''}, " \
+              f"reclaiming {__format_size(reclaimed)}"
+    if dry_run:
+        for entry in entries:
+            click.echo(f"{entry.orig_abspath}\t{str(entry.date_created).split('.')[0]}")
+        click.echo(f"Would remove {summary}")
+        return True
+    if not quietly and not click.confirm(f"Remove {summary}?", default=False):
+        click.echo("Cancelled.")
+        return True
+    __remove_bakfiles(entries)
+    click.echo(f"Removed {summary}")
+    return True
+# endregion
+
+
+# region fsck
+# Bakfile names, as made by __assemble_bakfile(): the mangled original path,
+# then the creation timestamp
+BAKFILE_NAME = re.compile(r'^(?P<path>.+)\.(?P<seconds>\d+)-(?P<fraction>\d+)\.bak$')
+
+
+def __storage_chain(bak_entry: bakfile.BakFile, entries_by_id: dict):
+    """ ((bakfile_loc, codec), ...) to read `bak_entry` back: its full version
+        first, then the reverse deltas down to it. None if a base is gone.
+    """
+    chain = [bak_entry]
+    while chain[-1].delta_base is not None:
+        base = entries_by_id.get(chain[-1].delta_base)
+        if base is None or base in chain:
+            return None
+        chain.append(base)
+    return tuple((str(entry.bakfile_loc), entry.codec) for entry in reversed(chain))
+
+
+def __guess_original(mangled: str, known: dict):
+    """ The file an unregistered bakfile was made from: one bak already knows
+        whose name mangles the same way, or else an existing file that does
+        (any dash may have been a slash)
+    """
+    if mangled in known:
+        return known[mangled]
+    parts = mangled.split('-')
+
+    def search(directory: Path, start: int):
+        for end in range(start + 1, len(parts) + 1):
+            name = '-'.join(parts[start:end])
+            if not name:
+                continue
+            candidate = directory / name
+            if end == len(parts):
+                if candidate.is_file():
+                    return candidate
+            elif candidate.is_dir():
+                found = search(candidate, end)
+                if found:
+                    return found
+        return None
+    return search(Path('/'), 0)
+
+
+def __register_orphan(bakfile_loc: Path, original: Path, created: datetime):
+    """ Gives a bakfile with no entry (say, from a crash mid-backup) one """
+    codec = bak_fsck.sniff_codec(bakfile_loc) if COMPRESSION else None
+    content_hash, size, _, error = bak_fsck.rehash(((bakfile_loc, codec),))
+    if codec and (error or (original.is_file() and
+                            bak_store.hash_current_file(original) == bak_store.hash_file(bakfile_loc))):
+        # Already-compressed originals are stored raw
+        codec = None
+        content_hash, size, _, error = bak_fsck.rehash(((bakfile_loc, None),))
+    if error:
+        return False
+    db_handler.create_bakfile_entry(bakfile.BakFile(original.name, original, bakfile_loc,
+                                                    created, created, restored=False,
+                                                    content_hash=content_hash, size=size,
+                                                    codec=codec))
+    return True
+
+
+def __restore_from_original(bak_entry: bakfile.BakFile, sharing: list):
+    """ Stores a lost or damaged bakfile's contents again, from its original
+        file, if that still holds them. `sharing` are the entries using the
+        same bakfile, which all get the new copy.
+    """
+    original = Path(bak_entry.orig_abspath)
+    try:
+        if not bak_entry.content_hash or not original.is_file() or \
+                bak_store.hash_current_file(original) != bak_entry.content_hash:
+            return False
+        old_loc = bak_entry.bakfile_loc
+        if bak_store.is_object(bak_dir, old_loc):
+            new_loc, _, _, codec, _ = bak_store.store_object(
+                bak_dir, original, bak_entry.content_hash, COMPRESSION, COMPRESSION_LEVEL,
+                SINGLE_WRITES)
+        else:
+            new_loc = __assemble_bakfile(original).bakfile_loc
+            _, _, codec, _ = bak_store.write_bakfile(original, new_loc,
+                                                     COMPRESSION, COMPRESSION_LEVEL, SINGLE_WRITES)
+    except OSError:
+        return False
+    for entry in sharing:
+        entry.bakfile_loc, entry.codec, entry.delta_base = new_loc, codec, None
+        db_handler.set_storage(entry)
+    if new_loc != old_loc:
+        __release_bakfile(old_loc)
+    return True
+
+
+def bak_fsck_cmd(repair: bool = False, quietly: bool = False, jobs: int = FSCK_WORKERS):
+    """ Checks that the database and bak_dir agree, and that every bakfile
+        still reads back to what was backed up. With `repair`, lost or
+        damaged bakfiles are stored again from their originals where those
+        are unchanged; entries that still can't be read back are removed;
+        bakfiles with no entry are registered under the file they came from,
+        if it can be worked out, and deleted otherwise.
+
+    Returns:
+        bool: True if no problems were found, or all were repaired
+    """
+    started = perf_counter()
+    entries = db_handler.get_all_entries()
+    entries_by_id = {entry.rowid: entry for entry in entries}
+    sharing = {}
+    for entry in entries:
+        sharing.setdefault(str(entry.bakfile_loc), []).append(entry)
+    skip = [bak_dir / DIFF_CACHE_DIRNAME] + \
+        [f"{bak_db_loc}{suffix}" for suffix in ('', '-wal', '-shm', '-journal')]
+    on_disk, recent, stale = bak_fsck.scan_store(bak_dir, skip)
+
+    orphans = sorted(Path(path) for path in on_disk.keys() - sharing.keys() - recent)
+    missing = [entry for entry in entries
+               if str(entry.bakfile_loc) not in on_disk and not os.path.exists(entry.bakfile_loc)]
+    missing_ids = {entry.rowid for entry in missing}
+    unreadable, corrupt, unhashed = [], [], []
+    chains = {}
+    for entry in entries:
+        if entry.rowid in missing_ids:
+            continue
+        chain = __storage_chain(entry, entries_by_id)
+        if chain is None:
+            unreadable.append((entry, "delta base is gone"))
+            continue
+        chains.setdefault(chain, []).append(entry)
+
+    checked = read = 0
+    hashing_started = perf_counter()
+    for chain, (content_hash, size, chain_read, error) in \
+            bak_fsck.rehash_all(list(chains), jobs):
+        checked += 1
+        read += chain_read
+        for entry in chains[chain]:
+            if error:
+                unreadable.append((entry, error))
+            elif not entry.content_hash:
+                unhashed.append((entry, content_hash, size))
+            elif (entry.content_hash, entry.size or size) != (content_hash, size):
+                corrupt.append((entry, "contents don't match their hash"))
+    hashing_time = perf_counter() - hashing_started
+
+    missing = [(entry, "bakfile is missing") for entry in missing]
+    problems = len(missing) + len(unreadable) + len(corrupt) + len(orphans) + len(stale)
+    for label, found in (("missing", missing), ("unreadable", unreadable), ("corrupt", corrupt)):
+        for entry, reason in found:
+            click.echo(f"{label}: {entry.bakfile_loc} ({entry.orig_abspath}, "
+                       f"{str(entry.date_created).split('.')[0]}): {reason}")
+    for path in orphans:
+        click.echo(f"orphaned: {path}")
+    for path in stale:
+        click.echo(f"stale temporary file: {path}")
+
+    elapsed = perf_counter() - started
+    click.echo(f"Checked {len(entries)} .bakfile entries and {len(on_disk)} files in {elapsed:.2f}s; "
+               f"read {__format_size(read)} from {checked} bakfiles "
+               f"({__format_size(read / hashing_time if hashing_time else 0)}/s, "
+               f"{jobs} process{'es' if jobs != 1 else ''})")
+    summary = ", ".join(f"{len(found)} {label}" for label, found in (
+        ("missing", missing), ("unreadable", unreadable), ("corrupt", corrupt),
+        ("orphaned", orphans), ("stale temporary", stale)) if found)
+    if not problems:
+        if unhashed and repair:
+            with db_handler.transaction():
+                for entry, content_hash, size in unhashed:
+                    db_handler.set_content_hash(entry, content_hash, size)
+        click.echo("No problems found.")
+        return True
+    click.echo(f"Found {summary}.")
+    if not repair:
+        click.echo("Run 'bak fsck --repair' to fix what can be fixed.")
+        return False
+    if not quietly and not click.confirm("Repair?", default=False):
+        click.echo("Cancelled.")
         return False
 
+    restored, removed, registered, unregistered, left = set(), [], 0, [], []
+    with db_handler.transaction():
+        for entry, content_hash, size in unhashed:
+            db_handler.set_content_hash(entry, content_hash, size)
+        for entry, _ in missing + unreadable + corrupt:
+            if entry.rowid in restored:
+                continue
+            shared = sharing[str(entry.bakfile_loc)]
+            if __restore_from_original(entry, shared):
+                restored.update(other.rowid for other in shared)
+        # Versions only unreadable through a delta base that's been restored
+        # read back fine now. Whatever still can't be read back goes.
+        for entry, _ in missing + unreadable:
+            if entry.rowid in restored:
+                continue
+            chain = __storage_chain(entry, entries_by_id)
+            if chain is None or bak_fsck.rehash(chain)[3]:
+                removed.append(entry)
+        if removed:
+            db_handler.del_bakfile_entries(removed)
+            unreadable_files = db_handler.unreferenced_bakfiles(entry.bakfile_loc for entry in removed)
+            db_handler.call_after_commit(lambda: __unlink_bakfiles(unreadable_files))
+            db_handler.del_empty_snapshots()
+
+        known = {__mangled_name(Path(entry.orig_abspath)): Path(entry.orig_abspath)
+                 for entry in entries}
+        registered_names = {Path(loc).name: Path(loc).parent
+                            for loc in sharing if os.path.exists(loc)}
+        for path in orphans + stale:
+            match = BAKFILE_NAME.match(path.name)
+            if path.name in registered_names and path.parent != registered_names[path.name]:
+                # Left behind by an interrupted `bak migrate`; the entry has the other copy
+                unregistered.append(path)
+                continue
+            original = __guess_original(match['path'], known) \
+                if match and bak_store.in_layout(bak_dir, path) else None
+            if original:
+                created = datetime.fromtimestamp(float(f"{match['seconds']}.{match['fraction']}"))
+                if __register_orphan(path, original, created):
+                    registered += 1
+                    continue
+            if path in stale or bak_store.is_object(bak_dir, path) or \
+                    (bak_store.in_layout(bak_dir, path) and
+                     (match or path.name.endswith('.bak' + bak_store.DELTA_SUFFIX))):
+                unregistered.append(path)
+            else:
+                # Not something bak would have written
+                left.append(path)
+        db_handler.call_after_commit(lambda: [__unlink_bakfile(path) for path in unregistered])
+
+    unrepaired = len([entry for entry, _ in corrupt if entry.rowid not in restored])
+    click.echo(f"Restored {len(restored)} .bakfile{'s' if len(restored) != 1 else ''} "
+               f"from their originals, removed {len(removed)} unreadable "
+               f"entr{'ies' if len(removed) != 1 else 'y'}, registered {registered} and "
+               f"deleted {len(unregistered)} unregistered file{'s' if len(unregistered) != 1 else ''}.")
+    for path in left:
+        click.echo(f"Left {path} alone; bak didn't write it.")
+    if unrepaired:
+        click.echo(f"Left {unrepaired} corrupt .bakfile{'s' if unrepaired != 1 else ''} "
+                   "as is; the original has changed since.")
+    return not unrepaired
+# endregion
+
+
+def __link_into_place(old_loc: Path, new_loc: Path):
+    """ Hard-links a bakfile at its new location, so it's reachable under
+        both names until the database says otherwise
+    """
+    new_loc.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(old_loc, new_loc)
+    except FileExistsError:
+        # From an interrupted migration, or else not ours to overwrite
+        if not os.path.samefile(old_loc, new_loc):
+            raise
+
+
+def bak_migrate_cmd(layout: (str, None) = None, batch_size: int = MIGRATE_BATCH_SIZE):
+    """ Moves existing bakfiles into `layout` (by default, the configured
+        one) while bak stays usable. Each batch is hard-linked into place,
+        then the database is pointed at the new names in one short
+        transaction, then the old names are unlinked; at no point does an
+        entry refer to a file that isn't there.
+
+    Returns:
+        bool: True if every bakfile that needed moving was moved
+    """
+    layout = layout or LAYOUT
+    moves = []
+    for loc in map(Path, db_handler.get_bakfile_locs()):
+        # Objects are sharded already, and bakfiles outside bak_dir stay put
+        if bak_store.is_object(bak_dir, loc) or not bak_store.in_layout(bak_dir, loc):
+            continue
+        new_loc = bak_store.bakfile_path(bak_dir, loc.name, layout)
+        if new_loc != loc:
+            moves.append((loc, new_loc))
+    if not moves:
+        click.echo(f"All .bakfiles are already in the {layout} layout.")
+        return True
+
+    started = perf_counter()
+    moved, failed = 0, []
+    for start in range(0, len(moves), batch_size):
+        batch = []
+        for old_loc, new_loc in moves[start:start + batch_size]:
+            try:
+                __link_into_place(old_loc, new_loc)
+            except OSError as error:
+                failed.append((old_loc, error.strerror or str(error)))
+                continue
+            batch.append((old_loc, new_loc))
+        db_handler.move_bakfiles(batch)
+        for old_loc, _ in batch:
+            __unlink_bakfile(old_loc)
+        moved += len(batch)
+        click.echo(f"Moved {moved} of {len(moves)} .bakfiles", err=True)
+    # Shards emptied by going back to the flat layout
+    for shard in {old_loc.parent for old_loc, _ in moves} - {bak_dir}:
+        try:
+            shard.rmdir()
+        except OSError:
+            pass
+
+    for old_loc, reason in failed:
+        click.echo(f"Couldn't move {old_loc}: {reason}", err=True)
+    click.echo(f"Moved {moved} .bakfile{'s' if moved != 1 else ''} to the {layout} layout "
+               f"in {perf_counter() - started:.2f}s"
+               + (f"; {len(failed)} failed (see 'bak fsck')" if failed else "."))
+    if layout != LAYOUT:
+        click.echo(f"New .bakfiles still use the {LAYOUT} layout; "
+                   f"see 'bak config --set layout {layout}'.")
+    return not failed
+
+
+def bak_watch_cmd(paths: List[Path],
+                  recursive: bool = False,
+                  delay: float = WATCH_DELAY,
+                  poll_interval: Optional[float] = None,
+                  verbose: bool = False,
+                  jobs: int = BATCH_WORKERS):
+    """ `bak watch`: backs files (and the files in directories) up as they
+        change, until interrupted. Runs on an asyncio event loop that sleeps
+        until inotify (or the polling timer) has something for it. Changes
+        are coalesced (see bak_watch.Coalescer), then handed to
+        create_bakfiles(), which skips files whose contents haven't changed.
+    """
+    import asyncio
+    import signal
+
+    dirs = [path for path in paths if path.is_dir()]
+    files = [path for path in paths if path not in dirs]
+
+    def back_up(changed):
+        changed = [path for path in changed if path.is_file()]
+        if not changed:
+            return
+        backed_up, skipped, failed = create_bakfiles(changed, verbose, jobs)
+        bak_store.forget_hashes()
+        for filename, reason in failed:
+            click.echo(f"Failed: {filename} ({reason})", err=True)
+        if backed_up or verbose:
+            click.echo(f"{datetime.now():%Y-%m-%d %H:%M:%S} "
+                       f"backed up {backed_up} file{'s' if backed_up != 1 else ''}"
+                       + (f": {changed[0]}" if len(changed) == 1 else "")
+                       + (f", skipped {skipped} unchanged" if skipped else ""))
+
+    loop = asyncio.new_event_loop()
+    coalescer = bak_watch.Coalescer(loop, delay, delay * WATCH_MAX_DELAYS, back_up)
+    # Never watch bak watching itself
+    exclude = [bak_dir] + [Path(f"{bak_db_loc}{suffix}")
+                           for suffix in ('', '-wal', '-shm', '-journal')]
+    try:
+        watcher = bak_watch.watch(files, dirs, recursive, coalescer.add, exclude, poll_interval)
+        watcher.start(loop)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, loop.stop)
+        click.echo(f"Watching {len(paths)} path{'s' if len(paths) != 1 else ''} "
+                   f"({watcher.name}); Ctrl-C to stop", err=True)
+        loop.run_forever()
+        # Don't lose changes still waiting out their delay
+        coalescer.flush_all()
+        watcher.close()
+    finally:
+        loop.close()
 
 def bak_print_cmd(bak_to_print: (str, bakfile.BakFile),
                   using: (str, None) = None,
@@ -627,7 +1946,8 @@ def bak_print_cmd(bak_to_print: (str, bakfile.BakFile),
     pager = using if using else \
         (cfg['bak_open_exec'] or os.environ['PAGER']) or 'less'
     pager = pager.strip('"').strip("'").split(" ")
-    call(pager + [bak_to_print.bakfile_loc])
+    with __materialize(bak_to_print) as bak_path:
+        call(pager + [str(bak_path)])
 
 
 def bak_getfile_cmd(bak_to_get: (str, bakfile.BakFile), bakfile_number:int=0):
@@ -648,13 +1968,84 @@ def bak_getfile_cmd(bak_to_get: (str, bakfile.BakFile), bakfile_number:int=0):
     print(bak_to_get.bakfile_loc)
 
 
-def bak_diff_cmd(filename: (bakfile.BakFile, Path), command=None, bakfile_number: int=0):
+def __diff_label(bak_entry: bakfile.BakFile):
+    return f"{bak_entry.orig_abspath} (.bakfile, {str(bak_entry.date_modified).split('.')[0]})"
+
+
+def __cached_hunks(old_entry: bakfile.BakFile, new_entry: bakfile.BakFile,
+                   old_path: Path, new_path: Path):
+    """ Hunks of the diff between two bakfiles. Bakfiles never change, so
+        these are cached by the pair's content hashes.
+    """
+    cache_dir = bak_dir / DIFF_CACHE_DIRNAME
+    cache_file = cache_dir / f"{__bakfile_hash(old_entry)}-{__bakfile_hash(new_entry)}"
+    try:
+        with open(cache_file, 'rb') as _file:
+            yield from _file
+        return
+    except FileNotFoundError:
+        pass
+
+    kept, size = [], 0
+    for line in bak_diff.diff_hunks(old_path, new_path):
+        yield line
+        if kept is not None:
+            size += len(line)
+            kept = kept if size <= DIFF_CACHE_MAX_SIZE else None
+            if kept is not None:
+                kept.append(line)
+    if kept is None:
+        return
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_dir / f".{cache_file.name}.{os.getpid()}"
+    tmp_file.write_bytes(b''.join(kept))
+    os.replace(tmp_file, cache_file)
+    cached = sorted(cache_dir.iterdir(), key=lambda path: path.stat().st_mtime)
+    for stale in cached[:-DIFF_CACHE_MAX_ENTRIES]:
+        __unlink_bakfile(stale)
+
+
+def __builtin_diff(old_entry: bakfile.BakFile, new_entry: Optional[bakfile.BakFile] = None):
+    """ Diffs a bakfile against the current file, or against another bakfile,
+        in process, writing to stdout as it goes
+    """
+    if new_entry is None:
+        new_file = Path(old_entry.orig_abspath)
+        if not new_file.exists():
+            # As an external diff would put it
+            click.echo(f"diff: {new_file}: No such file or directory", err=True)
+            return
+        if __matches_current_file(old_entry, new_file):
+            return
+        new_label = f"{new_file} ({datetime.fromtimestamp(new_file.stat().st_mtime):%Y-%m-%d %H:%M:%S})"
+    else:
+        # Hashes alone: sizes aren't known for older bakfiles until they're hashed
+        if __bakfile_hash(old_entry) == __bakfile_hash(new_entry):
+            return
+        new_label = __diff_label(new_entry)
+
+    with __materialize(old_entry) as old_path, \
+            (__materialize(new_entry) if new_entry else nullcontext(new_file)) as new_path:
+        hunks = __cached_hunks(old_entry, new_entry, old_path, new_path) if new_entry else None
+        output = stdout.buffer
+        for line in bak_diff.unified_diff(old_path, new_path, __diff_label(old_entry),
+                                          new_label, hunks):
+            output.write(line)
+        output.flush()
+
+
+def bak_diff_cmd(filename: (bakfile.BakFile, Path), command=None, bakfile_number: int=0,
+                 other_number: int=0):
     '''
     Expects a config value for its exec along the lines of:
         diff %old %new
     or:
         diff -r %old %new
     which will be substituted with the bakfile and the original file.
+    'builtin' uses bak's own diff instead.
+
+    With `other_number`, diffs bakfile #`bakfile_number` against bakfile
+    #`other_number`, rather than the original file.
     '''
     # TODO write tests for this (mildly tricky)
     console = Console()
@@ -667,7 +2058,8 @@ def bak_diff_cmd(filename: (bakfile.BakFile, Path), command=None, bakfile_number
                             console=console)
     if not command:
         command = cfg['bak_diff_exec']
-        if not command or any((i not in command.lower() for i in ['%old', '%new'])):
+        if not command or (command.strip().lower() != BUILTIN_DIFF and
+                           any((i not in command.lower() for i in ['%old', '%new']))):
             command = 'diff %old %new'
     if bak_to_diff is None:
         if not bakfile_number:
@@ -675,11 +2067,25 @@ def bak_diff_cmd(filename: (bakfile.BakFile, Path), command=None, bakfile_number
         return
     if not bak_to_diff:
         return
+    other_bak = None
+    if other_number:
+        other_bak = __get_bakfile_entry(bak_to_diff.orig_abspath,
+                                        bakfile_number=other_number,
+                                        console=console)
+        if not other_bak:
+            return
+
+    if command.strip().lower() == BUILTIN_DIFF:
+        __builtin_diff(bak_to_diff, other_bak)
+        return
 
     command = command.split(" ")
-    command[command.index('%old')] = bak_to_diff.bakfile_loc
-    command[command.index('%new')] = bak_to_diff.orig_abspath
-    call(command)
+    with __materialize(bak_to_diff) as bak_path, \
+            (__materialize(other_bak) if other_bak else nullcontext(bak_to_diff.orig_abspath)) \
+            as new_path:
+        command[command.index('%old')] = str(bak_path)
+        command[command.index('%new')] = str(new_path)
+        call(command)
 
 
 def bak_config_command(get_op: bool, setting: str, value: tuple = ()):
@@ -696,6 +2102,7 @@ def bak_config_command(get_op: bool, setting: str, value: tuple = ()):
         except KeyError:
             click.echo(f"Unknown option {setting}")
     else:
+        from config import KeyNotFoundError
         try:
             cfg[setting] = ' '.join(value)
         except KeyNotFoundError as err:
@@ -1,4 +1,5 @@
 # Straight file. Read config into variables. Probably no need for a data structure.
+import json
 import os
 
 from pathlib import Path
@@ -6,8 +7,11 @@ from re import sub
 from shutil import copy2
 from sys import exit as _exit
 
-from click import echo
-from config import Config, KeyNotFoundError
+from bak import trace
+
+# The config module (CFG) is only imported when bak.cfg has to be parsed;
+# otherwise settings come from the compiled cache (see __load())
+CACHE_SUFFIX = '.cache'
 
 
 class BakConfiguration(dict):
@@ -15,20 +19,51 @@ class BakConfiguration(dict):
     DEFAULT_VALUES = {
         'bakfile_location': 'null',
         'bak_database_location': 'null',
+        'bakfile_layout': "'sharded'",
         'bak_diff_exec': 'null',
         'bak_list_relative_paths': 'false',
         'bak_list_colors': 'true',
-        'fast_mode': 'false'
+        'fast_mode': 'false',
+        'dedup': 'false',
+        'compression': 'null',
+        'compression_level': 'null',
+        'delta_chains': 'false',
+        'delta_keyframe_interval': '10',
+        'durability': "'group'",
+        'retention_keep_last': 'null',
+        'retention_keep_hourly': 'null',
+        'retention_keep_daily': 'null',
+        'retention_keep_weekly': 'null',
+        'retention_max_age': 'null',
+        'retention_max_bytes_per_file': 'null',
+        'retention_max_bytes': 'null',
+        'retention_paths': '{}'
     }
 
     SETTABLE_VALUES = {
         'diff-exec': 'bak_diff_exec',
+        'layout': 'bakfile_layout',
         'relative-paths': 'bak_list_relative_paths',
         'colors': 'bak_list_colors',
-        'fast-mode': 'fast_mode'
+        'fast-mode': 'fast_mode',
+        'dedup': 'dedup',
+        'compression': 'compression',
+        'compression-level': 'compression_level',
+        'delta-chains': 'delta_chains',
+        'delta-keyframe-interval': 'delta_keyframe_interval',
+        'durability': 'durability',
+        'keep-last': 'retention_keep_last',
+        'keep-hourly': 'retention_keep_hourly',
+        'keep-daily': 'retention_keep_daily',
+        'keep-weekly': 'retention_keep_weekly',
+        'max-age': 'retention_max_age',
+        'max-bytes-per-file': 'retention_max_bytes_per_file',
+        'max-bytes': 'retention_max_bytes'
     }
-    cfg: Config
-    config_file: str
+    # Settings where 'none' is a value of its own, rather than null
+    NONE_VALUED = ('durability',)
+    config_file: Path
+    cache_file: Path
     data_dir: Path
     config_dir: Path
     newline: str
@@ -53,38 +88,92 @@ class BakConfiguration(dict):
             self.config_dir = Path("~/.config").expanduser().resolve()
 
         self.config_file = self.config_dir / 'bak.cfg'
-        if not self.config_file.exists():
+        self.cache_file = self.config_dir / ('bak.cfg' + CACHE_SUFFIX)
+        try:
+            stat = os.stat(self.config_file)
+        except FileNotFoundError:
+            stat = None
             try:
                 copy2(Path('/etc/xdg/bak.cfg.default'), self.config_file)
             except FileNotFoundError:
                 try:
                     copy2(self.config_dir / 'bak.cfg.default', self.config_file)
                 except FileNotFoundError:
+                    # click is only needed for this, and it's slow to import
+                    from click import echo
                     echo("Error: current user can't find bak's default config file! "
                         "Try copying \n\t~/.config/bak.cfg.default\nfrom your default user's ~"
                         " into this user's, or installing bak another way.")
                     _exit()
-        _cfg = Config(str(self.config_file))
-
-        reload = False
-        for cfg_value in self.DEFAULT_VALUES.keys():
-            if cfg_value not in _cfg.as_dict():
-                with open(self.config_file, 'a') as _file:
-                    _file.writelines(
-                        f"{cfg_value}: {self.DEFAULT_VALUES[cfg_value]}\n")
-                    _file.close()
-                    reload = True
-        if reload:
-            _cfg = Config(str(self.config_file))
-
-        self.cfg = _cfg
+        self.__load(stat)
 
         super().__init__()
 
+    # region compiled cache
+    def __load(self, stat: (os.stat_result, None)):
+        """ Settings come from the cache when it matches bak.cfg's mtime and
+            size, which costs one stat() and one small read. Otherwise bak.cfg
+            is parsed, missing defaults are appended to it, and the cache is
+            rewritten.
+        """
+        if stat is not None:
+            try:
+                with open(self.cache_file) as _file:
+                    cache = json.load(_file)
+                # A newer bak may have added settings, which bak.cfg needs
+                # appending
+                if (cache['mtime_ns'], cache['size']) == (stat.st_mtime_ns, stat.st_size) \
+                        and all(key in cache['values'] for key in self.DEFAULT_VALUES):
+                    self.values = cache['values']
+                    return
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        self.values = self.__parse()
+        missing = [key for key in self.DEFAULT_VALUES if key not in self.values]
+        if missing:
+            with open(self.config_file, 'a') as _file:
+                _file.writelines(f"{key}: {self.DEFAULT_VALUES[key]}\n" for key in missing)
+            self.values = self.__parse()
+        self.__write_cache()
+
+    def __parse(self):
+        from config import Config
+        return Config(str(self.config_file)).as_dict()
+
+    def __write_cache(self):
+        """ Skipped for configs with references (${...}) or special values
+            (`$ENV_VAR`, ...), since those are resolved when parsing
+        """
+        try:
+            with open(self.config_file) as _file:
+                if any('${' in line or '`' in line for line in _file
+                       if not line.lstrip().startswith('#')):
+                    return
+            stat = os.stat(self.config_file)
+            tmp_file = self.cache_file.with_name(f".{self.cache_file.name}.{os.getpid()}")
+            with open(tmp_file, 'w') as _file:
+                json.dump({'mtime_ns': stat.st_mtime_ns,
+                           'size': stat.st_size,
+                           'values': self.values}, _file)
+            os.replace(tmp_file, self.cache_file)
+        except (OSError, TypeError, ValueError):
+            # Not worth failing over; bak.cfg is parsed again next time
+            pass
+    # endregion
+
+    @property
+    def bak_dir(self) -> Path:
+        """ Where bakfiles are stored """
+        return Path(self['bakfile_location'] or self.data_dir / 'bak' / 'bakfiles').expanduser()
+
+    @property
+    def bak_db_loc(self) -> Path:
+        return Path(self['bak_database_location'] or self.data_dir / 'bak' / 'bak.db').expanduser()
+
     def __getitem__(self, item):
         if item in self.SETTABLE_VALUES:
             item = self.SETTABLE_VALUES[item]
-        return translate_config_value(self.cfg[item])
+        return translate_config_value(self.values[item])
 
     def get(self, item, literal=True):
         """
@@ -97,7 +186,7 @@ class BakConfiguration(dict):
         if literal:
             # `and` would work, but why make the second check if this is a regular dict.get()?
             if item in self.SETTABLE_VALUES:
-                return self.cfg[self.SETTABLE_VALUES[item]]
+                return self.values[self.SETTABLE_VALUES[item]]
         return super().get(item)
 
     def __setitem__(self, item: str, value: str):
@@ -107,9 +196,10 @@ class BakConfiguration(dict):
             err = f"{item} is not a valid bak setting. Valid settings include:\n"
             for setting in self.DEFAULT_VALUES:
                 err += f"\n\t\t\t{setting + self.newline}"
+            from config import KeyNotFoundError
             raise KeyNotFoundError(err)
         if str(value).lower not in ('true', 'false'):
-            if value is None or value.lower() == 'none':
+            if value is None or (value.lower() == 'none' and item not in self.NONE_VALUED):
                 value = 'null'
             else:
                 value = f"'{value}'"
@@ -120,7 +210,9 @@ class BakConfiguration(dict):
             _config = sub(f"{item}: .*", f"{item}: {value}", _config)
             with open(self.config_file, 'w') as _file:
                 _file.write(_config)
-            self.cfg = Config(str(self.config_file))
+            # What CFG would parse that line as, without parsing the file again
+            self.values[item] = None if value == 'null' else value[1:-1]
+            self.__write_cache()
 
 
 EQUIVALENT_VALUES = {'false': False,
@@ -129,6 +221,8 @@ EQUIVALENT_VALUES = {'false': False,
 
 
 def translate_config_value(val):
+    if not isinstance(val, str):  # mappings (retention_paths) aren't hashable
+        return val
     if val in EQUIVALENT_VALUES.values():
         return val
     if val not in EQUIVALENT_VALUES:
@@ -136,4 +230,5 @@ def translate_config_value(val):
     return EQUIVALENT_VALUES[val]
 
 
-bak_cfg = BakConfiguration()
+with trace.phase('config'):
+    bak_cfg = BakConfiguration()
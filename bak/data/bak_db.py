@@ -1,99 +1,671 @@
 import os
 import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 
 from .bakfile import BakFile
 
 
 class BakDBHandler:
+    """ Holds a single connection to bak's database for the life of the process.
+
+        Every method runs in a transaction. Methods called inside an outer
+        `with db_handler.transaction():` block join it, so a multi-step
+        operation commits (or rolls back) as a unit.
+    """
     db_loc: Path
+    # Tracked with PRAGMA user_version. Unversioned databases are either
+    # new, or were created by bak <= 0.2.2a10 (untyped columns, no indexes).
+    SCHEMA_VERSION = 8
     COL_NAMES = ['original_file', 'original_abspath',
-                 'bakfile', 'date_created', 'date_modified', 'restored']
+                 'bakfile', 'date_created', 'date_modified', 'restored',
+                 'content_hash', 'size', 'codec', 'delta_base', 'snapshot', 'source_stat']
+    # Column order expected by BakFile()
+    ENTRY_COLUMNS = ", ".join(COL_NAMES[:6] + ['id'] + COL_NAMES[6:])
+    # SQLite before 3.32 allows at most 999 bound parameters per statement
+    MAX_SQL_VARIABLES = 900
+    PRAGMAS = {'journal_mode': 'WAL',
+               'synchronous': 'NORMAL',
+               'temp_store': 'MEMORY',
+               'busy_timeout': 5000}
 
-    def __init__(self, db_loc: Path):
+    def __init__(self, db_loc: Path, durable: bool = False):
+        """ `durable` fsyncs the WAL on every commit (synchronous=FULL); by
+            default, the last commits can be lost to power loss, though
+            never half-applied
+        """
         self.db_loc = db_loc
+        self.durable = durable
+        self._depth = 0
+        self._after_commit = []
+        self._db_conn = None
+
+    @property
+    def db_conn(self) -> sqlite3.Connection:
+        """ Connects, and brings the schema up to date, on first use. Commands
+            that never touch the database don't pay for opening it.
+        """
+        if self._db_conn is None:
+            Path(self.db_loc).parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit mode; transactions are managed explicitly by transaction()
+            self._db_conn = sqlite3.connect(self.db_loc, isolation_level=None)
+            for pragma, value in self.PRAGMAS.items():
+                self._db_conn.execute(f"PRAGMA {pragma}={value}")
+            if self.durable:
+                self._db_conn.execute("PRAGMA synchronous=FULL")
+
+            schema_version = self._db_conn.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version < self.SCHEMA_VERSION:
+                self.__migrate(schema_version)
+        return self._db_conn
+
+    # region schema
+    def __migrate(self, from_version: int):
+        with self.transaction() as db_conn:
+            for version, migration in MIGRATIONS:
+                if version > from_version:
+                    migration(db_conn)
+            db_conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+    # endregion
+
+    @contextmanager
+    def transaction(self):
+        """ Groups everything done in its block into one atomic transaction.
+            Nested blocks join the outermost one.
+        """
+        if self._depth:
+            self._depth += 1
+            try:
+                yield self.db_conn
+            finally:
+                self._depth -= 1
+            return
+        self.db_conn.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield self.db_conn
+        except BaseException:
+            self._depth = 0
+            self._after_commit.clear()
+            self.db_conn.execute("ROLLBACK")
+            raise
+        self._depth = 0
+        self.db_conn.execute("COMMIT")
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
 
-        if not self.db_loc.exists():
-            with sqlite3.connect(self.db_loc) as db_conn:
-                db_conn.execute("""
-                                CREATE TABLE bakfiles (original_file,
-                                                        original_abspath,
-                                                        bakfile,
-                                                        date_created,
-                                                        date_modified,
-                                                        restored)
-                                """)
-                db_conn.commit()
+    def call_after_commit(self, callback):
+        """ Defers `callback` (e.g. unlinking a file) until the current
+            transaction commits. Runs it right away outside a transaction.
+        """
+        if self._depth:
+            self._after_commit.append(callback)
         else:
-            with sqlite3.connect(self.db_loc) as db_conn:
-                cur = db_conn.cursor()
-                cur.execute("SELECT * from bakfiles")
-                db_cols = [name[0] for name in cur.description]
-                for col in self.COL_NAMES:
-                    if col not in db_cols:
-                        cur.execute(f"ALTER TABLE bakfiles ADD COLUMN {col}")
-                        db_conn.commit()
+            callback()
+
+    def close(self):
+        if self._db_conn is not None:
+            self._db_conn.close()
+            self._db_conn = None
 
     def create_bakfile_entry(self, bakfile_obj: BakFile):
-        with sqlite3.connect(self.db_loc) as db_conn:
-            db_conn.execute(
-                """
-                INSERT INTO bakfiles VALUES
-                (:orig, :abs, :bakfile, :created, :modified, :restored)
+        with self.transaction() as db_conn:
+            cursor = db_conn.execute(
+                f"""
+                INSERT INTO bakfiles ({", ".join(self.COL_NAMES)}) VALUES
+                (:orig, :abs, :bakfile, :created, :modified, :restored, :hash, :size, :codec,
+                 :delta_base, :snapshot, :source_stat)
                  """, bakfile_obj.export())
-            db_conn.commit()
+            bakfile_obj.rowid = cursor.lastrowid
 
     def del_bakfile_entry(self, bak_entry: BakFile):
-        with sqlite3.connect(self.db_loc) as db_conn:
+        with self.transaction() as db_conn:
             db_conn.execute(
                 """
-                DELETE FROM bakfiles WHERE bakfile=:bakfile
-                """, (bak_entry.bakfile_loc,))
-            db_conn.commit()
+                DELETE FROM bakfiles WHERE id=:rowid
+                """, (bak_entry.rowid,))
+
+    def count_references(self, bakfile_loc: Path):
+        """ Number of entries pointing at `bakfile_loc`. Bakfiles in the
+            content-addressed store may be shared by many entries.
+        """
+        cursor = self.db_conn.execute(
+            """
+            SELECT COUNT(*) FROM bakfiles WHERE bakfile=:bakfile
+            """, (str(bakfile_loc),))
+        return cursor.fetchone()[0]
+
+    def get_entry(self, rowid: int):
+        cursor = self.db_conn.execute(
+            f"SELECT {self.ENTRY_COLUMNS} FROM bakfiles WHERE id=:rowid", (rowid,))
+        entry = cursor.fetchone()
+        return BakFile(*entry) if entry else None
+
+    def get_delta_dependents(self, bakfile: BakFile):
+        """ Entries stored as reverse deltas against `bakfile` """
+        cursor = self.db_conn.execute(
+            f"SELECT {self.ENTRY_COLUMNS} FROM bakfiles WHERE delta_base=:rowid",
+            (bakfile.rowid,))
+        return [BakFile(*entry) for entry in cursor]
+
+    def find_bakfile_entry(self, bakfile_loc: Path):
+        """ Any one entry pointing at `bakfile_loc`, or None """
+        cursor = self.db_conn.execute(
+            f"""
+            SELECT {self.ENTRY_COLUMNS} FROM bakfiles WHERE bakfile=:bakfile LIMIT 1
+            """, (str(bakfile_loc),))
+        entry = cursor.fetchone()
+        return BakFile(*entry) if entry else None
 
     def del_all_entries(self, bak_entry: BakFile):
-        with sqlite3.connect(self.db_loc) as db_conn:
+        with self.transaction() as db_conn:
             db_conn.execute(
                 """
                 DELETE FROM bakfiles WHERE original_abspath=:orig
-                """, (bak_entry.orig_abspath,))
-            db_conn.commit()
+                """, (str(bak_entry.orig_abspath),))
 
     def update_bakfile_entry(self,
                              old_bakfile: BakFile,
                              new_bakfile: (BakFile, None) = None):
-        with sqlite3.connect(self.db_loc) as db_conn:
-            db_conn.execute(
-                """
-                DELETE FROM bakfiles WHERE bakfile=:bakfile_loc
-                """, (old_bakfile.bakfile_loc,))
-            db_conn.commit()
+        with self.transaction() as db_conn:
             if new_bakfile:
-                os.remove(old_bakfile.bakfile_loc)
+                self.del_bakfile_entry(old_bakfile)
+                if not self.count_references(old_bakfile.bakfile_loc):
+                    self.call_after_commit(
+                        lambda: os.remove(old_bakfile.bakfile_loc))
                 self.create_bakfile_entry(new_bakfile)
-            else:
-                self.create_bakfile_entry(old_bakfile)
-                self.set_restored_flag(old_bakfile, False)
+                return
+            db_conn.execute(
+                """
+                UPDATE bakfiles SET bakfile=:bakfile_loc,
+                                    date_modified=:modified,
+                                    restored=0,
+                                    content_hash=:hash,
+                                    size=:size,
+                                    codec=:codec,
+                                    delta_base=:delta_base,
+                                    source_stat=:source_stat
+                WHERE id=:rowid
+                """, (str(old_bakfile.bakfile_loc),
+                      old_bakfile.date_modified,
+                      old_bakfile.content_hash,
+                      old_bakfile.size,
+                      old_bakfile.codec,
+                      old_bakfile.delta_base,
+                      old_bakfile.source_stat,
+                      old_bakfile.rowid))
+        old_bakfile.restored = False
+
+    def set_storage(self, bakfile: BakFile):
+        """ Records a new on-disk representation (location, codec, delta base)
+            of the same contents, e.g. after delta-compressing a bakfile
+        """
+        with self.transaction() as db_conn:
+            db_conn.execute(
+                """
+                UPDATE bakfiles SET bakfile=:bakfile_loc, codec=:codec, delta_base=:delta_base
+                WHERE id=:rowid
+                """, (str(bakfile.bakfile_loc), bakfile.codec, bakfile.delta_base, bakfile.rowid))
+
+    def set_content_hash(self, bakfile: BakFile, content_hash: str, size: int):
+        """ Records the hash of a bakfile created before bak stored them """
+        with self.transaction() as db_conn:
+            db_conn.execute(
+                """
+                UPDATE bakfiles SET content_hash=:hash, size=:size WHERE id=:rowid
+                """, (content_hash, size, bakfile.rowid))
+        bakfile.content_hash, bakfile.size = content_hash, size
+
+    def set_source_stat(self, bakfile: BakFile, source_stat: str):
+        """ Records that the original, with this stat signature, was found to
+            still hold the bakfile's contents
+        """
+        with self.transaction() as db_conn:
+            db_conn.execute(
+                """
+                UPDATE bakfiles SET source_stat=:source_stat WHERE id=:rowid
+                """, (source_stat, bakfile.rowid))
+        bakfile.source_stat = source_stat
 
     def set_restored_flag(self, bakfile, status=True):
-        with sqlite3.connect(self.db_loc) as db_conn:
+        with self.transaction() as db_conn:
             db_conn.execute(
                 """
-                UPDATE bakfiles SET restored=:status WHERE bakfile=:bakfile_loc
-                """, (status, bakfile.bakfile_loc)
+                UPDATE bakfiles SET restored=:status WHERE id=:rowid
+                """, (status, bakfile.rowid)
             )
 
     # TODO handle disambiguation
     def get_bakfile_entries(self, filename):
-        with sqlite3.connect(self.db_loc) as db_conn:
+        cursor = self.db_conn.execute(
+            f"""
+                SELECT {self.ENTRY_COLUMNS} FROM bakfiles
+                WHERE original_abspath=:orig ORDER BY date_created
+            """, (os.path.abspath(os.path.expanduser(filename)),))
+        return [BakFile(*entry) for entry in cursor] or None
+
+    def iter_entries(self, filename=None):
+        """ Every entry (or `filename`'s), ordered by file, then creation,
+            as BakFiles made one at a time off the cursor, rather than all
+            at once.
+        """
+        where = "WHERE original_abspath=:orig" if filename else ""
+        cursor = self.db_conn.execute(
+            f"""
+                SELECT {self.ENTRY_COLUMNS} FROM bakfiles {where}
+                ORDER BY original_abspath, date_created, id
+            """, {'orig': os.path.abspath(os.path.expanduser(filename)) if filename else None})
+        for entry in cursor:
+            yield BakFile(*entry)
+
+    def iter_list_rows(self, filename=None):
+        """ `bak list`, in display order: the entries for `filename` (or every
+            file) as raw rows (in ENTRY_COLUMNS order), each with flags marking
+            its file's oldest and newest .bakfile by modification date, as
+            (row, oldest, newest).
+
+            The index on (original_abspath, date_created) already has this
+            order, so SQLite sorts nothing and rows stream off the cursor.
+            One file's rows are held at a time, to find its oldest and newest,
+            so memory follows the longest history, not the size of the store.
+        """
+        where = "WHERE original_abspath=:orig" if filename else ""
+        cursor = self.db_conn.execute(
+            f"""
+                SELECT {self.ENTRY_COLUMNS} FROM bakfiles {where}
+                ORDER BY original_abspath, date_created, id
+            """, {'orig': os.path.abspath(os.path.expanduser(filename)) if filename else None})
+        for _, rows in groupby(cursor, key=itemgetter(1)):
+            rows = list(rows)
+            # Ties go to the lowest id
+            oldest = min(rows, key=itemgetter(4, 6))[6]
+            newest = max(rows, key=lambda row: (row[4], -row[6]))[6]
+            for row in rows:
+                yield row, row[6] == oldest, row[6] == newest
+
+    def iter_list_entries(self, filename=None):
+        """ iter_list_rows(), with BakFiles for rows """
+        for row, oldest, newest in self.iter_list_rows(filename):
+            yield BakFile(*row), oldest, newest
+
+    # region snapshots
+    def create_snapshot(self, root: Path, date_created: datetime):
+        """ Starts a directory snapshot; its entries refer to the returned id """
+        with self.transaction() as db_conn:
             cursor = db_conn.execute(
                 """
-                    SELECT * FROM bakfiles WHERE original_abspath=:orig ORDER BY date_created
-                """, (os.path.abspath(os.path.expanduser(filename)),))
-            return [BakFile(*entry) for entry in cursor.fetchall()] or None
+                INSERT INTO snapshots (root, date_created) VALUES (:root, :created)
+                """, (str(root), date_created))
+            return cursor.lastrowid
+
+    def get_snapshots(self, root: (Path, None) = None):
+        """ Snapshots of `root` (or of every directory), oldest first within
+            each directory, as (id, root, date_created, number of files)
+        """
+        where = "WHERE root=:root" if root else ""
+        cursor = self.db_conn.execute(
+            f"""
+                SELECT snapshots.id, root, snapshots.date_created,
+                       (SELECT COUNT(*) FROM bakfiles WHERE snapshot=snapshots.id)
+                FROM snapshots {where}
+                ORDER BY root, date_created, id
+            """, {'root': str(root) if root else None})
+        return cursor.fetchall()
+
+    def get_snapshot_entries(self, snapshot_id: int):
+        cursor = self.db_conn.execute(
+            f"""
+                SELECT {self.ENTRY_COLUMNS} FROM bakfiles
+                WHERE snapshot=:snapshot ORDER BY original_abspath
+            """, (snapshot_id,))
+        return [BakFile(*entry) for entry in cursor]
+
+    def del_empty_snapshots(self):
+        """ Forgets snapshots whose .bakfiles have all been deleted """
+        with self.transaction() as db_conn:
+            db_conn.execute(
+                """
+                DELETE FROM snapshots
+                WHERE NOT EXISTS (SELECT 1 FROM bakfiles WHERE snapshot=snapshots.id)
+                """)
+    # endregion
+
+    # region pruning
+    # strftime() formats of the time buckets for keep_hourly etc.
+    PRUNE_BUCKETS = {'hourly': '%Y-%m-%d %H', 'daily': '%Y-%m-%d', 'weekly': '%Y-%W'}
+
+    def __prune_scope_query(self, policy: dict, scope: str):
+        """ SELECT of the ids in `scope` that `policy` prunes, or None if it
+            prunes nothing. A file's newest entry is never pruned.
+        """
+        keep = ["rn <= :keep_last"] if policy.get('keep_last') else []
+        keep += [f"({bucket}_rn = 1 AND {bucket}_rank <= :keep_{bucket})"
+                 for bucket in self.PRUNE_BUCKETS if policy.get(f'keep_{bucket}')]
+        drop = [f"NOT ({' OR '.join(keep)})"] if keep else []
+        if policy.get('cutoff'):
+            drop.append("date_created < :cutoff")
+        if policy.get('max_bytes_per_file'):
+            drop.append("file_bytes > :max_bytes_per_file")
+        if not drop:
+            return None
+        newest_first = "PARTITION BY original_abspath ORDER BY date_created DESC, id DESC"
+        buckets = ",".join(
+            f"""
+                ROW_NUMBER() OVER (PARTITION BY original_abspath, strftime('{fmt}', date_created)
+                                   ORDER BY date_created DESC, id DESC) AS {bucket}_rn,
+                DENSE_RANK() OVER (PARTITION BY original_abspath
+                                   ORDER BY strftime('{fmt}', date_created) DESC) AS {bucket}_rank"""
+            for bucket, fmt in self.PRUNE_BUCKETS.items())
+        return f"""
+            SELECT id FROM (
+                SELECT id, date_created,
+                       ROW_NUMBER() OVER ({newest_first}) AS rn,
+                       SUM(COALESCE(size, 0)) OVER ({newest_first}
+                                                    ROWS UNBOUNDED PRECEDING) AS file_bytes,
+                       {buckets}
+                FROM bakfiles WHERE {scope})
+            WHERE rn > 1 AND ({' OR '.join(drop)})
+            """
+
+    def plan_prune(self, policies, max_bytes: (int, None) = None, filenames=None):
+        """ Works out, in SQL, which entries retention policies would remove.
+
+        Arguments:
+            policies: [(glob pattern, policy)], most specific first; the last
+                      pattern should be None, for everything else. Policies are
+                      dicts with keep_last, keep_hourly, keep_daily, keep_weekly,
+                      cutoff (a datetime) and max_bytes_per_file, any of them None.
+            max_bytes: cap on the whole store, trimming oldest entries first
+                       once the policies are applied. Ignored with `filenames`.
+            filenames: only prune these files' entries
+
+        Returns:
+            (list, list): the BakFiles to remove, and the bakfiles no entry
+                          refers to afterwards
+        """
+        if sqlite3.sqlite_version_info < (3, 25, 0):
+            raise sqlite3.NotSupportedError("bak prune needs SQLite 3.25 or newer")
+        params = {}
+        restrict = "1"
+        if filenames:
+            params.update({f'file{i}': os.path.abspath(os.path.expanduser(filename))
+                           for i, filename in enumerate(filenames)})
+            restrict = f"original_abspath IN ({', '.join(':file%d' % i for i in range(len(filenames)))})"
+        with self.transaction() as db_conn:
+            db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS prune_plan (id INTEGER PRIMARY KEY)")
+            db_conn.execute("DELETE FROM prune_plan")
+            earlier = []
+            for i, (pattern, policy) in enumerate(policies):
+                scope = [restrict] + [f"NOT original_abspath GLOB :pattern{j}" for j in earlier]
+                if pattern is not None:
+                    scope.append(f"original_abspath GLOB :pattern{i}")
+                    params[f'pattern{i}'] = pattern
+                    earlier.append(i)
+                query = self.__prune_scope_query(policy, " AND ".join(scope))
+                if query:
+                    db_conn.execute(f"INSERT OR IGNORE INTO prune_plan {query}",
+                                    {**params, **policy})
+            if max_bytes and not filenames:
+                db_conn.execute(
+                    """
+                    INSERT OR IGNORE INTO prune_plan
+                    SELECT id FROM (
+                        SELECT id,
+                               ROW_NUMBER() OVER (PARTITION BY original_abspath
+                                                  ORDER BY date_created DESC, id DESC) AS rn,
+                               SUM(COALESCE(size, 0)) OVER (ORDER BY date_created DESC, id DESC
+                                                            ROWS UNBOUNDED PRECEDING) AS total
+                        FROM bakfiles WHERE id NOT IN (SELECT id FROM prune_plan))
+                    WHERE rn > 1 AND total > :max_bytes
+                    """, {'max_bytes': max_bytes})
+            entries = [BakFile(*entry) for entry in db_conn.execute(
+                f"""
+                SELECT {self.ENTRY_COLUMNS} FROM bakfiles WHERE id IN (SELECT id FROM prune_plan)
+                ORDER BY original_abspath, date_created
+                """)]
+            orphans = [Path(row[0]) for row in db_conn.execute(
+                """
+                SELECT bakfile FROM bakfiles WHERE id IN (SELECT id FROM prune_plan)
+                GROUP BY bakfile
+                HAVING COUNT(*) = (SELECT COUNT(*) FROM bakfiles AS b
+                                   WHERE b.bakfile = bakfiles.bakfile)
+                """)]
+            db_conn.execute("DROP TABLE prune_plan")
+        return entries, orphans
+
+    def del_bakfile_entries(self, entries):
+        """ Deletes many entries at once, by id """
+        ids = [entry.rowid for entry in entries]
+        with self.transaction() as db_conn:
+            for start in range(0, len(ids), self.MAX_SQL_VARIABLES):
+                chunk = ids[start:start + self.MAX_SQL_VARIABLES]
+                db_conn.execute(f"DELETE FROM bakfiles WHERE id IN ({', '.join('?' * len(chunk))})",
+                                chunk)
+
+    def unreferenced_bakfiles(self, bakfile_locs):
+        """ Those of `bakfile_locs` that no entry points at """
+        locs = list({str(loc) for loc in bakfile_locs})
+        referenced = set()
+        for start in range(0, len(locs), self.MAX_SQL_VARIABLES):
+            chunk = locs[start:start + self.MAX_SQL_VARIABLES]
+            referenced.update(row[0] for row in self.db_conn.execute(
+                f"SELECT DISTINCT bakfile FROM bakfiles WHERE bakfile IN ({', '.join('?' * len(chunk))})",
+                chunk))
+        return [Path(loc) for loc in locs if loc not in referenced]
+    # endregion
+
+    # region removing whole files
+    REMOVAL_TABLES = ('removal_plan', 'removal_paths', 'removal_prefixes')
+
+    def __plan_removal(self, db_conn, paths, prefixes, patterns):
+        """ Fills the temp table removal_plan with the ids of the entries of
+            `paths`, of every file under the directories `prefixes`, and of
+            files matching the GLOB `patterns`. Paths and prefixes go in
+            temp tables of their own, so there's no limit on how many.
+        """
+        db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS removal_plan (id INTEGER PRIMARY KEY)")
+        db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS removal_paths (path TEXT PRIMARY KEY)")
+        db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS removal_prefixes (lo TEXT, hi TEXT)")
+        for table in self.REMOVAL_TABLES:
+            db_conn.execute(f"DELETE FROM {table}")
+        db_conn.executemany("INSERT OR IGNORE INTO removal_paths VALUES (?)",
+                            ((str(path),) for path in paths))
+        # Everything under /a/b sorts between '/a/b/' and '/a/b0' ('0' follows '/'),
+        # so each prefix is one range scan of the index
+        db_conn.executemany("INSERT INTO removal_prefixes VALUES (?, ?)",
+                            ((f"{str(prefix).rstrip('/')}/", f"{str(prefix).rstrip('/')}0")
+                             for prefix in prefixes))
+        db_conn.execute(
+            """
+            INSERT OR IGNORE INTO removal_plan
+            SELECT id FROM bakfiles WHERE original_abspath IN (SELECT path FROM removal_paths)
+            """)
+        db_conn.execute(
+            """
+            INSERT OR IGNORE INTO removal_plan
+            SELECT bakfiles.id FROM removal_prefixes
+            JOIN bakfiles ON original_abspath >= lo AND original_abspath < hi
+            """)
+        for pattern in patterns:
+            db_conn.execute(
+                """
+                INSERT OR IGNORE INTO removal_plan
+                SELECT id FROM bakfiles WHERE original_abspath GLOB :pattern
+                """, (str(pattern),))
+
+    def count_entries_of(self, paths=(), prefixes=(), patterns=()):
+        """ How many entries, and of how many files, del_entries_of() would
+            remove
+
+        Returns:
+            (int, int)
+        """
+        with self.transaction() as db_conn:
+            self.__plan_removal(db_conn, paths, prefixes, patterns)
+            counts = db_conn.execute(
+                """
+                SELECT COUNT(*), COUNT(DISTINCT original_abspath) FROM bakfiles
+                WHERE id IN (SELECT id FROM removal_plan)
+                """).fetchone()
+            self.__drop_removal_plan(db_conn)
+        return counts
+
+    def del_entries_of(self, paths=(), prefixes=(), patterns=()):
+        """ Deletes every entry of the files `paths`, of every file under the
+            directories `prefixes`, and of files matching the GLOB `patterns`
+            (where * matches / too), in a handful of statements. Whole files'
+            histories go, so no remaining entry can be a delta against them.
+
+        Returns:
+            (int, list): how many entries were deleted, and the bakfiles no
+                         entry refers to anymore
+        """
+        with self.transaction() as db_conn:
+            self.__plan_removal(db_conn, paths, prefixes, patterns)
+            orphans = [Path(row[0]) for row in db_conn.execute(
+                """
+                SELECT bakfile FROM bakfiles WHERE id IN (SELECT id FROM removal_plan)
+                GROUP BY bakfile
+                HAVING COUNT(*) = (SELECT COUNT(*) FROM bakfiles AS b
+                                   WHERE b.bakfile = bakfiles.bakfile)
+                """)]
+            in_snapshots = db_conn.execute(
+                """
+                SELECT 1 FROM bakfiles
+                WHERE id IN (SELECT id FROM removal_plan) AND snapshot IS NOT NULL LIMIT 1
+                """).fetchone()
+            removed = db_conn.execute(
+                "DELETE FROM bakfiles WHERE id IN (SELECT id FROM removal_plan)").rowcount
+            if in_snapshots:
+                self.del_empty_snapshots()
+            self.__drop_removal_plan(db_conn)
+        return removed, orphans
+
+    def __drop_removal_plan(self, db_conn):
+        for table in self.REMOVAL_TABLES:
+            db_conn.execute(f"DROP TABLE {table}")
+    # endregion
+
+    def get_bakfile_locs(self):
+        """ Every bakfile location in use, once each """
+        cursor = self.db_conn.execute("SELECT DISTINCT bakfile FROM bakfiles ORDER BY bakfile")
+        return [row[0] for row in cursor.fetchall()]
+
+    def move_bakfiles(self, moves):
+        """ Points every entry using each old location at the new one.
+            `moves` are (old, new) pairs.
+        """
+        with self.transaction() as db_conn:
+            db_conn.executemany("UPDATE bakfiles SET bakfile=:new WHERE bakfile=:old",
+                                ({'old': str(old), 'new': str(new)} for old, new in moves))
 
     def get_all_entries(self):
-        with sqlite3.connect(self.db_loc) as db_conn:
-            cursor = db_conn.execute(
-                "SELECT * FROM bakfiles ORDER BY original_abspath, date_created")
-            return [BakFile(*entry) for entry in cursor.fetchall()]
+        return list(self.iter_entries())
+
+
+# region migrations
+def _create_v2_table(db_conn, table_name='bakfiles'):
+    db_conn.execute(f"""
+                    CREATE TABLE {table_name} (
+                        id INTEGER PRIMARY KEY,
+                        original_file TEXT NOT NULL,
+                        original_abspath TEXT NOT NULL,
+                        bakfile TEXT NOT NULL,
+                        date_created TEXT NOT NULL,
+                        date_modified TEXT NOT NULL,
+                        restored INTEGER NOT NULL DEFAULT 0)
+                    """)
+
+
+def _migrate_to_v2(db_conn):
+    """ Typed columns, an integer primary key and indexes. Rows from an
+        unversioned database keep their rowids as ids.
+    """
+    legacy_cols = [row[1] for row in
+                   db_conn.execute("PRAGMA table_info(bakfiles)").fetchall()]
+    if legacy_cols:
+        _create_v2_table(db_conn, 'bakfiles_v2')
+
+        def legacy(col, default):
+            return f"COALESCE({col}, {default})" if col in legacy_cols else default
+        db_conn.execute(f"""
+                        INSERT INTO bakfiles_v2 (id, original_file, original_abspath, bakfile,
+                                                 date_created, date_modified, restored)
+                        SELECT rowid,
+                               {legacy('original_file', "''")},
+                               {legacy('original_abspath', "''")},
+                               {legacy('bakfile', "''")},
+                               {legacy('date_created', "''")},
+                               {legacy('date_modified', legacy('date_created', "''"))},
+                               {legacy('restored', '0')}
+                        FROM bakfiles
+                        """)
+        db_conn.execute("DROP TABLE bakfiles")
+        db_conn.execute("ALTER TABLE bakfiles_v2 RENAME TO bakfiles")
+    else:
+        _create_v2_table(db_conn)
+    db_conn.execute("""CREATE INDEX bakfiles_by_original_abspath
+                       ON bakfiles (original_abspath, date_created)""")
+    db_conn.execute("CREATE INDEX bakfiles_by_bakfile ON bakfiles (bakfile)")
+    db_conn.execute("CREATE INDEX bakfiles_by_date_created ON bakfiles (date_created)")
+
+
+def _migrate_to_v3(db_conn):
+    """ Content hashes and sizes. Existing rows are hashed lazily, when needed. """
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN content_hash TEXT")
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN size INTEGER")
+
+
+def _migrate_to_v4(db_conn):
+    """ Compression codecs. Existing bakfiles are stored raw. """
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN codec TEXT")
+
+
+def _migrate_to_v5(db_conn):
+    """ Reverse-delta version chains """
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN delta_base INTEGER REFERENCES bakfiles(id)")
+    db_conn.execute("CREATE INDEX bakfiles_by_delta_base ON bakfiles (delta_base)")
+
+
+def _migrate_to_v6(db_conn):
+    """ Directory snapshots (`bak -r`), grouping one entry per file """
+    db_conn.execute("""
+                    CREATE TABLE snapshots (
+                        id INTEGER PRIMARY KEY,
+                        root TEXT NOT NULL,
+                        date_created TEXT NOT NULL)
+                    """)
+    db_conn.execute("CREATE INDEX snapshots_by_root ON snapshots (root, date_created)")
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN snapshot INTEGER REFERENCES snapshots(id)")
+    db_conn.execute("CREATE INDEX bakfiles_by_snapshot ON bakfiles (snapshot)")
+
+
+def _migrate_to_v7(db_conn):
+    """ Tree hashes (see bak_hash): contents of more than one 16 MiB segment
+        no longer hash to their plain sha256, so those hashes are dropped,
+        to be worked out again when next needed
+    """
+    db_conn.execute("UPDATE bakfiles SET content_hash=NULL WHERE size IS NULL OR size > :segment",
+                    {'segment': 16 * 1024 * 1024})
+
+
+def _migrate_to_v8(db_conn):
+    """ Stat signatures of originals, to skip reading unchanged files.
+        Existing entries learn theirs the next time they're compared.
+    """
+    db_conn.execute("ALTER TABLE bakfiles ADD COLUMN source_stat TEXT")
+
+
+# (version, migration) pairs, applied in order to databases older than `version`
+MIGRATIONS = [(2, _migrate_to_v2),
+              (3, _migrate_to_v3),
+              (4, _migrate_to_v4),
+              (5, _migrate_to_v5),
+              (6, _migrate_to_v6),
+              (7, _migrate_to_v7),
+              (8, _migrate_to_v8)]
+# endregion
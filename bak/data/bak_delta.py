@@ -0,0 +1,55 @@
+""" Line-based reverse deltas, modeled on RCS.
+
+    The newest version of a file is kept in full. Older versions are stored
+    as edit scripts against their successor: runs of lines to copy from the
+    successor, and literal lines to add. A delta looks like:
+
+        BAKDELTA1
+        c 0 12          copy lines [0, 12) of the base
+        a 2             add the next 2 lines verbatim
+        <line>
+        <line>
+        c 14 40
+"""
+from difflib import SequenceMatcher
+from typing import BinaryIO, List
+
+DELTA_MAGIC = b'BAKDELTA1\n'
+BINARY_SNIFF_SIZE = 8192
+
+
+def is_text(sample: bytes):
+    """ Deltas only make sense for line-oriented text """
+    return b'\0' not in sample[:BINARY_SNIFF_SIZE]
+
+
+def make_delta(base_lines: List[bytes], target_lines: List[bytes]) -> bytes:
+    """ Edit script that rebuilds `target_lines` from `base_lines`.
+        Lines are bytes, line endings included (as from readlines()).
+    """
+    delta = [DELTA_MAGIC]
+    matcher = SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(b'c %d %d\n' % (i1, i2))
+        elif tag in ('replace', 'insert'):
+            delta.append(b'a %d\n' % (j2 - j1))
+            delta.extend(target_lines[j1:j2])
+    return b''.join(delta)
+
+
+def apply_delta(base_lines: List[bytes], delta: BinaryIO) -> List[bytes]:
+    """ Rebuilds a version from its successor's lines and its delta stream
+    """
+    if delta.readline() != DELTA_MAGIC:
+        raise ValueError("Not a bak delta")
+    lines = []
+    for operation in iter(delta.readline, b''):
+        kind, *args = operation.split()
+        if kind == b'c':
+            lines.extend(base_lines[int(args[0]):int(args[1])])
+        elif kind == b'a':
+            lines.extend(delta.readline() for _ in range(int(args[0])))
+        else:
+            raise ValueError(f"Corrupt bak delta: {operation!r}")
+    return lines
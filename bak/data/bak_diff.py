@@ -0,0 +1,157 @@
+""" bak's built-in diff (bak_diff_exec: builtin), for when forking diff(1)
+    isn't worth it.
+
+    Files are memory-mapped. Their common head and tail are found by
+    comparing the maps directly, so only the lines in between (plus a little
+    context) are ever split up and handed to difflib. Output is unified
+    diff hunks, like `diff -u`, yielded a line at a time.
+"""
+import mmap
+import os
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from itertools import chain
+from pathlib import Path
+from typing import Iterator
+
+from .bak_delta import BINARY_SNIFF_SIZE, is_text
+
+CONTEXT_LINES = 3
+COMPARE_CHUNK = 1024 * 1024
+NO_NEWLINE = b'\\ No newline at end of file\n'
+
+
+@contextmanager
+def mapped(path: Path):
+    """ Read-only mmap of `path`. Empty files (which can't be mapped) are b'' """
+    with open(path, 'rb') as _file:
+        if not os.fstat(_file.fileno()).st_size:
+            yield b''
+            return
+        with mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as _map:
+            yield _map
+
+
+def is_text_file(path: Path) -> bool:
+    with open(path, 'rb') as _file:
+        return is_text(_file.read(BINARY_SNIFF_SIZE))
+
+
+def _common_prefix(old, new) -> int:
+    """ Length of the longest common prefix of two buffers, in bytes """
+    limit = min(len(old), len(new))
+    pos = 0
+    for chunk in (COMPARE_CHUNK, 4096, 1):
+        while pos + chunk <= limit and old[pos:pos + chunk] == new[pos:pos + chunk]:
+            pos += chunk
+    return pos
+
+
+def _common_suffix(old, new, limit: int) -> int:
+    """ Length of the longest common suffix, up to `limit` bytes """
+    old_len, new_len = len(old), len(new)
+    length = 0
+    for chunk in (COMPARE_CHUNK, 4096, 1):
+        while length + chunk <= limit and \
+                old[old_len - length - chunk:old_len - length] == \
+                new[new_len - length - chunk:new_len - length]:
+            length += chunk
+    return length
+
+
+def _count_lines(buf, end: int) -> int:
+    return sum(buf[i:min(i + COMPARE_CHUNK, end)].count(b'\n')
+               for i in range(0, end, COMPARE_CHUNK))
+
+
+def _back_lines(buf, pos: int, count: int) -> int:
+    """ Start of the line `count` lines before the one starting at `pos` """
+    for _ in range(count):
+        if pos <= 0:
+            break
+        pos = buf.rfind(b'\n', 0, pos - 1) + 1
+    return pos
+
+
+def _forward_lines(buf, pos: int, count: int) -> int:
+    """ Start of the line `count` lines after the one starting at `pos` """
+    for _ in range(count):
+        if pos >= len(buf):
+            break
+        newline = buf.find(b'\n', pos)
+        pos = len(buf) if newline < 0 else newline + 1
+    return pos
+
+
+def _format_range(start: int, stop: int) -> str:
+    """ As in difflib.unified_diff(): 'start,length', 1-based """
+    beginning, length = start + 1, stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def _hunk_lines(tag: bytes, lines):
+    for line in lines:
+        yield tag + line
+        if not line.endswith(b'\n'):
+            yield b'\n' + NO_NEWLINE
+
+
+def diff_hunks(old_path: Path, new_path: Path, context: int = CONTEXT_LINES) -> Iterator[bytes]:
+    """ Unified diff hunks (everything after the ---/+++ header) turning
+        `old_path` into `new_path`. Yields nothing if they're identical.
+    """
+    with mapped(old_path) as old, mapped(new_path) as new:
+        prefix = _common_prefix(old, new)
+        if prefix == len(old) == len(new):
+            return
+        # Work in whole lines: back up to the start of the first changed line,
+        # and move the common tail forward to the start of a line
+        prefix = old.rfind(b'\n', 0, prefix) + 1 if prefix else 0
+        suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
+        old_end = len(old) - suffix
+        if old_end and old[old_end - 1:old_end] != b'\n':
+            old_end = _forward_lines(old, old_end, 1)
+        new_end = len(new) - (len(old) - old_end)
+
+        # Some unchanged lines on either side, for context
+        start = _back_lines(old, prefix, context)
+        first_line = _count_lines(old, start)
+        old_stop = _forward_lines(old, old_end, context)
+        new_stop = new_end + (old_stop - old_end)
+        old_lines = old[start:old_stop].splitlines(keepends=True)
+        new_lines = new[start:new_stop].splitlines(keepends=True)
+
+    matcher = SequenceMatcher(None, old_lines, new_lines)
+    for group in matcher.get_grouped_opcodes(context):
+        first, last = group[0], group[-1]
+        yield (f"@@ -{_format_range(first_line + first[1], first_line + last[2])} "
+               f"+{_format_range(first_line + first[3], first_line + last[4])} @@\n").encode()
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                yield from _hunk_lines(b' ', old_lines[i1:i2])
+                continue
+            yield from _hunk_lines(b'-', old_lines[i1:i2])
+            yield from _hunk_lines(b'+', new_lines[j1:j2])
+
+
+def unified_diff(old_path: Path, new_path: Path,
+                 old_label: str, new_label: str,
+                 hunks: Iterator[bytes] = None) -> Iterator[bytes]:
+    """ `diff -u old_path new_path`, a line at a time, labelled like
+        `--- old_label`. Pass `hunks` to reuse ones computed (or cached)
+        earlier.
+    """
+    if not (is_text_file(old_path) and is_text_file(new_path)):
+        yield f"Binary files {old_label} and {new_label} differ\n".encode()
+        return
+    hunks = iter(hunks if hunks is not None else diff_hunks(old_path, new_path))
+    first = next(hunks, None)
+    if first is None:
+        return
+    yield f"--- {old_label}\n".encode()
+    yield f"+++ {new_label}\n".encode()
+    yield from chain([first], hunks)
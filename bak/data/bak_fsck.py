@@ -0,0 +1,116 @@
+""" The filesystem half of `bak fsck`: listing what's actually in bak_dir,
+    and re-hashing stored contents in worker processes. Nothing here touches
+    the database; commands.bak_fsck_cmd() reconciles the two.
+"""
+import lzma
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from . import bak_delta, bak_hash, bak_store
+
+# Half-written bakfiles are hidden '.tmp' files (see bak_store.temp_path()).
+# Files changed more recently than this may belong to a bak that's still
+# running, so fsck leaves them alone.
+GRACE_PERIOD = 10 * 60
+# Magic numbers of the codecs' containers, for bakfiles with no DB entry
+CODEC_MAGIC = {b'\x1f\x8b': 'zlib', b'BZh': 'bz2', b'\xfd7zXZ\x00': 'lzma'}
+
+
+def is_tmp_file(name: str) -> bool:
+    return name.startswith('.') and name.endswith('.tmp')
+
+
+def scan_store(bak_dir: Path, skip=()):
+    """ Lists every file under `bak_dir` with os.scandir(), without following
+        symlinks. Paths in `skip` (files or directories) are left out.
+
+    Returns:
+        (dict, set, list): {path: size on disk} of stored files, those of
+                           them changed within GRACE_PERIOD, and the stale
+                           temporary files left behind by interrupted writes
+    """
+    skip = {str(path) for path in skip}
+    files, recent, stale = {}, set(), []
+    now = time.time()
+    pending = [str(bak_dir)]
+    while pending:
+        try:
+            scanner = os.scandir(pending.pop())
+        except FileNotFoundError:
+            continue
+        with scanner:
+            for entry in scanner:
+                if entry.path in skip:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if now - stat.st_ctime < GRACE_PERIOD:
+                    recent.add(entry.path)
+                if not is_tmp_file(entry.name):
+                    files[entry.path] = stat.st_size
+                elif entry.path not in recent:
+                    stale.append(Path(entry.path))
+    return files, recent, stale
+
+
+def sniff_codec(path: Path):
+    """ The codec a bakfile was written with, going by its first bytes """
+    with open(path, 'rb') as _file:
+        head = _file.read(6)
+    for magic, codec in CODEC_MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def rehash(chain):
+    """ Reads a version back the way `bak down` would and hashes it.
+
+    Arguments:
+        chain: ((bakfile_loc, codec), ...), the full version first, then any
+               reverse deltas to apply to it, in order
+
+    Returns:
+        (str|None, int, int, str|None): content hash and size of the contents,
+            bytes read from disk, and an error message if it couldn't be read
+    """
+    read = 0
+    try:
+        for loc, _ in chain:
+            read += os.stat(loc).st_size
+        (loc, codec), deltas = chain[0], chain[1:]
+        if not deltas and codec is None:
+            return (*bak_hash.hash_file(loc), read, None)
+        with bak_store.open_bakfile(loc, codec) as _file:
+            if not deltas:
+                return (*bak_store.hash_stream(_file), read, None)
+            lines = _file.readlines()
+        for loc, codec in deltas:
+            with bak_store.open_bakfile(loc, codec) as _delta:
+                lines = bak_delta.apply_delta(lines, _delta)
+    except FileNotFoundError as error:
+        return None, 0, read, f"missing {error.filename}"
+    except (OSError, EOFError, ValueError, lzma.LZMAError, zlib.error) as error:
+        # Truncated or mangled compressed streams, corrupt deltas
+        return None, 0, read, str(error) or type(error).__name__
+    data = b''.join(lines)
+    return bak_hash.hash_bytes(data), len(data), read, None
+
+
+def rehash_all(chains, jobs: int):
+    """ rehash() for each of `chains`, across `jobs` processes, so hashing
+        isn't bound to one core. Yields (chain, result), in order.
+    """
+    if jobs <= 1 or len(chains) < 2:
+        for chain in chains:
+            yield chain, rehash(chain)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # Most bakfiles are small; hand them out a few at a time
+        chunksize = max(1, min(64, len(chains) // (jobs * 4)))
+        yield from zip(chains, pool.map(rehash, chains, chunksize=chunksize))
@@ -0,0 +1,103 @@
+""" Content hashes, for telling whether a file changed (create, `bak up`,
+    `--compare`), for dedup, and for fsck.
+
+    Contents are split into SEGMENT_SIZE segments, each hashed with sha256.
+    A single segment's hash is the hash, so anything up to SEGMENT_SIZE
+    hashes to its plain sha256, as it always has. Longer contents hash to
+    sha256(TREE_PREFIX + the segments' digests), and that's what lets large
+    files be hashed in parallel: they're memory-mapped, and their segments
+    handed to threads (hashlib lets go of the GIL while it hashes), so a
+    big file is read at disk speed rather than one core's sha256 speed.
+"""
+import hashlib
+import mmap
+import os
+from pathlib import Path
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Keeps tree hashes from colliding with plain sha256es of other contents
+TREE_PREFIX = b'bak-tree-sha256\0'
+READ_SIZE = 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+class TreeHash:
+    """ Incremental hash of a stream, for when contents only come a chunk at
+        a time (compressed bakfiles, copies being written). Same result as
+        hash_file(), one segment after another.
+    """
+
+    def __init__(self):
+        self.leaves = []
+        self.segment = hashlib.sha256()
+        self.segment_size = 0
+        self.size = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        self.size += len(view)
+        while view:
+            if self.segment_size == SEGMENT_SIZE:
+                self.leaves.append(self.segment.digest())
+                self.segment, self.segment_size = hashlib.sha256(), 0
+            take = view[:SEGMENT_SIZE - self.segment_size]
+            self.segment.update(take)
+            self.segment_size += len(take)
+            view = view[len(take):]
+
+    def hexdigest(self) -> str:
+        if not self.leaves:
+            return self.segment.hexdigest()
+        return combine(self.leaves + [self.segment.digest()])
+
+
+def combine(leaves) -> str:
+    """ The tree hash of contents whose segments have the digests `leaves` """
+    if len(leaves) == 1:
+        return leaves[0].hex()
+    return hashlib.sha256(TREE_PREFIX + b''.join(leaves)).hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    tree_hash = TreeHash()
+    tree_hash.update(data)
+    return tree_hash.hexdigest()
+
+
+def hash_stream(_file):
+    """ Hash and size of what's left of a binary stream """
+    tree_hash = TreeHash()
+    for chunk in iter(lambda: _file.read(READ_SIZE), b''):
+        tree_hash.update(chunk)
+    return tree_hash.hexdigest(), tree_hash.size
+
+
+def _hash_segment(view) -> bytes:
+    try:
+        return hashlib.sha256(view).digest()
+    finally:
+        view.release()
+
+
+def hash_file(filename: Path, workers: int = HASH_WORKERS):
+    """ Hash and size of `filename`'s contents. Files of more than one
+        segment are mapped and their segments hashed across `workers`
+        threads.
+    """
+    with open(filename, 'rb') as _file:
+        size = os.fstat(_file.fileno()).st_size
+        if size <= SEGMENT_SIZE or workers <= 1:
+            return hash_stream(_file)
+        with mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as _map:
+            if hasattr(_map, 'madvise'):
+                _map.madvise(mmap.MADV_SEQUENTIAL)
+            size = len(_map)
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Each segment's view is released as soon as it's hashed; the map
+            # can't be closed while any are still around
+            with memoryview(_map) as view, ThreadPoolExecutor(max_workers=workers) as pool:
+                leaves = list(pool.map(_hash_segment,
+                                       (view[start:start + SEGMENT_SIZE]
+                                        for start in range(0, size, SEGMENT_SIZE))))
+    return combine(leaves), size
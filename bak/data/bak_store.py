@@ -0,0 +1,426 @@
+import bz2
+import gzip
+import hashlib
+import itertools
+import lzma
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from shutil import copyfileobj, copystat
+from tempfile import NamedTemporaryFile
+from time import time_ns
+
+from . import bak_copy, bak_hash
+
+HASH_CHUNK_SIZE = 1024 * 1024
+OBJECTS_DIRNAME = 'objects'
+# How bakfiles are arranged in bak_dir (see bakfile_path())
+LAYOUTS = ('flat', 'sharded')
+DELTA_SUFFIX = '.delta'
+
+# Stream codecs for compressed bakfiles: name -> (open for reading, open for
+# writing at a level). 'zlib' data is kept in a gzip container, so it can
+# be streamed with the stdlib's file classes (and read with zcat).
+CODECS = {
+    'zlib': (lambda path: gzip.open(path, 'rb'),
+             lambda _file, level: gzip.GzipFile(fileobj=_file, mode='wb', mtime=0,
+                                                compresslevel=6 if level is None else level)),
+    'bz2': (lambda path: bz2.open(path, 'rb'),
+            lambda _file, level: bz2.BZ2File(_file, 'wb',
+                                             compresslevel=9 if level is None else level)),
+    'lzma': (lambda path: lzma.open(path, 'rb'),
+             lambda _file, level: lzma.LZMAFile(_file, 'wb', preset=level)),
+}
+CODEC_ALIASES = {'gzip': 'zlib', 'xz': 'lzma'}
+# The compression levels (presets, for lzma) each codec takes
+CODEC_LEVELS = {'zlib': range(0, 10), 'bz2': range(1, 10), 'lzma': range(0, 10)}
+# A sample of the file is test-compressed first. If it shrinks by less than
+# this, it's stored raw, rather than spending CPU on a larger file.
+COMPRESSIBILITY_SAMPLE = 64 * 1024
+MIN_COMPRESSION_RATIO = 0.9
+# Raw files at least this big go through bak_copy's fast paths (reflinks,
+# in-kernel copies) and are hashed lazily; smaller ones are hashed as they're
+# copied, which costs next to nothing.
+FAST_COPY_MIN_SIZE = 8 * 1024 * 1024
+
+# (abspath, st_dev, st_ino, st_size, st_mtime_ns) -> content hash
+_hash_cache = {}
+# How hard bakfiles are pushed to disk before their entries are committed;
+# see Durability
+DURABILITY_MODES = ('none', 'per-file', 'group')
+_temp_names = itertools.count()
+# Files changed this recently (in ns) may yet change again within the same
+# timestamp tick, so their stat signatures aren't trusted; 2s covers FAT
+RACY_WINDOW_NS = 2 * 1000 ** 3
+
+
+def normalize_codec(codec: (str, None)):
+    """ Canonical codec name, or None for raw storage. Raises KeyError for
+        codecs bak doesn't know.
+    """
+    if not codec or str(codec).lower() in ('none', 'null', 'raw'):
+        return None
+    codec = CODEC_ALIASES.get(codec.lower(), codec.lower())
+    if codec not in CODECS:
+        raise KeyError(codec)
+    return codec
+
+
+def hash_stream(_file):
+    """ Content hash (see bak_hash) and size of what's left of a binary stream
+    """
+    return bak_hash.hash_stream(_file)
+
+
+def hash_file(filename: Path) -> str:
+    """ Content hash of `filename`; large files are hashed in parallel
+    """
+    return bak_hash.hash_file(filename)[0]
+
+
+def hash_current_file(filename: Path, stat: os.stat_result = None) -> str:
+    """ hash_file() for files that may change under us, such as the original
+        of a bakfile. Each version is only read once per invocation.
+    """
+    stat = stat or os.stat(filename)
+    key = (str(filename), stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_cache:
+        _hash_cache[key] = hash_file(filename)
+    return _hash_cache[key]
+
+
+def stat_signature(stat: os.stat_result) -> str:
+    """ Identifies a version of a file without reading it: device, inode,
+        size, mtime and ctime. Anything that rewrites the file changes at
+        least its ctime.
+    """
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ctime_ns}"
+
+
+def settled_signature(stat: os.stat_result) -> (str, None):
+    """ stat_signature(), or None if the file changed too recently for its
+        timestamps to tell a later change apart (git's "racily clean" files).
+        `stat` has to be taken before the contents it vouches for are read.
+    """
+    if time_ns() - max(stat.st_mtime_ns, stat.st_ctime_ns) < RACY_WINDOW_NS:
+        return None
+    return stat_signature(stat)
+
+
+def forget_hashes():
+    """ Empties hash_current_file()'s cache, for long-running processes
+        (`bak watch`), where old versions' hashes would pile up
+    """
+    _hash_cache.clear()
+
+
+# region durability
+def temp_path(dest: Path) -> Path:
+    """ A hidden name next to `dest` to write it under, so that nothing is
+        ever half-written under its final name. Crashes leave these behind
+        for fsck to clean up (see bak_fsck.is_tmp_file()).
+    """
+    dest = Path(dest)
+    return dest.with_name(f".{dest.name}.{os.getpid()}-{next(_temp_names)}.tmp")
+
+
+def fsync_path(path: Path, directory: bool = False):
+    flags = os.O_RDONLY | (getattr(os, 'O_DIRECTORY', 0) if directory else 0)
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    """ Puts files written under temp_path()s in place, as durably as `mode`
+        asks (see DURABILITY_MODES):
+
+        'none': renames them as soon as they're written. A crash can't leave
+            a half-written file under its final name, but power loss can
+            lose files whose entries were already committed.
+        'per-file': fsyncs each file, renames it and fsyncs its directory,
+            before anything else happens.
+        'group': files wait under their temporary names until flush(), which
+            fsyncs them all (across `workers` threads, so the filesystem can
+            fold them into a few journal commits), renames them, then fsyncs
+            each directory once. The caller then commits their entries in one
+            transaction.
+
+        Either way, files are on disk before the entries pointing at them.
+        place() is safe to call from worker threads.
+    """
+
+    def __init__(self, mode: str = 'none', workers: int = 1):
+        self.mode = mode
+        self.workers = workers
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def place(self, tmp: Path, dest: Path):
+        if self.mode == 'group':
+            with self.lock:
+                self.pending.append((tmp, dest))
+            return
+        if self.mode == 'per-file':
+            fsync_path(tmp)
+        os.replace(tmp, dest)
+        if self.mode == 'per-file':
+            fsync_path(Path(dest).parent, directory=True)
+
+    def flush(self):
+        """ Puts a group's files in place. Nothing to do in other modes. """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            self._fsync_all([tmp for tmp, _ in pending])
+            for tmp, dest in pending:
+                os.replace(tmp, dest)
+        except BaseException:
+            self.pending = pending
+            self.discard()
+            raise
+        for directory in {Path(dest).parent for _, dest in pending}:
+            fsync_path(directory, directory=True)
+
+    def _fsync_all(self, paths):
+        if self.workers > 1 and len(paths) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(fsync_path, paths))
+        else:
+            for path in paths:
+                fsync_path(path)
+
+    def discard(self):
+        """ Deletes a group's files that haven't been put in place """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for tmp, _ in pending:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+
+
+# For callers with no opinion: atomic, not durable
+IMMEDIATE = Durability()
+# endregion
+
+
+def _compresses_well(sample: bytes):
+    if not sample:
+        return False
+    sample = sample[:COMPRESSIBILITY_SAMPLE]
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_COMPRESSION_RATIO
+
+
+def write_stream(_src, dest: Path, codec: (str, None) = None, level: (int, None) = None):
+    """ Writes the binary stream `_src` to `dest` in one pass, compressing with
+        `codec` if the data turns out to be compressible, and hashing it on
+        its way through.
+
+    Returns:
+        (str, int, str|None): content hash and size of the data, and the
+                              codec actually used
+    """
+    digest = bak_hash.TreeHash()
+    with open(dest, 'wb') as _dest:
+        chunk = _src.read(HASH_CHUNK_SIZE)
+        if codec and not _compresses_well(chunk):
+            codec = None
+        writer = CODECS[codec][1](_dest, level) if codec else _dest
+        try:
+            while chunk:
+                digest.update(chunk)
+                writer.write(chunk)
+                chunk = _src.read(HASH_CHUNK_SIZE)
+        finally:
+            if writer is not _dest:
+                writer.close()
+    return digest.hexdigest(), digest.size, codec
+
+
+def store_stream(_src, dest: Path, codec: (str, None) = None, level: (int, None) = None,
+                 durability: Durability = IMMEDIATE):
+    """ write_stream(), by way of a temporary file put in place by `durability`
+    """
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path(dest)
+    try:
+        written = write_stream(_src, tmp, codec, level)
+        durability.place(tmp, dest)
+    except BaseException:
+        _unlink_quietly(tmp)
+        raise
+    return written
+
+
+def write_bakfile(src: Path, dest: Path, codec: (str, None) = None, level: (int, None) = None,
+                  durability: Durability = IMMEDIATE):
+    """ Copies a file into the store, compressing it with `codec` if it's
+        compressible. Metadata is copied as with shutil.copy2. The copy is
+        written under a temporary name, then put in place by `durability`.
+
+    Returns:
+        (str|None, int, str|None, str): as write_stream(), plus the copy
+                                        strategy used. Large raw files are
+                                        not hashed (None).
+    """
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path(dest)
+    try:
+        written = _copy_in(src, tmp, codec, level)
+        durability.place(tmp, dest)
+    except BaseException:
+        _unlink_quietly(tmp)
+        raise
+    return written
+
+
+def _unlink_quietly(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _copy_in(src: Path, dest: Path, codec: (str, None), level: (int, None)):
+    """ The copying half of write_bakfile(), straight to `dest` """
+    size = os.stat(src).st_size
+    if size >= FAST_COPY_MIN_SIZE:
+        if codec:
+            with open(src, 'rb') as _src:
+                if not _compresses_well(_src.read(COMPRESSIBILITY_SAMPLE)):
+                    codec = None
+        if not codec:
+            return None, size, None, bak_copy.copy_file(src, dest)
+    with open(src, 'rb') as _src:
+        written = write_stream(_src, dest, codec, level)
+    copystat(src, dest)
+    return (*written, f"{written[2]} stream" if written[2] else 'chunked')
+
+
+def open_bakfile(bakfile_loc: Path, codec: (str, None) = None):
+    """ Opens a bakfile for reading its original contents as a binary stream
+    """
+    return CODECS[codec][0](bakfile_loc) if codec else open(bakfile_loc, 'rb')
+
+
+def restore_stream(_src, stat_src: Path, dest: Path):
+    """ Copies a bakfile's contents from `_src` to `dest`, then `stat_src`'s
+        metadata, as shutil.copy2 would
+    """
+    with open(dest, 'wb') as _dest:
+        copyfileobj(_src, _dest, HASH_CHUNK_SIZE)
+    copystat(stat_src, dest)
+
+
+def restore_bakfile(bakfile_loc: Path, codec: (str, None), dest: Path) -> str:
+    """ Copies a bakfile's original contents to `dest`
+
+    Returns:
+        str: the copy strategy used
+    """
+    if not codec:
+        return bak_copy.copy_file(bakfile_loc, dest)
+    with open_bakfile(bakfile_loc, codec) as _src:
+        restore_stream(_src, bakfile_loc, dest)
+    return f"{codec} stream"
+
+
+@contextmanager
+def materialize_stream(_src, suffix: str = ''):
+    """ Yields the path of a temporary file holding `_src`'s contents,
+        for external programs (pagers, diff)
+    """
+    with NamedTemporaryFile(prefix='bak-', suffix=suffix) as tmp_file:
+        copyfileobj(_src, tmp_file, HASH_CHUNK_SIZE)
+        tmp_file.flush()
+        yield Path(tmp_file.name)
+
+
+@contextmanager
+def materialize(bakfile_loc: Path, codec: (str, None), suffix: str = ''):
+    """ Yields the path of a plain copy of a bakfile's contents. Uncompressed
+        bakfiles are used in place; others are decompressed into a temporary
+        file for the duration.
+    """
+    if not codec:
+        yield Path(bakfile_loc)
+        return
+    with open_bakfile(bakfile_loc, codec) as _src, \
+            materialize_stream(_src, suffix) as tmp_path:
+        yield tmp_path
+
+
+def bakfile_path(bak_dir: Path, name: str, layout: str = 'sharded') -> Path:
+    """ Where a bakfile called `name` goes. 'flat' puts every bakfile right in
+        bak_dir. 'sharded' spreads them over 256 subdirectories, by a hash of
+        the name, so that none of them gets huge; deltas go next to the
+        bakfile they were made from.
+    """
+    if layout != 'sharded':
+        return bak_dir / name
+    key = name[:-len(DELTA_SUFFIX)] if name.endswith(DELTA_SUFFIX) else name
+    return bak_dir / hashlib.sha256(key.encode()).hexdigest()[:2] / name
+
+
+def in_layout(bak_dir: Path, bakfile_loc: Path) -> bool:
+    """ True if `bakfile_loc` is where one of the LAYOUTS would put it """
+    bakfile_loc = Path(bakfile_loc)
+    return bakfile_loc.parent in (bak_dir, bakfile_path(bak_dir, bakfile_loc.name).parent)
+
+
+def object_path(bak_dir: Path, content_hash: str) -> Path:
+    return bak_dir / OBJECTS_DIRNAME / content_hash[:2] / content_hash[2:]
+
+
+def is_object(bak_dir: Path, bakfile_loc: Path) -> bool:
+    """ True if `bakfile_loc` lives in the content-addressed part of the store
+    """
+    try:
+        Path(bakfile_loc).relative_to(bak_dir / OBJECTS_DIRNAME)
+    except ValueError:
+        return False
+    return True
+
+
+def store_object(bak_dir: Path,
+                 filename: Path,
+                 content_hash: str,
+                 codec: (str, None) = None,
+                 level: (int, None) = None,
+                 durability: Durability = IMMEDIATE):
+    """ Writes `filename` into the content-addressed store as `content_hash`.
+        Callers check whether the object already exists (and is referenced)
+        first; see commands.__store_bakfile().
+
+    Returns:
+        (Path, str, int, str|None, str): the object's location, to be used as
+                                         a bakfile_loc, then as write_bakfile()
+    """
+    obj = object_path(bak_dir, content_hash)
+    obj.parent.mkdir(parents=True, exist_ok=True)
+    # Objects are shared, so a half-written one must never be visible
+    # under its final name
+    tmp_obj = temp_path(obj)
+    try:
+        written = _copy_in(filename, tmp_obj, codec, level)
+        if written[0] is None:
+            written = (content_hash, *written[1:])
+        elif written[0] != content_hash:
+            # `filename` changed since it was hashed; file it under what we got
+            obj = object_path(bak_dir, written[0])
+            obj.parent.mkdir(parents=True, exist_ok=True)
+        durability.place(tmp_obj, obj)
+    except BaseException:
+        _unlink_quietly(tmp_obj)
+        raise
+    return (obj, *written)
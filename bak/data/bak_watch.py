@@ -0,0 +1,273 @@
+""" Change notification for `bak watch`. On Linux, inotify(7), called through
+    ctypes; elsewhere (or if inotify runs out of watches), polling with
+    os.scandir(). Either way, the watcher plugs into an asyncio event loop,
+    so watching costs nothing between changes, and reports changed paths to
+    a Coalescer, which batches bursts of writes into one backup.
+"""
+import ctypes
+import errno
+import os
+import struct
+from fnmatch import fnmatch
+from pathlib import Path
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# Editors that save by renaming a new file over the old one replace its
+# inode, so it's the directories that are watched, never the files
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# Editors' swap and backup files, not worth a bakfile of their own
+IGNORED_NAMES = ('.*.sw?', '*~', '.#*', '4913')
+
+
+class Watcher:
+    """ What's being watched: `files`, and every file in `dirs` (and, if
+        `recursive`, their subdirectories). Nothing under `exclude` counts.
+        Subclasses call `on_change(path)` as things change.
+    """
+    name: str
+
+    def __init__(self, files, dirs, recursive: bool, on_change, exclude=()):
+        self.files = {Path(path) for path in files}
+        self.dirs = {Path(path) for path in dirs}
+        self.recursive = recursive
+        self.on_change = on_change
+        self.exclude = {Path(path) for path in exclude}
+        self.loop = None
+
+    def wants(self, path: Path) -> bool:
+        if path in self.exclude or any(fnmatch(path.name, pattern) for pattern in IGNORED_NAMES):
+            return False
+        if path in self.files:
+            return True
+        if self.recursive:
+            return any(parent in self.dirs for parent in path.parents) and \
+                not any(parent in self.exclude for parent in path.parents)
+        return path.parent in self.dirs
+
+    def watched_dirs(self):
+        """ Directories to keep an eye on: those of `dirs` (walked with
+            os.scandir() when recursive) and the parents of `files`
+        """
+        found = {path.parent for path in self.files}
+        pending = list(self.dirs)
+        while pending:
+            directory = pending.pop()
+            if directory in found or directory in self.exclude:
+                continue
+            found.add(directory)
+            if self.recursive:
+                try:
+                    with os.scandir(directory) as entries:
+                        pending.extend(Path(entry.path) for entry in entries
+                                       if entry.is_dir(follow_symlinks=False))
+                except OSError:
+                    pass
+        return found
+
+    def start(self, loop):
+        self.loop = loop
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    name = 'inotify'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.dirs_by_wd = {}
+        try:
+            for directory in self.watched_dirs():
+                self.add_dir(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_dir(self, directory: Path):
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            # ENOSPC: out of watches (fs.inotify.max_user_watches)
+            raise OSError(error, f"{os.strerror(error)}: {directory}")
+        self.dirs_by_wd[wd] = directory
+
+    def start(self, loop):
+        super().start(loop)
+        loop.add_reader(self.fd, self._read_events)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped; anything might have changed
+            for path in self.files:
+                self.on_change(path)
+            for directory in self.dirs_by_wd.values():
+                self._changed_in(directory)
+            return
+        directory = self.dirs_by_wd.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.dirs_by_wd[wd]
+            return
+        path = directory / name
+        if mask & IN_ISDIR:
+            if self.recursive and mask & (IN_CREATE | IN_MOVED_TO) and \
+                    any(parent in self.dirs for parent in (path, *path.parents)) and \
+                    path not in self.exclude:
+                # Files may have landed in it before the watch was in place
+                self.add_dir(path)
+                self._changed_in(path)
+            return
+        if self.wants(path):
+            self.on_change(path)
+
+    def _changed_in(self, directory: Path):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False) and self.wants(Path(entry.path)):
+                        self.on_change(Path(entry.path))
+        except OSError:
+            pass
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+    """ Looks for changed (mtime, size, inode) signatures every `interval`
+        seconds: one os.scandir() per directory, one stat() per file
+    """
+    name = 'polling'
+
+    def __init__(self, *args, interval: float = 2.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.signatures = self._scan()
+        self._timer = None
+
+    def _scan(self):
+        signatures = {}
+        for directory in self.watched_dirs():
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        path = Path(entry.path)
+                        if entry.is_file(follow_symlinks=False) and self.wants(path):
+                            stat = entry.stat(follow_symlinks=False)
+                            signatures[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            except OSError:
+                pass
+        return signatures
+
+    def start(self, loop):
+        super().start(loop)
+        self._timer = loop.call_later(self.interval, self._poll)
+
+    def _poll(self):
+        signatures = self._scan()
+        for path, signature in signatures.items():
+            if self.signatures.get(path) != signature:
+                self.on_change(path)
+        self.signatures = signatures
+        self._timer = self.loop.call_later(self.interval, self._poll)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def watch(files, dirs, recursive: bool, on_change, exclude=(), poll_interval: (float, None) = None):
+    """ An InotifyWatcher, or a PollingWatcher if `poll_interval` is given
+        or inotify can't be used
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(files, dirs, recursive, on_change, exclude)
+        except (OSError, AttributeError):
+            poll_interval = 2.0
+    return PollingWatcher(files, dirs, recursive, on_change, exclude, interval=poll_interval)
+
+
+class Coalescer:
+    """ Collects changed paths, and hands them to `flush` in batches once each
+        has been quiet for `delay` seconds, so that a burst of writes (or a
+        string of saves) makes one bakfile. Files that never stop changing,
+        like logs, are flushed at least every `max_delay` seconds.
+    """
+
+    def __init__(self, loop, delay: float, max_delay: float, flush):
+        self.loop, self.delay, self.max_delay, self.flush = loop, delay, max_delay, flush
+        self.first_change = {}
+        self.due = {}
+        self._timer = None
+
+    def add(self, path: Path):
+        now = self.loop.time()
+        first = self.first_change.setdefault(path, now)
+        self.due[path] = min(now + self.delay, first + self.max_delay)
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_at(min(self.due.values()), self._fire) if self.due else None
+
+    def _fire(self):
+        # asyncio may run timers a hair early
+        now = self.loop.time() + 0.001
+        ready = [path for path, due in self.due.items() if due <= now]
+        for path in ready:
+            del self.due[path], self.first_change[path]
+        self._schedule()
+        if ready:
+            self.flush(ready)
+
+    def flush_all(self):
+        """ Flushes whatever's pending right away, e.g. when stopping """
+        ready = list(self.due)
+        self.due.clear()
+        self.first_change.clear()
+        self._schedule()
+        if ready:
+            self.flush(ready)
@@ -3,11 +3,26 @@ from pathlib import Path
 
 
 class BakFile:
+    """ One row of the bakfiles table. Stores can hold a great many of
+        these, so they're slotted (no per-instance __dict__), and the dates
+        stay as the DB's ISO strings until created_at/modified_at are asked
+        for, then are parsed once.
+    """
+    __slots__ = ('original_file', 'orig_abspath', 'bakfile_loc', 'date_created',
+                 'date_modified', 'restored', 'rowid', 'content_hash', 'size', 'codec',
+                 'delta_base', 'snapshot', 'source_stat', '_created_at', '_modified_at')
     original_file: str
     orig_abspath: Path
     bakfile_loc: Path
-    date_created: datetime
-    date_modified: datetime
+    date_created: (str, datetime)
+    date_modified: (str, datetime)
+    rowid: (int, None)
+    content_hash: (str, None)
+    size: (int, None)
+    codec: (str, None)
+    delta_base: (int, None)
+    snapshot: (int, None)
+    source_stat: (str, None)
 
     def __init__(self,
                  original: str,
@@ -15,7 +30,14 @@ class BakFile:
                  bakfile: Path,
                  created: datetime,
                  modified: datetime,
-                 restored: bool):
+                 restored: bool,
+                 rowid: (int, None) = None,
+                 content_hash: (str, None) = None,
+                 size: (int, None) = None,
+                 codec: (str, None) = None,
+                 delta_base: (int, None) = None,
+                 snapshot: (int, None) = None,
+                 source_stat: (str, None) = None):
         self.original_file, \
             self.orig_abspath, \
             self.bakfile_loc, \
@@ -23,6 +45,44 @@ class BakFile:
             self.date_modified, \
             self.restored = \
             original, orig_abspath, bakfile, created, modified, restored
+        # Several entries may share one bakfile_loc, so the DB row is the identity
+        self.rowid = rowid
+        # Size and bak-tree-sha256 hash (see bak_hash.py) of the original
+        # contents; not a plain sha256sum, so don't compare it with one. The
+        # hash may be missing: the v7 migration cleared it for entries over
+        # 16 MiB, and raw files of FAST_COPY_MIN_SIZE or more, copied in by
+        # bak_store._copy_in(), are stored without one (it's worked out later)
+        self.content_hash, self.size = content_hash, size
+        # Compression codec (see bak_store.CODECS), or None if stored raw
+        self.codec = codec
+        # If set, this bakfile is a reverse delta against the entry with that rowid
+        self.delta_base = delta_base
+        # Id of the directory snapshot (`bak -r`) this entry belongs to, if any
+        self.snapshot = snapshot
+        # The original's stat signature (see bak_store.stat_signature()) when
+        # it last had these contents, if known; lets `bak` skip reading it
+        self.source_stat = source_stat
+        # (string, datetime) once parsed
+        self._created_at = self._modified_at = None
+
+    @staticmethod
+    def _parse(value: (str, datetime), cached: (tuple, None)):
+        if isinstance(value, datetime):
+            return value, None
+        # The date may have been reassigned (`bak up` does) since it was parsed
+        if cached is None or cached[0] is not value:
+            cached = (value, datetime.fromisoformat(value))
+        return cached[1], cached
+
+    @property
+    def created_at(self) -> datetime:
+        parsed, self._created_at = self._parse(self.date_created, self._created_at)
+        return parsed
+
+    @property
+    def modified_at(self) -> datetime:
+        parsed, self._modified_at = self._parse(self.date_modified, self._modified_at)
+        return parsed
 
     def export(self):
         return((
@@ -31,5 +91,11 @@ class BakFile:
             str(self.bakfile_loc),
             self.date_created,
             self.date_modified,
-            self.restored
+            self.restored,
+            self.content_hash,
+            self.size,
+            self.codec,
+            self.delta_base,
+            self.snapshot,
+            self.source_stat
         ))
@@ -0,0 +1,30 @@
+from importlib import import_module
+
+from bak import trace
+
+
+class LazyImport:
+    """ Stands in for `module.name` (a class, usually) until it's first used,
+        then imports it. For slow imports, like rich, that most invocations
+        of bak never need.
+
+            Console = LazyImport('rich.console', 'Console')
+            console = Console()    # rich.console is imported here
+    """
+
+    def __init__(self, module: str, name: (str, None) = None):
+        self._module, self._name = module, name
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            with trace.phase(f"import {self._module}"):
+                module = import_module(self._module)
+            self._target = getattr(module, self._name) if self._name else module
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
@@ -0,0 +1,327 @@
+""" `bak --trace` (or BAK_TRACE=1): where a command's time goes. Reports
+    wall time per phase (startup, config, copying, rendering, ...), database
+    calls and the queries they ran, bytes read and written, and peak memory,
+    on stderr or as JSON. `--profile` runs the command under cProfile too.
+
+    Tracing is off unless asked for, and then phase() and count() cost a
+    global lookup each. The database is traced by wrapping BakDBHandler's
+    methods when tracing starts, so bak_db itself knows nothing about it.
+"""
+import atexit
+import os
+import sys
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+# BAK_TRACE=1 (or 'stderr') reports on stderr; any other value, besides 0,
+# is a file to write the JSON report to. BAK_TRACE_PROFILE=1 adds cProfile.
+TRACE_ENV = 'BAK_TRACE'
+PROFILE_ENV = 'BAK_TRACE_PROFILE'
+STDERR_VALUES = ('1', 'stderr', '-')
+# Functions in a --profile report, by cumulative time
+PROFILE_TOP = 25
+# BakDBHandler methods that hand back context managers or don't query
+UNTIMED_DB_METHODS = ('transaction', 'call_after_commit', 'close')
+# inspect.CO_GENERATOR; inspect itself costs bak --version too much to import
+CO_GENERATOR = 0x20
+
+_tracer = None
+_off = nullcontext()
+
+
+class Tracer:
+    def __init__(self, output: (str, None), profile: bool):
+        import threading
+        import tracemalloc
+
+        self.output = output
+        self.command = list(sys.argv)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # {name: [calls, seconds]}; phases nest, and their names with them
+        self.phases = {}
+        # {method: [calls, seconds, queries]}
+        self.db_calls = {}
+        self.counters = {}
+        self.io_at_start = _proc_io()
+        tracemalloc.start()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = perf_counter()
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _add(self, table: dict, key: str, *amounts):
+        with self.lock:
+            totals = table.setdefault(key, [0] * len(amounts))
+            for i, amount in enumerate(amounts):
+                totals[i] += amount
+
+    @contextmanager
+    def phase(self, name: str):
+        stack = self._stack()
+        stack.append(name)
+        key = '/'.join(stack)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._add(self.phases, key, 1, perf_counter() - start)
+            stack.pop()
+
+    # region database
+    def wrap_db_method(self, name: str, method):
+        if getattr(method, '__code__', None) and method.__code__.co_flags & CO_GENERATOR:
+            return self.wrap_db_generator(name, method)
+
+        def traced(*args, **kwargs):
+            outer = getattr(self.local, 'db_method', None)
+            self.local.db_method = name
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                # Queries count against the innermost method; time is inclusive
+                self._add(self.db_calls, name, 1, perf_counter() - start, 0)
+                self.local.db_method = outer
+        traced.__name__, traced.__doc__ = method.__name__, method.__doc__
+        return traced
+
+    def wrap_db_generator(self, name: str, method):
+        """ Generators (iter_entries() and co.) run their queries as they're
+            iterated, not when called, so each step is timed instead
+        """
+        def traced(*args, **kwargs):
+            generator = method(*args, **kwargs)
+            calls = 1
+            while True:
+                outer = getattr(self.local, 'db_method', None)
+                self.local.db_method = name
+                start = perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    self._add(self.db_calls, name, calls, perf_counter() - start, 0)
+                    self.local.db_method = outer
+                    calls = 0
+                yield item
+        traced.__name__, traced.__doc__ = method.__name__, method.__doc__
+        return traced
+
+    def wrap_db_conn(self, db_conn: property):
+        def connect(handler):
+            if handler._db_conn is not None:
+                return db_conn.fget(handler)
+            with self.phase('db open'):
+                conn = db_conn.fget(handler)
+            conn.set_trace_callback(self.on_query)
+            return conn
+        return property(connect, doc=db_conn.__doc__)
+
+    def on_query(self, statement: str):
+        # Statements run straight on the connection (in a transaction() block,
+        # say) belong to no method
+        self._add(self.db_calls, getattr(self.local, 'db_method', None) or '(direct)', 0, 0, 1)
+    # endregion
+
+    # region reporting
+    def report(self) -> dict:
+        import tracemalloc
+
+        total = perf_counter() - self.started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        io_now = _proc_io()
+        report = {
+            'command': self.command,
+            'total_s': total,
+            'phases': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in sorted(self.phases.items())},
+            'db': {'queries': sum(queries for _, _, queries in self.db_calls.values()),
+                   'calls': {name: {'calls': calls, 'seconds': seconds, 'queries': queries}
+                             for name, (calls, seconds, queries)
+                             in sorted(self.db_calls.items(), key=lambda item: -item[1][1])}},
+            'io': {'counters': dict(self.counters),
+                   'process': {key: io_now[key] - self.io_at_start.get(key, 0)
+                               for key in io_now}},
+            'memory': {'tracemalloc_peak': peak, 'max_rss': _max_rss()},
+        }
+        if self.profiler is not None:
+            report['profile'] = _profile_top(self.profiler)
+        return report
+
+    def finish(self):
+        # Not imported up front: json pulls in re, which costs bak --version
+        # more than everything else it does
+        import json
+
+        if self.profiler is not None:
+            self.profiler.disable()
+        report = self.report()
+        if self.output is None:
+            sys.stderr.write(format_report(report))
+            return
+        try:
+            with open(self.output, 'w') as _file:
+                json.dump(report, _file, indent=1)
+                _file.write('\n')
+        except OSError as error:
+            sys.stderr.write(f"bak: couldn't write trace to {self.output}: {error.strerror}\n")
+    # endregion
+
+
+# region hooks
+def active() -> bool:
+    return _tracer is not None
+
+
+def phase(name: str):
+    """ Context manager timing its block as `name`, when tracing """
+    return _tracer.phase(name) if _tracer is not None else _off
+
+
+def count(counter: str, amount: int):
+    """ Adds `amount` (bytes copied, say) to a counter, when tracing """
+    if _tracer is not None:
+        with _tracer.lock:
+            _tracer.counters[counter] = _tracer.counters.get(counter, 0) + amount
+# endregion
+
+
+# region starting
+def start(output: (str, None) = None, profile: bool = False):
+    """ Starts tracing, unless it already has been. The report is written
+        to `output` as JSON (or to stderr, as text) when bak exits.
+    """
+    global _tracer
+    if _tracer is not None:
+        return
+    from bak.data.bak_db import BakDBHandler
+
+    _tracer = Tracer(os.path.abspath(output) if output else None, profile)
+    for name, attr in list(vars(BakDBHandler).items()):
+        if name == 'db_conn':
+            setattr(BakDBHandler, name, _tracer.wrap_db_conn(attr))
+        elif callable(attr) and not name.startswith('_') and name not in UNTIMED_DB_METHODS:
+            setattr(BakDBHandler, name, _tracer.wrap_db_method(name, attr))
+    atexit.register(_tracer.finish)
+
+
+def start_from_options(trace: bool = False, output: (str, None) = None, profile: bool = False):
+    """ Starts tracing if the command line or the environment ask for it """
+    env = os.environ.get(TRACE_ENV, '')
+    env_profile = os.environ.get(PROFILE_ENV, '') not in ('', '0')
+    if not (trace or output or profile or env not in ('', '0') or env_profile):
+        return
+    if output is None and env not in ('', '0') and env not in STDERR_VALUES:
+        output = env
+    start(output, profile or env_profile)
+
+
+def start_early(args):
+    """ For bak's entry point: looks through the global options ahead of the
+        command (--trace, --trace-file FILE, --profile), so that tracing can
+        start before the rest of bak is imported. The CLI parses them again.
+    """
+    trace, output, profile = False, None, False
+    args = iter(args)
+    for arg in args:
+        if arg == '--trace':
+            trace = True
+        elif arg == '--profile':
+            profile = True
+        elif arg == '--trace-file':
+            output = next(args, None)
+        elif arg.startswith('--trace-file='):
+            output = arg.split('=', 1)[1]
+        elif arg != '--version':
+            break
+    start_from_options(trace, output, profile)
+# endregion
+
+
+# region helpers
+def _proc_io() -> dict:
+    """ The process's I/O counters, on Linux: rchar/wchar (bytes passed to
+        read() and write()) and read_bytes/write_bytes (bytes that hit the disk)
+    """
+    try:
+        with open('/proc/self/io') as _file:
+            return {key: int(value) for key, value in
+                    (line.split(':') for line in _file if ':' in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+def _max_rss() -> (int, None):
+    try:
+        import resource
+    except ImportError:  # not POSIX
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB everywhere else
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _profile_top(profiler, top: int = PROFILE_TOP):
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: -item[1][3])[:top]
+    return [{'function': f"{filename}:{line}({name})", 'calls': calls,
+             'tottime': tottime, 'cumtime': cumtime}
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in rows]
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:10.1f} ms"
+
+
+def _bytes(amount: (int, None)) -> str:
+    if amount is None:
+        return "?"
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(amount) < 1024 or unit == 'GiB':
+            return f"{amount:.0f} {unit}" if unit == 'B' else f"{amount:.1f} {unit}"
+        amount /= 1024
+
+
+def format_report(report: dict) -> str:
+    """ The plain-text report --trace prints to stderr """
+    lines = [f"bak trace: {' '.join(report['command'][1:]) or 'bak'}",
+             f"  {'total':<40}{_ms(report['total_s'])}",
+             "phases (inclusive; threads add up separately):"]
+    for name, phase_ in report['phases'].items():
+        lines.append(f"  {name:<40}{_ms(phase_['seconds'])}  x{phase_['calls']}")
+    db = report['db']
+    lines.append(f"database: {db['queries']} queries")
+    for name, call in db['calls'].items():
+        lines.append(f"  {name:<40}{_ms(call['seconds'])}  x{call['calls']}, "
+                     f"{call['queries']} queries")
+    lines.append("i/o:")
+    for name, amount in report['io']['counters'].items():
+        lines.append(f"  {name:<40}{_bytes(amount):>13}")
+    for name, amount in report['io']['process'].items():
+        if name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+            lines.append(f"  {name:<40}{_bytes(amount):>13}")
+    memory = report['memory']
+    lines.append(f"memory: peak {_bytes(memory['tracemalloc_peak'])} traced by tracemalloc, "
+                 f"max RSS {_bytes(memory['max_rss'])}")
+    if 'profile' in report:
+        lines.append(f"profile (top {len(report['profile'])} by cumulative time):")
+        lines.append(f"  {'calls':>9} {'tottime':>13} {'cumtime':>13}  function")
+        for row in report['profile']:
+            lines.append(f"  {row['calls']:>9} {_ms(row['tottime'])} {_ms(row['cumtime'])}"
+                         f"  {row['function']}")
+    return '\n'.join(lines) + '\n'
+# endregion
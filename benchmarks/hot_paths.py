@@ -0,0 +1,299 @@
+""" Timings of bak's hot paths against synthetic stores, written as JSON so
+    runs can be compared across commits.
+
+        python benchmarks/hot_paths.py [--entries 10,1k,100k] [--sizes 1K,1M,64M]
+                                       [--runs N] [--full] [--output FILE]
+        python benchmarks/hot_paths.py --compare BEFORE.json AFTER.json
+
+    Each store size gets a throwaway XDG_CONFIG_HOME/XDG_DATA_HOME. Its
+    database is filled straight from SQL, ten versions per file; those rows
+    share one small bakfile, as dedup or snapshots would. The store is then
+    benchmarked in a fresh interpreter. That interpreter also makes a text
+    file of each size and times these with real bakfiles:
+    - create_bakfile and bak_up_cmd;
+    - bak_down_cmd, to another destination;
+    - bak_diff_cmd, with bak's builtin diff and with diff(1);
+    - show_bak_list, for that file and for the whole store, with and
+      without --compare.
+    Cold starts (`python -m bak ...`) are timed against every store too.
+
+    --full adds a store of 1M entries and a 4G file. Those take a while to
+    build, and need the disk space.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+DEFAULT_ENTRIES = ['10', '1k', '100k']
+DEFAULT_SIZES = ['1K', '1M', '64M']
+FULL_ENTRIES = ['1M']
+FULL_SIZES = ['4G']
+# Listing the whole store is skipped above this many entries; rich takes
+# minutes to draw a million rows, and nobody reads them
+LIST_ALL_MAX_ENTRIES = 100_000
+VERSIONS_PER_FILE = 10
+# --compare flags anything this much slower
+REGRESSION_THRESHOLD = 1.10
+
+
+def parse_count(count: str) -> int:
+    """ '10', '1k', '100k', '1M' """
+    multiplier = {'k': 1000, 'm': 1000 ** 2}.get(count[-1].lower(), 1)
+    return int(float(count.rstrip('kKmM')) * multiplier)
+
+
+def parse_size(size: str) -> int:
+    """ '1K', '64M', '4G', in powers of 1024 """
+    multiplier = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}.get(size[-1].lower(), 1)
+    return int(float(size.rstrip('kKmMgG')) * multiplier)
+
+
+# region worker (runs inside a sandbox, with bak imported)
+@contextmanager
+def silenced():
+    """ Sends stdout and stderr (including child processes') to /dev/null """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in (*saved, devnull):
+            os.close(fd)
+
+
+def time_runs(function, runs: int, prepare=None):
+    """ Wall-clock seconds of `runs` calls of `function`, each after an
+        untimed call of `prepare`
+    """
+    timings = []
+    for _ in range(runs):
+        if prepare:
+            prepare()
+        with silenced():
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def fill_store(commands, entries: int):
+    """ `entries` rows, VERSIONS_PER_FILE per original file, all sharing one
+        bakfile, inserted in one transaction
+    """
+    filler = commands.bak_dir / 'filler.bak'
+    filler.parent.mkdir(parents=True, exist_ok=True)
+    filler.write_bytes(b"filler\n")
+    start = datetime(2020, 1, 1)
+
+    def rows():
+        for i in range(entries):
+            original = f"/nonexistent/bench/dir{i // 10000}/file{i // VERSIONS_PER_FILE}.txt"
+            created = start + timedelta(minutes=i)
+            yield (Path(original).name, original, str(filler), created, created, 0)
+
+    with commands.db_handler.transaction() as db_conn:
+        db_conn.executemany(
+            """
+            INSERT INTO bakfiles (original_file, original_abspath, bakfile,
+                                  date_created, date_modified, restored)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, rows())
+
+
+def write_text_file(path: Path, size: int):
+    """ Deterministic numbered lines, `size` bytes in all """
+    block = b''.join(b"%08d the quick brown fox jumps over the lazy dog\n" % i
+                     for i in range(20000))
+    with open(path, 'wb') as _file:
+        for _ in range(size // len(block)):
+            _file.write(block)
+        _file.write(block[:size % len(block)])
+
+
+_edits = itertools.count(1)
+
+
+def touch_line(path: Path):
+    """ Changes one line in the middle of `path`, so there's something new
+        to back up (and to diff)
+    """
+    with open(path, 'r+b') as _file:
+        _file.seek(os.fstat(_file.fileno()).st_size // 2)
+        _file.write(b"edit %08d" % next(_edits))
+
+
+def run_worker(entries: int, sizes, runs: int):
+    from bak import commands
+
+    results = []
+
+    def record(benchmark, timings, size=None):
+        results.append({'benchmark': benchmark, 'entries': entries, 'size': size,
+                        'median_s': statistics.median(timings), 'min_s': min(timings),
+                        'runs_s': timings})
+
+    fill_store(commands, entries)
+    for size_name in sizes:
+        subject = Path.cwd() / f"subject-{size_name}.txt"
+        write_text_file(subject, parse_size(size_name))
+        record('create_bakfile', time_runs(lambda: commands.create_bakfile(subject),
+                                           runs, lambda: touch_line(subject)), size_name)
+        bakfile_count = len(commands.db_handler.get_bakfile_entries(subject))
+        record('bak_up_cmd', time_runs(lambda: commands.bak_up_cmd(subject, bakfile_count),
+                                       runs, lambda: touch_line(subject)), size_name)
+        restored = Path.cwd() / f"restored-{size_name}.txt"
+        record('bak_down_cmd', time_runs(
+            lambda: commands.bak_down_cmd(subject, restored, ['all'], quiet=True,
+                                          bakfile_number=1), runs), size_name)
+        restored.unlink()
+        for command in ('builtin', 'diff %old %new'):
+            record(f"bak_diff_cmd ({command.split()[0]})", time_runs(
+                lambda: commands.bak_diff_cmd(subject, command, bakfile_number=1), runs),
+                size_name)
+        for compare in (False, True):
+            record(f"show_bak_list FILE{' --compare' if compare else ''}", time_runs(
+                lambda: commands.show_bak_list(subject, compare=compare), runs), size_name)
+
+    if entries <= LIST_ALL_MAX_ENTRIES:
+        for compare in (False, True):
+            record(f"show_bak_list{' --compare' if compare else ''}", time_runs(
+                lambda: commands.show_bak_list(compare=compare), runs))
+    record('show_bak_list (first page)', time_runs(
+        lambda: commands.show_bak_list(limit=commands.BAK_LIST_PAGE_SIZE), runs))
+    return results
+# endregion
+
+
+def sandbox_env(sandbox: Path):
+    (sandbox / 'config').mkdir()
+    (sandbox / 'data').mkdir()
+    (sandbox / 'config' / 'bak.cfg.default').write_bytes(
+        (REPO / 'bak' / 'default.cfg').read_bytes())
+    return dict(os.environ,
+                XDG_CONFIG_HOME=str(sandbox / 'config'),
+                XDG_DATA_HOME=str(sandbox / 'data'),
+                PYTHONPATH=str(REPO))
+
+
+def time_cold_starts(env, cwd: Path, entries: int, subject: str, runs: int):
+    results = []
+    for args in [('--version',), ('where', subject, '1'), ('list', subject)]:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            # As root, bak asks for confirmation before doing anything
+            subprocess.run([sys.executable, '-m', 'bak', *args], env=env, cwd=cwd,
+                           input=b'y\n', stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+        results.append({'benchmark': f"cold start: bak {' '.join(args)}", 'entries': entries,
+                        'size': None, 'median_s': statistics.median(timings),
+                        'min_s': min(timings), 'runs_s': timings})
+    return results
+
+
+def metadata(runs: int):
+    def git(*args):
+        try:
+            return subprocess.run(['git', '-C', str(REPO), *args], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {'commit': git('rev-parse', 'HEAD'),
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'runs': runs}
+
+
+def compare(before_file: str, after_file: str):
+    """ Prints after/before ratios of median times. Returns 1 if anything
+        got slower by more than REGRESSION_THRESHOLD.
+    """
+    def load(filename):
+        with open(filename) as _file:
+            report = json.load(_file)
+        return report['meta'], {(result['benchmark'], result['entries'], result['size']): result
+                                for result in report['results']}
+    (before_meta, before), (after_meta, after) = load(before_file), load(after_file)
+    print(f"before: {before_meta['commit']}  after: {after_meta['commit']}")
+    regressed = False
+    for key in sorted(before.keys() & after.keys(), key=str):
+        ratio = after[key]['median_s'] / before[key]['median_s'] if before[key]['median_s'] else 1
+        slower = ratio > REGRESSION_THRESHOLD
+        regressed |= slower
+        benchmark, entries, size = key
+        print(f"{benchmark:<36}{entries:>9} entries {size or '':>5}"
+              f"{before[key]['median_s'] * 1000:10.2f} ms{after[key]['median_s'] * 1000:10.2f} ms"
+              f"{ratio:8.2f}x{'  SLOWER' if slower else ''}")
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', default=','.join(DEFAULT_ENTRIES),
+                        help="Store sizes, comma-separated (default: %(default)s)")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help="File sizes, comma-separated (default: %(default)s)")
+    parser.add_argument('--full', action='store_true',
+                        help=f"Add {', '.join(FULL_ENTRIES)} entries and {', '.join(FULL_SIZES)} files")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help="Write JSON here (default: stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.compare:
+        return compare(*options.compare)
+    sizes = options.sizes.split(',') + (FULL_SIZES if options.full else [])
+    if options.worker:
+        json.dump(run_worker(parse_count(options.entries), sizes, options.runs), sys.stdout)
+        return 0
+
+    results = []
+    for entries in options.entries.split(',') + (FULL_ENTRIES if options.full else []):
+        with tempfile.TemporaryDirectory(prefix='bak-bench-') as sandbox:
+            sandbox = Path(sandbox)
+            env = sandbox_env(sandbox)
+            print(f"{entries} entries...", file=sys.stderr)
+            worker = subprocess.run(
+                [sys.executable, __file__, '--worker', '--entries', entries,
+                 '--sizes', ','.join(sizes), '--runs', str(options.runs)],
+                env=env, cwd=sandbox, stdout=subprocess.PIPE, check=True)
+            results += json.loads(worker.stdout)
+            results += time_cold_starts(env, sandbox, parse_count(entries),
+                                        f"subject-{sizes[0]}.txt", options.runs)
+
+    report = json.dumps({'meta': metadata(options.runs), 'results': results}, indent=1)
+    if options.output:
+        Path(options.output).write_text(report + '\n')
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+""" Startup time of the commands bak is called for from shell prompts and
+    hooks, against a budget.
+
+        python benchmarks/startup.py [--runs N]
+
+    Each command is run N times in a throwaway XDG_CONFIG_HOME/XDG_DATA_HOME;
+    the median is compared with a bare `python -c pass`, and the difference
+    (bak's own startup) with the command's budget. Exits 1 if any command is
+    over budget.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+# Milliseconds on top of the interpreter's own startup
+BUDGETS_MS = {
+    ('--version',): 25,
+    ('where', 'example.txt', '1'): 60,
+    ('config', '--get', 'colors'): 50,
+}
+# Not budgeted; for comparison
+UNBUDGETED = [('list', 'example.txt')]
+
+
+def run(args, env, cwd):
+    # As root, bak asks for confirmation before doing anything
+    subprocess.run([sys.executable, *args], env=env, cwd=cwd, input=b'y\n',
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+def time_median(args, env, cwd, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(args, env, cwd)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=15)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bak-bench-') as sandbox:
+        sandbox = Path(sandbox)
+        (sandbox / 'config').mkdir()
+        (sandbox / 'data').mkdir()
+        (sandbox / 'config' / 'bak.cfg.default').write_bytes(
+            (REPO / 'bak' / 'default.cfg').read_bytes())
+        env = dict(os.environ,
+                   XDG_CONFIG_HOME=str(sandbox / 'config'),
+                   XDG_DATA_HOME=str(sandbox / 'data'),
+                   PYTHONPATH=str(REPO))
+        (sandbox / 'example.txt').write_text("example\n")
+        run(['-m', 'bak', 'create', 'example.txt'], env, sandbox)
+
+        baseline = time_median(['-c', 'pass'], env, sandbox, options.runs)
+        print(f"{'python -c pass':<32}{baseline:8.1f} ms")
+        over_budget = False
+        for args in [*BUDGETS_MS, *UNBUDGETED]:
+            overhead = time_median(['-m', 'bak', *args], env, sandbox, options.runs) - baseline
+            budget = BUDGETS_MS.get(args)
+            verdict = '' if budget is None else \
+                f"(budget {budget} ms{', OVER' if overhead > budget else ''})"
+            over_budget |= budget is not None and overhead > budget
+            print(f"{'bak ' + ' '.join(args):<32}{overhead:+8.1f} ms  {verdict}")
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())